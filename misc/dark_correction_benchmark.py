@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Benchmark dark-current (and flat-field) correction of full-frame camera
+# images: the original DarkCurrentCorrector.correct() method (interpolate the
+# dark image, subtract in int32, clip, cast back) against
+# image_correction.ImageCorrector, with and without threads, output buffers
+# and flat-fielding.
+#
+#   dark_correction_benchmark.py --repeats 50 --threads 1 2 4 8
+#
+import argparse
+import time
+
+import numpy
+
+from scope.util import image_correction
+
+def original_correct(exposures, dark_images, image, exposure_ms):
+    i = numpy.searchsorted(exposures, exposure_ms)
+    before_exp, after_exp = exposures[i-1], exposures[i]
+    a = (exposure_ms - before_exp) / (after_exp - before_exp)
+    dark_image = ((1-a) * dark_images[i-1] + a * dark_images[i]).round().astype(numpy.uint16)
+    int_image = image.astype(numpy.int32) - dark_image
+    int_image[int_image < 0] = 0
+    return int_image.astype(numpy.uint16)
+
+def make_test_data(shape, exposure_count=10):
+    exposures = numpy.logspace(numpy.log10(0.5), numpy.log10(1000), exposure_count, base=10)
+    base = numpy.random.normal(100, 3, size=shape)
+    dark_images = [base + exp * 0.01 + numpy.random.normal(0, 1, size=shape) for exp in exposures]
+    image = numpy.random.randint(80, 20000, size=shape).astype(numpy.uint16)
+    flat_field = numpy.random.uniform(0.9, 1.1, size=shape).astype(numpy.float32)
+    return exposures, dark_images, image, flat_field
+
+def time_function(function, repeats):
+    function() # warm up caches
+    t0 = time.perf_counter()
+    for i in range(repeats):
+        function()
+    return (time.perf_counter() - t0) / repeats
+
+def benchmark(shape, repeats, thread_counts):
+    exposures, dark_images, image, flat_field = make_test_data(shape)
+    exposure_ms = 13.7 # between calibration exposures, so the dark image must be interpolated
+    expected = original_correct(exposures, dark_images, image, exposure_ms)
+    mb = image.nbytes / 1e6
+    print('Correcting {}x{} uint16 images ({:.1f} MB)'.format(shape[1], shape[0], mb))
+
+    def report(name, seconds):
+        print('\t{}: {:.2f} ms/image, {:.0f} MB/s'.format(name, seconds * 1000, mb / seconds))
+
+    report('original', time_function(lambda: original_correct(exposures, dark_images, image, exposure_ms), repeats))
+    out = numpy.empty_like(image)
+    for num_threads in thread_counts:
+        corrector = image_correction.ImageCorrector(exposures, dark_images, num_threads)
+        assert (corrector.correct(image, exposure_ms) == expected).all()
+        report('{} threads, new output'.format(num_threads),
+            time_function(lambda: corrector.correct(image, exposure_ms), repeats))
+        report('{} threads, output buffer'.format(num_threads),
+            time_function(lambda: corrector.correct(image, exposure_ms, out=out), repeats))
+        report('{} threads, output buffer + flat-field'.format(num_threads),
+            time_function(lambda: corrector.correct(image, exposure_ms, flat_field, out), repeats))
+        corrector.shutdown()
+
+parser = argparse.ArgumentParser('dark_correction_benchmark.py')
+parser.add_argument('--width', type=int, default=2560)
+parser.add_argument('--height', type=int, default=2160)
+parser.add_argument('--repeats', type=int, default=20)
+parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+args = parser.parse_args()
+benchmark((args.height, args.width), args.repeats, args.threads)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Benchmark flat-field estimation: the original full-resolution smoothing
+# pipeline against calibrate.get_flat_field(), which smooths a downsampled
+# image. Reports the runtime of each and the largest relative difference
+# between their flat-field images within the (slightly eroded) image region.
+#
+#   flat_field_benchmark.py [image.png] --repeats 5 --downsample 2 4 8
+#
+# With no image, a synthetic vignetted brightfield image is used.
+#
+import argparse
+import time
+
+import freeimage
+import numpy
+from scipy import ndimage
+
+from scope.client_util import calibrate
+
+def original_flat_field(image, vignette_mask):
+    flat_field = numpy.array(image, dtype=float)
+    near_vignette_mask = vignette_mask ^ ndimage.binary_erosion(vignette_mask, iterations=10)
+    flat_field[~vignette_mask] = flat_field[near_vignette_mask].mean()
+    flat_field = ndimage.gaussian_filter(flat_field.astype(numpy.float32), 15, mode='nearest')
+    flat_field = flat_field[::2, ::2]
+    flat_field = ndimage.median_filter(flat_field, footprint=calibrate._circular_mask(9))
+    flat_field = ndimage.zoom(flat_field, 2)
+    flat_field = ndimage.gaussian_filter(flat_field, 5)
+    mean_intensity = flat_field[vignette_mask].mean()
+    flat_field /= mean_intensity
+    flat_field[flat_field <= 0] = 1
+    flat_field = 1 / flat_field
+    flat_field[~vignette_mask] = 0
+    return flat_field, mean_intensity
+
+def synthetic_image(shape=(2560, 2160)):
+    xs, ys = numpy.indices(shape, dtype=numpy.float32)
+    cx, cy = shape[0] / 2, shape[1] / 2
+    r2 = ((xs - cx)**2 + (ys - cy)**2) / (min(shape) / 2)**2
+    image = 20000 * (1 - 0.3 * r2) + 0.05 * (xs - cx)
+    image[r2 > 1.3] = 100 # vignetted corners
+    image += numpy.random.normal(0, 50, size=shape)
+    return image.clip(0, 65535)
+
+def time_function(function, repeats):
+    t0 = time.perf_counter()
+    for i in range(repeats):
+        result = function()
+    return result, (time.perf_counter() - t0) / repeats
+
+def benchmark(image, repeats, downsamples):
+    print('Estimating flat-field from {}x{} image'.format(*image.shape))
+    vignette_mask, elapsed = time_function(lambda: calibrate.get_vignette_mask(image), repeats)
+    print('\tvignette mask: {:.0f} ms'.format(elapsed * 1000))
+    reused_mask, elapsed = time_function(lambda: calibrate.get_vignette_mask(image, vignette_mask), repeats)
+    print('\tvignette mask, reusing previous: {:.0f} ms'.format(elapsed * 1000))
+    (expected, expected_mean), elapsed = time_function(lambda: original_flat_field(image, vignette_mask), repeats)
+    print('\toriginal flat-field: {:.0f} ms'.format(elapsed * 1000))
+    interior = ndimage.binary_erosion(vignette_mask, iterations=20)
+    for downsample in downsamples:
+        (flat_field, mean), elapsed = time_function(lambda: calibrate.get_flat_field(image, vignette_mask,
+            downsample=downsample), repeats)
+        error = numpy.abs(flat_field[interior] / expected[interior] - 1).max()
+        print('\tdownsampled {}x: {:.0f} ms, max relative difference {:.4f}, mean intensity difference {:.4f}'.format(
+            downsample, elapsed * 1000, error, mean / expected_mean - 1))
+
+parser = argparse.ArgumentParser('flat_field_benchmark.py')
+parser.add_argument('image', nargs='?')
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--downsample', type=int, nargs='+', default=[2, 4, 8])
+args = parser.parse_args()
+image = synthetic_image() if args.image is None else freeimage.read(args.image).astype(numpy.float32)
+benchmark(image, args.repeats, args.downsample)
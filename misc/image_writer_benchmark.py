@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Benchmark the threaded_image_io image writers: write speed (MB/s of raw
+# pixel data), read-back speed and compression ratio for each writer, on
+# representative frames from an experiment (e.g. a brightfield and a
+# fluorescence image), so that IMAGE_COMPRESSION can be chosen per image type.
+#
+#   image_writer_benchmark.py 'exp/pos1/2016-01-01t1200 bf.png' 'exp/pos1/2016-01-01t1200 gfp.png' --repeats 5
+#
+# With no images, a synthetic noisy 16-bit frame is used. Writers whose
+# libraries are not installed are skipped.
+#
+# To compare ThreadedIO against ProcessIO throughput for a given writer with
+# several workers, writing batches of images as a timecourse acquisition does:
+#   image_writer_benchmark.py --pool-workers 1 2 4 8 --pool-writer 'PNG zlib 6 (default)'
+#
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy
+
+from scope.util import threaded_image_io
+
+COMPRESSION = threaded_image_io.COMPRESSION
+
+WRITERS = [
+    ('PNG zlib 6 (default)', COMPRESSION.DEFAULT, '.png'),
+    ('PNG zlib 1', COMPRESSION.PNG_FAST, '.png'),
+    ('PNG uncompressed', COMPRESSION.PNG_NONE, '.png'),
+    ('TIFF LZW (default)', COMPRESSION.DEFAULT, '.tiff'),
+    ('TIFF uncompressed', COMPRESSION.TIFF_NONE, '.tiff'),
+    ('TIFF deflate 1', COMPRESSION.TIFF_DEFLATE_FAST, '.tiff'),
+    ('TIFF zstd 1', COMPRESSION.TIFF_ZSTD, '.tiff'),
+    ('blosc lz4', COMPRESSION.BLOSC_LZ4, '.blosc'),
+    ('blosc zstd', COMPRESSION.BLOSC_ZSTD, '.blosc'),
+]
+
+def synthetic_image(shape=(2560, 2160)):
+    xs, ys = numpy.indices(shape)
+    background = 2000 + 1000 * numpy.cos(xs / shape[0] * numpy.pi) * numpy.cos(ys / shape[1] * numpy.pi)
+    return numpy.random.poisson(background).astype(numpy.uint16)
+
+def benchmark(name, image, repeats, temp_dir):
+    mb = image.nbytes / 1e6
+    print('{} ({}x{} {}, {:.1f} MB)'.format(name, image.shape[0], image.shape[1], image.dtype, mb))
+    for writer_name, compression, suffix in WRITERS:
+        writer = threaded_image_io.get_writer(compression)
+        path = temp_dir / ('benchmark' + suffix)
+        try:
+            writer.write(image, path)
+        except ImportError as e:
+            print('\t{}: skipped ({})'.format(writer_name, e))
+            continue
+        t0 = time.perf_counter()
+        for i in range(repeats):
+            writer.write(image, path)
+        write_time = (time.perf_counter() - t0) / repeats
+        t0 = time.perf_counter()
+        for i in range(repeats):
+            read_back = threaded_image_io.read_image(path)
+        read_time = (time.perf_counter() - t0) / repeats
+        assert (read_back == image).all()
+        ratio = image.nbytes / os.path.getsize(str(path))
+        print('\t{}: write {:.0f} MB/s, read {:.0f} MB/s, compression ratio {:.2f}'.format(
+            writer_name, mb / write_time, mb / read_time, ratio))
+        os.unlink(str(path))
+
+def benchmark_pools(images, writer_name, worker_counts, batches, temp_dir):
+    compression, suffix = {name: (compression, suffix) for name, compression, suffix in WRITERS}[writer_name]
+    mb = sum(image.nbytes for image in images) * batches / 1e6
+    print('Writing {} batches of {} images ({:.0f} MB) with {}'.format(batches, len(images), mb, writer_name))
+    for workers in worker_counts:
+        for pool_name, image_io in [('threads', threaded_image_io.ThreadedIO(workers)),
+                ('processes', threaded_image_io.ProcessIO(workers))]:
+            t0 = time.perf_counter()
+            for batch in range(batches):
+                paths = [temp_dir / '{}_{}{}'.format(batch, i, suffix) for i in range(len(images))]
+                if pool_name == 'processes':
+                    image_io.write_async(images, paths, compression)
+                else:
+                    image_io.write(images, paths, compression)
+            if pool_name == 'processes':
+                image_io.wait()
+            elapsed = time.perf_counter() - t0
+            print('\t{} {}: {:.0f} MB/s'.format(workers, pool_name, mb / elapsed))
+            if pool_name == 'processes':
+                image_io.shutdown()
+
+parser = argparse.ArgumentParser('image_writer_benchmark.py')
+parser.add_argument('images', nargs='*')
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--pool-workers', type=int, nargs='*')
+parser.add_argument('--pool-writer', default='PNG zlib 6 (default)')
+parser.add_argument('--pool-batches', type=int, default=10)
+args = parser.parse_args()
+with tempfile.TemporaryDirectory() as temp_dir:
+    if args.images:
+        images = [threaded_image_io.read_image(image_path) for image_path in args.images]
+        names = args.images
+    else:
+        images = [synthetic_image()]
+        names = ['synthetic image']
+    if args.pool_workers:
+        benchmark_pools(images, args.pool_writer, args.pool_workers, args.pool_batches, pathlib.Path(temp_dir))
+    else:
+        for name, image in zip(names, images):
+            benchmark(name, image, args.repeats, pathlib.Path(temp_dir))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# Benchmark parsing of Leica stand messages on the path the server actually
+# uses: messaging.serial_io.TerminatorParser, fed by the SerialIOLoop with
+# whatever each os.read() returns.
+#
+# Record a stream from the stand (while clicking around in the Leica software,
+# moving the stage by hand, etc.):
+#   serial_io_benchmark.py record /dev/ttyScope leica_events.bin --seconds 60
+# Time the parser alone on a recorded (or, with no file, a synthetic) stream,
+# fed in chunks of various sizes, against the previous find-per-message parser:
+#   serial_io_benchmark.py parse [leica_events.bin] --chunk-sizes 64 4096 65536
+# Time the full path, replaying the stream through a pseudo-terminal to a
+# serial_io channel whose message callback counts the messages:
+#   serial_io_benchmark.py replay [leica_events.bin] --repeats 20
+#
+import argparse
+import os
+import pty
+import random
+import threading
+import time
+import tty
+
+from scope.messaging import serial_io
+from scope.util import smart_serial
+
+class OriginalTerminatorParser:
+    def __init__(self, terminator):
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self._scan_start = 0
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        start = 0
+        while True:
+            end = self.buffer.find(self.terminator, self._scan_start)
+            if end == -1:
+                break
+            messages.append(bytes(self.buffer[start:end]))
+            start = self._scan_start = end + len(self.terminator)
+        if start:
+            del self.buffer[:start]
+        self._scan_start = max(0, len(self.buffer) - len(self.terminator) + 1)
+        return messages
+
+def synthetic_stream(message_count):
+    """Return bytes resembling stand auto-events: '<FU><cmd> <params>\r'"""
+    messages = []
+    for i in range(message_count):
+        function_unit = random.choice([70, 71, 72, 73, 78, 79, 81, 83, 84, 94])
+        command = random.randint(0, 99)
+        params = ' '.join(str(random.randint(-200000, 200000)) for _ in range(random.randint(0, 3)))
+        messages.append('{}{:03d} {}\r'.format(function_unit, command, params))
+    return ''.join(messages).encode('ascii')
+
+def load_stream(filename, repeats):
+    if filename is None:
+        stream = synthetic_stream(10000)
+    else:
+        with open(filename, 'rb') as f:
+            stream = f.read()
+    return stream * repeats
+
+def record(port, baud, filename, seconds):
+    serial_port = smart_serial.Serial(port, baudrate=baud, timeout=0.5)
+    end = time.time() + seconds
+    with open(filename, 'wb') as f:
+        while time.time() < end:
+            try:
+                f.write(serial_port.read(1) + serial_port.read_all_buffered())
+            except smart_serial.SerialTimeout:
+                pass
+    print('Recorded {} bytes to {}'.format(os.path.getsize(filename), filename))
+
+def parse(stream, chunk_sizes):
+    message_count = stream.count(b'\r')
+    print('Parsing {} bytes ({} messages)'.format(len(stream), message_count))
+    for chunk_size in chunk_sizes:
+        chunks = [stream[i:i+chunk_size] for i in range(0, len(stream), chunk_size)]
+        for name, parser_class in [('original', OriginalTerminatorParser), ('current', serial_io.TerminatorParser)]:
+            parser = parser_class(b'\r')
+            t0 = time.perf_counter()
+            received = sum(len(parser.feed(chunk)) for chunk in chunks)
+            elapsed = time.perf_counter() - t0
+            assert received == message_count
+            print('\t{}-byte chunks, {} parser: {:.0f} messages/s, {:.1f} MB/s'.format(chunk_size, name,
+                received / elapsed, len(stream) / elapsed / 1e6))
+
+def _write_stream(fd, stream, chunk_size):
+    for i in range(0, len(stream), chunk_size):
+        os.write(fd, stream[i:i+chunk_size])
+
+def replay(stream, chunk_size):
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    serial_port = smart_serial.Serial(os.ttyname(slave), timeout=5)
+    message_count = stream.count(b'\r')
+    print('Replaying {} bytes ({} messages) in {}-byte chunks'.format(len(stream), message_count, chunk_size))
+    received = []
+    done = threading.Event()
+    def message_callback(message):
+        received.append(None)
+        if len(received) == message_count:
+            done.set()
+    io_loop = serial_io.get_io_loop()
+    io_loop.add_channel(serial_port, serial_io.TerminatorParser(b'\r'), message_callback, name='benchmark')
+    writer = threading.Thread(target=_write_stream, args=(master, stream, chunk_size), daemon=True)
+    t0 = time.perf_counter()
+    writer.start()
+    done.wait()
+    elapsed = time.perf_counter() - t0
+    print('\t{:.0f} messages/s, {:.2f} MB/s'.format(message_count / elapsed, len(stream) / elapsed / 1e6))
+
+parser = argparse.ArgumentParser('serial_io_benchmark.py')
+subparsers = parser.add_subparsers(dest='mode')
+record_parser = subparsers.add_parser('record')
+record_parser.add_argument('port')
+record_parser.add_argument('filename')
+record_parser.add_argument('--baud', type=int, default=115200)
+record_parser.add_argument('--seconds', type=float, default=60)
+parse_parser = subparsers.add_parser('parse')
+parse_parser.add_argument('filename', nargs='?')
+parse_parser.add_argument('--repeats', type=int, default=10)
+parse_parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[64, 4096, 65536])
+replay_parser = subparsers.add_parser('replay')
+replay_parser.add_argument('filename', nargs='?')
+replay_parser.add_argument('--repeats', type=int, default=10)
+replay_parser.add_argument('--chunk-size', type=int, default=4096)
+args = parser.parse_args()
+
+if args.mode == 'record':
+    record(args.port, args.baud, args.filename, args.seconds)
+elif args.mode == 'parse':
+    parse(load_stream(args.filename, args.repeats), args.chunk_sizes)
+elif args.mode == 'replay':
+    replay(load_stream(args.filename, args.repeats), args.chunk_size)
+else:
+    parser.print_help()
@@ -0,0 +1,29 @@
+import argparse
+import pathlib
+import sys
+
+from ..util import metadata_index
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='add existing timecourse experiments to a metadata index')
+    parser.add_argument('index', help='SQLite index file to add to (created if necessary)')
+    parser.add_argument('experiments', nargs='+', help='experiment directories (containing experiment_metadata.json)')
+    args = parser.parse_args(argv)
+    index = metadata_index.MetadataIndex(args.index)
+    failed = False
+    for experiment in args.experiments:
+        if not (pathlib.Path(experiment) / 'experiment_metadata.json').exists():
+            sys.stderr.write('{}: no experiment_metadata.json; skipping\n'.format(experiment))
+            failed = True
+            continue
+        try:
+            metadata_index.index_experiment(index, experiment)
+            print('Indexed {}'.format(experiment))
+        except Exception as e:
+            sys.stderr.write('{}: {}\n'.format(experiment, e))
+            failed = True
+    index.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -30,7 +30,10 @@ def autofocus(scope, z_start, z_max, coarse_range_mm, coarse_steps, fine_range_m
         z_start: position to start autofocus from
         z_max: absolute max z-position to try (if going too high might crash the
             objective)
-        coarse_range_mm: range to try to focus on, in mm around z_start
+        coarse_range_mm: range to try to focus on, in mm around z_start. If
+            None, skip the coarse autofocus and do only the fine autofocus
+            around z_start (useful if z_start is already known to be close
+            to the focal plane).
         coarse_steps: how many focus steps to take over the coarse range
         fine_range_mm: range to try to focus on, in mm around the optimal coarse
             focal point
@@ -45,8 +48,11 @@ def autofocus(scope, z_start, z_max, coarse_range_mm, coarse_steps, fine_range_m
     """
     exposure_time = scope.camera.exposure_time
     with scope.tl.lamp.in_state(enabled=True), scope.stage.in_state(z_speed=1):
-        coarse_result = _autofocus(scope, z_start, z_max, coarse_range_mm, coarse_steps, speed=0.8,
-            binning='4x4', exposure_time=exposure_time/16, return_images=return_images)
+        if coarse_range_mm is None:
+            coarse_result = (z_start, []) if return_images else z_start
+        else:
+            coarse_result = _autofocus(scope, z_start, z_max, coarse_range_mm, coarse_steps, speed=0.8,
+                binning='4x4', exposure_time=exposure_time/16, return_images=return_images)
         if return_images:
             coarse_z = coarse_result[0]
         else:
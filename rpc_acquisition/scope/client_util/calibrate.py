@@ -22,18 +22,141 @@
 #
 # Authors: Zach Pincus
 
+import hashlib
+import json
+import pathlib
 import time
 import numpy
 from scipy import ndimage
 from zplib.scalar_stats import mcd
 
+from ..util import image_correction
+from ..util import metadata_journal
+
 def image_order_statistic(image, k):
     return numpy.partition(image, k, axis=None)[k]
 
+def acquire_dark_images(scope, exposures, frames_to_average=5):
+    """Acquire dark-current images (with all shutters closed and lamps off)
+    at each of the given exposure times, averaging frames_to_average frames
+    for each. Returns a list of images."""
+    dark_images = []
+    with scope.il.in_state(shutter_open=False), \
+         scope.tl.in_state(shutter_open=False), \
+         scope.tl.lamp.in_state(enabled=False):
+        if hasattr(scope.il, 'spectra_x'):
+            scope.il.spectra_x.push_state(**{lamp+'_enabled':False for lamp in
+                scope.il.spectra_x.lamp_specs.keys()})
+        for exp in exposures:
+            # average the frames on the server so only one image per exposure is transferred
+            dark_images.append(scope.camera.acquire_reduced(frames_to_average, 'mean',
+                trigger_mode='Software', exposure_time=exp))
+        if hasattr(scope.il, 'spectra_x'):
+            scope.il.spectra_x.pop_state()
+    return dark_images
+
+class DarkCurrentLibrary:
+    """Persistent store of dark-current images, so that they need only be
+    re-acquired when they have gone out of date or the camera configuration
+    has changed.
+
+    Dark currents depend on the camera readout rate, gain, shutter mode, binning
+    and AOI, and on the sensor temperature. Images are stored by exposure time
+    under a key made from these parameters (with the temperature rounded to a
+    band of temperature_band degrees). Images older than max_age_hours are
+    re-acquired.
+
+    Before stored images are reused, a fresh image is acquired at the longest
+    stored exposure (where dark current is most evident) and compared with the
+    stored image: if the median difference is more than spot_check_tolerance
+    counts, all the stored images for the configuration are re-acquired.
+    """
+    INDEX_NAME = 'dark_library.json'
+
+    def __init__(self, library_dir, max_age_hours=24, temperature_band=2, spot_check_tolerance=2, read_only=False):
+        """Parameters:
+            library_dir: directory in which to store the images.
+            max_age_hours: age after which stored images are re-acquired.
+            temperature_band: width, in degrees C, of the sensor temperature
+                ranges within which stored images are reused.
+            spot_check_tolerance: largest allowable median difference, in
+                counts, between a fresh dark image and a stored one.
+            read_only: if True, reuse stored images but do not store new ones.
+        """
+        self.library_dir = pathlib.Path(library_dir)
+        self.max_age = max_age_hours * 60**2
+        self.temperature_band = temperature_band
+        self.spot_check_tolerance = spot_check_tolerance
+        self.read_only = read_only
+        self.index_path = self.library_dir / self.INDEX_NAME
+        if self.index_path.exists():
+            with self.index_path.open('r') as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+        # information about the most recent get_dark_images() call, for logging
+        self.reused_count = 0
+        self.acquired_count = 0
+        self.spot_check_difference = None
+
+    def get_configuration_key(self, camera):
+        """Return a string describing the camera parameters that the dark current
+        depends on."""
+        temperature = camera.sensor_temperature
+        band = int(numpy.floor(temperature / self.temperature_band)) * self.temperature_band
+        aoi = camera.aoi
+        return '{}, {}, {} shutter, {} binning, AOI {},{} {}x{}, {}-{} C'.format(camera.readout_rate,
+            camera.sensor_gain, camera.shutter_mode, camera.binning, aoi['aoi_left'], aoi['aoi_top'],
+            aoi['aoi_width'], aoi['aoi_height'], band, band + self.temperature_band)
+
+    def get_dark_images(self, scope, exposures, frames_to_average=5):
+        """Return a list of dark-current images for the given exposures in the
+        current camera configuration, reusing valid stored images and acquiring
+        (and storing) the rest."""
+        config_key = self.get_configuration_key(scope.camera)
+        config_entries = self.entries.setdefault(config_key, {})
+        now = time.time()
+        dark_images = []
+        for exposure in exposures:
+            entry = config_entries.get('{:g}'.format(exposure))
+            if entry is not None and now - entry['timestamp'] <= self.max_age:
+                dark_images.append(numpy.load(str(self.library_dir / entry['file'])))
+            else:
+                dark_images.append(None)
+        stored = [i for i, image in enumerate(dark_images) if image is not None]
+        self.spot_check_difference = None
+        new_images = {}
+        if stored:
+            i = stored[-1]
+            check_image = acquire_dark_images(scope, [exposures[i]], frames_to_average)[0]
+            self.spot_check_difference = float(numpy.median(check_image - dark_images[i]))
+            if abs(self.spot_check_difference) > self.spot_check_tolerance:
+                dark_images = [None] * len(exposures)
+            dark_images[i] = new_images[i] = check_image
+        stale = [i for i, image in enumerate(dark_images) if image is None]
+        if stale:
+            for i, image in zip(stale, acquire_dark_images(scope, [exposures[i] for i in stale], frames_to_average)):
+                dark_images[i] = new_images[i] = image
+        # the spot-check image is newly acquired (and used in place of the stored one)
+        self.acquired_count = len(new_images)
+        self.reused_count = len(exposures) - len(new_images)
+        if not self.read_only:
+            temperature = scope.camera.sensor_temperature
+            key_hash = hashlib.sha1(config_key.encode('utf8')).hexdigest()[:12]
+            if not self.library_dir.exists():
+                self.library_dir.mkdir(parents=True)
+            for i, image in new_images.items():
+                exposure_key = '{:g}'.format(exposures[i])
+                filename = '{} {}ms.npy'.format(key_hash, exposure_key)
+                numpy.save(str(self.library_dir / filename), numpy.asarray(image, dtype=numpy.float32))
+                config_entries[exposure_key] = dict(file=filename, timestamp=now, temperature=temperature)
+            metadata_journal.write_json_atomic(self.index_path, self.entries)
+        return dark_images
+
 class DarkCurrentCorrector:
     """Class that acquires dark-current images and corrects newly-acquired images
     for the dark currents."""
-    def __init__(self, scope, min_exposure_ms=0.5, max_exposure_ms=1000, frames_to_average=5):
+    def __init__(self, scope, min_exposure_ms=0.5, max_exposure_ms=1000, frames_to_average=5, library=None, num_threads=4):
         """Collect dark-current images across a range of exposures.
 
         NB: generally the dark-current images will only be valid for images
@@ -45,28 +168,26 @@ class DarkCurrentCorrector:
                 within this range can be corrected for their dark currents.
             frames_to_average: the given number of frames will be collected for
                 each exposure step, reducing per-pixel noise effects.
+            library: if not None, a DarkCurrentLibrary from which still-valid
+                dark images will be reused, rather than acquiring all of them.
+            num_threads: number of threads to split each correction across.
         """
         self.exposures = numpy.logspace(numpy.log10(min_exposure_ms), numpy.log10(max_exposure_ms), 10, base=10)
-        self.dark_images = []
-        with scope.il.in_state(shutter_open=False), \
-             scope.tl.in_state(shutter_open=False), \
-             scope.tl.lamp.in_state(enabled=False):
-            if hasattr(scope.il, 'spectra_x'):
-                scope.il.spectra_x.push_state(**{lamp+'_enabled':False for lamp in
-                    scope.il.spectra_x.lamp_specs.keys()})
-            scope.camera.start_image_sequence_acquisition(frame_count=len(self.exposures)*frames_to_average, trigger_mode='Software')
-            for exp in self.exposures:
-                images = []
-                for i in range(frames_to_average):
-                    scope.camera.send_software_trigger()
-                    images.append(scope.camera.next_image(max(1000, 2*exp)))
-                self.dark_images.append(numpy.mean(images, axis=0))
-            scope.camera.end_image_sequence_acquisition()
-            if hasattr(scope.il, 'spectra_x'):
-                scope.il.spectra_x.pop_state()
-
-    def correct(self, image, exposure_ms):
-        """Correct a given image for the dark-currents.
+        if library is None:
+            self.dark_images = acquire_dark_images(scope, self.exposures, frames_to_average)
+        else:
+            self.dark_images = library.get_dark_images(scope, self.exposures, frames_to_average)
+        self.num_threads = num_threads
+        self._image_corrector = None # created on first use
+
+    def _get_image_corrector(self):
+        if self._image_corrector is None:
+            self._image_corrector = image_correction.ImageCorrector(self.exposures, self.dark_images, self.num_threads)
+        return self._image_corrector
+
+    def correct(self, image, exposure_ms, flat_field=None, out=None):
+        """Correct a given image for the dark-currents, and optionally multiply
+        the result by a flat-field image.
 
         Parameters:
             image: newly-acquired image from the camera
@@ -74,24 +195,52 @@ class DarkCurrentCorrector:
                 full length of time that the camera was exposing, even if the
                 lights were on only for a portion of that duration (as with
                 the acquisition_sequencer.)
+            flat_field: None, or a flat-field image (see get_flat_field()).
+            out: output array. If None, a new array is allocated; pass image
+                itself to correct in place.
 
         Returns: corrected image.
         """
-        if exposure_ms < self.exposures[0] or exposure_ms > self.exposures[-1]:
-            raise ValueError('Exposure time is outside of the calibration range')
-        i = numpy.searchsorted(self.exposures, exposure_ms)
-        if exposure_ms == self.exposures[i]:
-            dark_image = self.dark_images[i]
-        else:
-            before_exp, after_exp = self.exposures[i-1], self.exposures[i]
-            before_img, after_img = self.dark_images[i-1], self.dark_images[i]
-            a = (exposure_ms - before_exp) / (after_exp - before_exp)
-            dark_image = (1-a) * before_img + a * after_img
-            dark_image.round()
-            dark_image = dark_image.astype(numpy.uint16)
-        int_image = image.astype(numpy.int32) - dark_image
-        int_image[int_image < 0] = 0
-        return int_image.astype(numpy.uint16)
+        return self._get_image_corrector().correct(image, exposure_ms, flat_field, out)
+
+    def get_dark_image(self, exposure_ms):
+        """Return the dark-current image for a given exposure time, interpolated
+        from the dark images acquired at the calibration exposures. The most
+        recently used interpolated images are cached, and must not be modified.
+
+        Parameters:
+            exposure_ms: the full exposure time, as for correct().
+
+        Returns: uint16 dark-current image.
+        """
+        return self._get_image_corrector().get_dark_image(exposure_ms)
+
+def enable_server_image_correction(scope, dark_corrector, flat_fields=None):
+    """Send dark-current (and optionally flat-field) calibration images to the
+    scope server, so that images from the acquisition sequencer are corrected
+    on the server as they are read from the camera. The images returned by
+    scope.camera.acquisition_sequencer.run() will then not need to be passed
+    through dark_corrector.correct().
+
+    The correction persists until
+    scope.camera.acquisition_sequencer.disable_image_correction() is called,
+    which should be done as soon as the calibrations may no longer be valid
+    (e.g. at the end of a timecourse timepoint).
+
+    Parameters:
+        scope: scope client object
+        dark_corrector: DarkCurrentCorrector instance
+        flat_fields: None, or a list with one entry for each step of the
+            acquisition sequence: either a flat-field image to multiply the
+            dark-corrected image by, or None for no flat-field correction.
+    """
+    dark_image_names = [scope._put_data(image) for image in dark_corrector.dark_images]
+    flat_field_names = None
+    if flat_fields is not None:
+        flat_field_names = [None if flat_field is None else scope._put_data(flat_field.astype(numpy.float32))
+            for flat_field in flat_fields]
+    scope.camera.acquisition_sequencer.enable_image_correction(dark_corrector.exposures.tolist(),
+        dark_image_names, flat_field_names)
 
 def meter_exposure_and_intensity(scope, lamp, max_exposure=200, max_intensity=255,
     min_intensity_fraction=0.3, max_intensity_fraction=0.75):
@@ -215,18 +364,27 @@ def meter_exposure(scope, lamp, max_exposure=200, min_intensity_fraction=0.3,
     scope.camera.exposure_time = good_exposure
     return good_exposure
 
-def get_vignette_mask(image):
+def get_vignette_mask(image, previous_mask=None, max_changed_fraction=0.001):
     """Convert a well-exposed image (ideally a brightfield image with ~uniform
     intensity) into a mask delimiting the image region from the dark,
     vignetted borders of the image.
 
+    If previous_mask (e.g. the mask from the previous timepoint) is provided
+    and differs from the new mask in no more than max_changed_fraction of the
+    pixels, previous_mask is returned, and the (slow) hole-filling is skipped.
+
     Returns: vignette_mask, which is True in the image regions.
 
     """
-    likely_vignette_pixels = image[image < numpy.percentile(image, 40)]
+    # the threshold statistics are calculated from a subsample of the pixels, for speed
+    sample = image[::4, ::4]
+    likely_vignette_pixels = sample[sample < numpy.percentile(sample, 40)]
     mean, std = mcd.robust_mean_std(likely_vignette_pixels, 0.5)
     vignette_threshold = mean + 150 * std
     vignette_mask = image > vignette_threshold
+    if previous_mask is not None and previous_mask.shape == image.shape:
+        if numpy.count_nonzero(vignette_mask != previous_mask) <= max_changed_fraction * image.size:
+            return previous_mask
     vignette_mask = ndimage.binary_fill_holes(vignette_mask)
     return vignette_mask
 
@@ -248,15 +406,16 @@ def get_averaged_images(scope, positions, dark_corrector, frames_to_average=5):
     with scope.stage.in_state(async=False):
         for position in positions:
             scope.stage.position = position
-            scope.camera.start_image_sequence_acquisition(frame_count=frames_to_average,
-                trigger_mode='Internal')
-            images = [scope.camera.next_image() for i in range(frames_to_average)]
-            scope.camera.end_image_sequence_acquisition()
-            images = [dark_corrector.correct(image, exposure_ms) for image in images]
-            position_images.append(numpy.mean(images, axis=0))
+            # average on the server and dark-correct the average: only one image per position is transferred
+            mean_image = scope.camera.acquire_reduced(frames_to_average, 'mean', trigger_mode='Internal')
+            mean_image -= dark_corrector.get_dark_image(exposure_ms)
+            mean_image[mean_image < 0] = 0
+            position_images.append(mean_image)
     return numpy.median(position_images, axis=0)
 
-def get_flat_field(image, vignette_mask):
+FLAT_FIELD_DOWNSAMPLE = 4
+
+def get_flat_field(image, vignette_mask, downsample=FLAT_FIELD_DOWNSAMPLE):
     """Return a flat-field correction image.
 
     This function smooths out an image and corrects for vignetting to produce
@@ -272,6 +431,11 @@ def get_flat_field(image, vignette_mask):
     correction image. This yields an image with approximately the same overall
     mean intensity but corrected for illumination inhomogeneities.
 
+    The smoothing is done on a copy of the image downsampled by the given
+    factor, and the result is interpolated back to full size. As the
+    flat-field is smooth, this is equivalent to smoothing at full resolution,
+    at a fraction of the cost.
+
     NB: Areas of the image that are determined to have been vignetted by the
     vignette_mask parameter will be set to zero in the flat-field image.
 
@@ -279,35 +443,62 @@ def get_flat_field(image, vignette_mask):
         image: input image.
         vignette_mask: image mask that is True for regions that are NOT obscured
            by vignetting (the dark areas around the edge of the image).
+        downsample: factor by which to downsample the image for smoothing.
 
     Returns: flat-field correction image and the mean intensity of the non-
         vignetted image regions (after smoothing), for use as a measure of
         overall illumination intensity.
     """
-    flat_field = numpy.array(image, dtype=float) # make a copy of the image because we modify it in-place
-    near_vignette_mask = vignette_mask ^ ndimage.binary_erosion(vignette_mask, iterations=10)
+    flat_field = _downsample(image, downsample)
+    # only use blocks entirely within the image region
+    small_mask = _downsample(vignette_mask, downsample) == 1
+    erosion_iterations = max(1, int(round(10 / downsample)))
+    near_vignette_mask = small_mask ^ ndimage.binary_erosion(small_mask, iterations=erosion_iterations)
     # set the vignetted region to a value that's the mean value of the pixels
     # nearest, so that when we do image smoothing those dark vignetted values
     # don't muck things up too much.
-    flat_field[~vignette_mask] = flat_field[near_vignette_mask].mean()
-    flat_field = _smooth_flat_field(flat_field)
-    mean_intensity = flat_field[vignette_mask].mean()
+    flat_field[~small_mask] = flat_field[near_vignette_mask].mean()
+    flat_field = _smooth_flat_field(flat_field, downsample)
+    mean_intensity = float(flat_field[small_mask].mean())
     flat_field /= mean_intensity
     flat_field[flat_field <= 0] = 1 # we're going to reciprocate, so prevent div/0 errors
     flat_field = 1 / flat_field # take reciprocal so that the mask can be used multiplicatively
+    flat_field = _upsample(flat_field, image.shape, downsample)
     flat_field[~vignette_mask] = 0
     return flat_field, mean_intensity
 
+def _downsample(image, factor):
+    """Return the float32 mean of each factor-by-factor block of an image
+    (dropping any partial blocks at the far edges)."""
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:height*factor, :width*factor].reshape(height, factor, width, factor)
+    return blocks.mean(axis=(1, 3), dtype=numpy.float32)
+
+def _interpolation_indices(full_size, small_size, factor):
+    # position of each full-size pixel in the coordinates of the block centers
+    coords = numpy.clip((numpy.arange(full_size) + 0.5) / factor - 0.5, 0, small_size - 1)
+    lower = numpy.minimum(coords.astype(int), max(small_size - 2, 0))
+    upper = numpy.minimum(lower + 1, small_size - 1)
+    return lower, upper, (coords - lower).astype(numpy.float32)
+
+def _upsample(image, shape, factor):
+    """Linearly interpolate an image from _downsample() back to the given shape,
+    one axis at a time."""
+    lower, upper, a = _interpolation_indices(shape[0], image.shape[0], factor)
+    a = a[:, numpy.newaxis]
+    image = image[lower] * (1 - a) + image[upper] * a
+    lower, upper, a = _interpolation_indices(shape[1], image.shape[1], factor)
+    return image[:, lower] * (1 - a) + image[:, upper] * a
 
 def _circular_mask(s):
   xs, ys = numpy.indices((s, s)).astype(float) / (s-1)
   return (xs**2 + ys**2) <= 1
 
-_m9 = _circular_mask(9)
-
-def _smooth_flat_field(image):
-    image = ndimage.gaussian_filter(image.astype(numpy.float32), 15, mode='nearest')
-    image = image[::2, ::2]
-    image = ndimage.median_filter(image, footprint=_m9)
-    image = ndimage.zoom(image, 2)
-    return ndimage.gaussian_filter(image, 5)
+def _smooth_flat_field(image, factor):
+    """Smooth an image that was downsampled by the given factor. The filter
+    sizes are those of a full-resolution sigma=15 gaussian, a median filter of
+    18 pixels, and a final sigma=5 gaussian, scaled by the downsampling
+    factor. (Gaussian filtering is separable, and is done one axis at a time.)"""
+    image = ndimage.gaussian_filter(image, 15 / factor, mode='nearest')
+    image = ndimage.median_filter(image, footprint=_circular_mask(max(3, int(round(18 / factor)))))
+    return ndimage.gaussian_filter(image, 5 / factor, mode='nearest')
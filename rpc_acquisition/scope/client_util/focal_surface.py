@@ -0,0 +1,116 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+import numpy
+
+class FocalSurfacePredictor:
+    """Predict the focal plane at each position of a timecourse experiment.
+
+    Focus drift between timepoints (from thermal changes, plate tilt, etc.) is
+    highly correlated across the plate. So the prediction for a position is its
+    focal plane from the previous timepoint, plus the drift measured so far at
+    the current timepoint at the other positions. The drift is modeled as a
+    plane across the stage x-y coordinates if enough positions have been
+    measured, or as a constant offset otherwise. The scatter of the measured
+    drifts around that model gives the uncertainty of each prediction."""
+
+    def __init__(self, positions, min_observations=3):
+        """Parameters:
+            positions: dict mapping position names to (x, y, z) stage positions.
+            min_observations: number of positions that must have been focused
+                at the current timepoint before an uncertainty is estimated.
+                The drift is modeled as a plane only once there are this many
+                more positions than the plane's three parameters.
+        """
+        self.positions = positions
+        self.min_observations = min_observations
+        self.drifts = [] # (x, y, drift) for each position focused this timepoint
+        self.errors = [] # prediction errors for each position focused this timepoint
+
+    def get_base_z(self, position_name, position_metadata):
+        """Return the most recent focal plane for the position, and whether
+        that came from a previous autofocus (rather than the configured
+        position)."""
+        for metadata in reversed(position_metadata):
+            if metadata.get('fine_z') is not None:
+                return metadata['fine_z'], True
+        return self.positions[position_name][2], False
+
+    def predict(self, position_name, position_metadata):
+        """Return (predicted_z, uncertainty) for the given position. The
+        uncertainty is the standard deviation of the predicted z, or None if
+        too few observations are available to estimate it."""
+        base_z, from_autofocus = self.get_base_z(position_name, position_metadata)
+        drift, uncertainty = self._predict_drift(*self.positions[position_name][:2])
+        if not from_autofocus:
+            # the configured z positions are too rough to trust any uncertainty estimate
+            uncertainty = None
+        return base_z + drift, uncertainty
+
+    def _predict_drift(self, x, y):
+        n = len(self.drifts)
+        if n == 0:
+            return 0, None
+        xs, ys, drifts = numpy.transpose(self.drifts)
+        if n >= 3 + self.min_observations:
+            # fit a plane only if there are enough points beyond the three parameters
+            # to estimate the scatter around it reasonably well
+            design = numpy.column_stack([numpy.ones(n), xs, ys])
+            coefs, residuals, rank, singular_values = numpy.linalg.lstsq(design, drifts, rcond=None)
+            if rank == 3:
+                prediction = coefs.dot([1, x, y])
+                residuals = drifts - design.dot(coefs)
+                params = 3
+            else:
+                # positions are collinear: can't fit a plane
+                prediction = drifts.mean()
+                residuals = drifts - prediction
+                params = 1
+        else:
+            prediction = drifts.mean()
+            residuals = drifts - prediction
+            params = 1
+        if n < max(self.min_observations, params + 1):
+            return prediction, None
+        uncertainty = numpy.sqrt((residuals**2).sum() / (n - params))
+        return prediction, uncertainty
+
+    def add_observation(self, position_name, position_metadata, predicted_z, focused_z):
+        """Record the focal plane found at a position, to refine future
+        predictions. Returns the prediction error."""
+        base_z, from_autofocus = self.get_base_z(position_name, position_metadata)
+        if from_autofocus:
+            x, y = self.positions[position_name][:2]
+            self.drifts.append((x, y, focused_z - base_z))
+        error = focused_z - predicted_z
+        self.errors.append(error)
+        return error
+
+    def get_rms_error(self):
+        """Return the root-mean-square prediction error for all positions
+        observed so far (or None if there are none)."""
+        if not self.errors:
+            return None
+        return numpy.sqrt(numpy.mean(numpy.square(self.errors)))
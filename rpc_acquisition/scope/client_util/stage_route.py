@@ -0,0 +1,118 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+import math
+
+def axis_move_time(distance, speed, ramp=None):
+    """Return the time in seconds to move a given distance (mm) along one axis
+    with the given maximum speed (mm/s). If an acceleration ramp (mm/s^2) is
+    given, assume a trapezoidal velocity profile; otherwise constant speed."""
+    distance = abs(distance)
+    if ramp is None:
+        return distance / speed
+    ramp_distance = speed**2 / ramp # distance covered speeding up and slowing down
+    if distance < ramp_distance:
+        # never reaches full speed: triangular velocity profile
+        return 2 * math.sqrt(distance / ramp)
+    return distance / speed + speed / ramp
+
+def travel_time(start, end, speeds, ramps=(None, None, None)):
+    """Return the time in seconds for the stage to move from start to end.
+    The axes move simultaneously, so the time is that of the slowest axis.
+    Positions are (x, y) or (x, y, z) tuples; speeds and ramps are per-axis."""
+    return max(axis_move_time(e - s, speed, ramp) for s, e, speed, ramp in zip(start, end, speeds, ramps))
+
+def get_stage_kinetics(scope):
+    """Return ((x_speed, y_speed, z_speed), (x_ramp, y_ramp, z_ramp)) for the
+    stage's current settings. Only the z axis has a configurable ramp; the x
+    and y ramps are returned as None."""
+    stage = scope.stage
+    speeds = stage.get_x_speed(), stage.get_y_speed(), stage.get_z_speed()
+    ramps = None, None, stage.get_z_ramp()
+    return speeds, ramps
+
+def route_time(positions, order, start, speeds, ramps=(None, None, None)):
+    """Return the total time to visit the named positions in the given order,
+    starting from the stage position 'start'."""
+    total = 0
+    current = start
+    for name in order:
+        total += travel_time(current, positions[name], speeds, ramps)
+        current = positions[name]
+    return total
+
+def plan_route(positions, start, speeds, ramps=(None, None, None), max_passes=20):
+    """Order positions to minimize the total stage travel time, starting from
+    the stage position 'start'.
+
+    A greedy nearest-neighbor route is refined by 2-opt (reversing segments of
+    the route) until no reversal shortens it or max_passes is reached. With
+    the ~100 positions of a typical multiwell experiment this takes well under
+    a second.
+
+    Parameters:
+        positions: dict mapping position names to (x, y, z) stage positions.
+        start: (x, y, z) stage position from which the route begins.
+        speeds, ramps: per-axis speeds and ramps (see travel_time()).
+        max_passes: maximum number of 2-opt passes over the route.
+
+    Returns: (order, estimated_time), where order is a list of position names.
+    """
+    names = sorted(positions.keys()) # sort to make ties deterministic
+    if not names:
+        return [], 0
+    def cost(a, b):
+        return travel_time(a, b, speeds, ramps)
+
+    # greedy nearest-neighbor construction
+    remaining = set(names)
+    current = start
+    order = []
+    while remaining:
+        name = min(sorted(remaining), key=lambda n: cost(current, positions[n]))
+        order.append(name)
+        remaining.remove(name)
+        current = positions[name]
+
+    # 2-opt refinement: node 0 is the fixed start; the route is an open path
+    points = [start] + [positions[name] for name in order]
+    n = len(points)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            for j in range(i + 1, n):
+                # reverse points[i:j+1]: edges (i-1, i) and (j, j+1) become (i-1, j) and (i, j+1)
+                before = cost(points[i-1], points[i])
+                after = cost(points[i-1], points[j])
+                if j + 1 < n:
+                    before += cost(points[j], points[j+1])
+                    after += cost(points[i], points[j+1])
+                if after < before - 1e-9:
+                    points[i:j+1] = points[i:j+1][::-1]
+                    order[i-1:j] = order[i-1:j][::-1]
+                    improved = True
+        if not improved:
+            break
+    return order, route_time(positions, order, start, speeds, ramps)
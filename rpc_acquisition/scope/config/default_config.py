@@ -12,7 +12,11 @@ scope_configuration = dict(
     Stand = dict(
         SERIAL_PORT = '/dev/ttyScope',
         SERIAL_BAUD = 115200,
-        INITIALIZE_ALL_OBJECTIVE_LAMP_INTENSITIES_TO_MAXIMUM = True
+        INITIALIZE_ALL_OBJECTIVE_LAMP_INTENSITIES_TO_MAXIMUM = True,
+        # max number of commands per function unit awaiting responses (None for no limit)
+        MAX_COMMANDS_IN_FLIGHT = 4,
+        # seconds to wait for a response before giving up (None to wait forever)
+        RESPONSE_TIMEOUT = 120
     ),
 
     Camera = dict(
@@ -53,6 +57,8 @@ scope_configuration = dict(
 
     Peltier = dict(
         SERIAL_PORT = '/dev/ttyPeltier',
-        SERIAL_BAUD = 2400
+        SERIAL_BAUD = 2400,
+        # connect only when first used, rather than at server startup
+        LAZY_INIT = False
     )
 )
\ No newline at end of file
@@ -0,0 +1,173 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+import queue
+import threading
+
+from ..util import transfer_ism_buffer
+
+class AcquisitionPlan:
+    """Run acquisition sequences at a series of stage positions back to back,
+    entirely on the server.
+
+    Compared to moving the stage and running the acquisition sequencer from a
+    client for each position, this avoids the RPC round trips between
+    positions, and the stage move to each position is started as soon as
+    the last exposure at the previous position has been read out, so that
+    it overlaps with the camera being cleaned up and re-armed. Frames from
+    all positions are delivered through a single stream (see next_frame()).
+
+    The plan runs its sequences with its own AcquisitionSequencer (not
+    camera.acquisition_sequencer), so running a plan does not change the
+    sequence configured on camera.acquisition_sequencer. Server-side image
+    correction (acquisition_sequencer.enable_image_correction()) is therefore
+    not applied to the frames of a plan. A plan cannot be run at the same time
+    as camera.acquisition_sequencer, as they share the camera and IOTool.
+    """
+    def __init__(self, stage, sequencer):
+        """Parameters:
+            stage: the stage device.
+            sequencer: an AcquisitionSequencer for the plan's exclusive use.
+        """
+        self._stage = stage
+        self._sequencer = sequencer
+        self._positions = []
+        self._spectra_x_intensities = {}
+        self._run_thread = None
+
+    def new_plan(self, **spectra_x_intensities):
+        """Start a new, empty acquisition plan.
+
+        Keyword Parameters: intensity values for the Spectra X lamps, as for
+            acquisition_sequencer.new_sequence().
+        """
+        self._positions = []
+        self._spectra_x_intensities = spectra_x_intensities
+
+    def add_position(self, position, steps, focus_offset=0):
+        """Add a position to the plan.
+
+        Parameters:
+            position: (x, y, z) stage position in mm. Any value may be None to
+                indicate no motion along that axis.
+            steps: list of dicts, each containing the keyword arguments to
+                acquisition_sequencer.add_step() for one image acquisition at
+                this position.
+            focus_offset: distance in mm to add to z for this position.
+        """
+        if not steps:
+            raise ValueError('At least one acquisition step is required at each position')
+        x, y, z = position
+        if z is not None:
+            z += focus_offset
+        self._positions.append(((x, y, z), [dict(step) for step in steps]))
+
+    def get_position_count(self):
+        return len(self._positions)
+
+    def start(self):
+        """Start running the plan and return immediately. Retrieve the frames
+        in order with next_frame(), which must be called until it returns None
+        to complete the run (or else abort() must be called)."""
+        if self._run_thread is not None:
+            raise RuntimeError('An acquisition plan is already running')
+        if not self._positions:
+            raise RuntimeError('No positions have been added to the acquisition plan')
+        self._frame_queue = queue.Queue()
+        self._aborted = threading.Event()
+        self._run_thread = threading.Thread(target=self._run, args=(list(self._positions),), daemon=True)
+        self._run_thread.start()
+
+    def _move_to(self, position):
+        # issue the move for all axes at once without waiting for it to finish
+        x, y, z = position
+        self._stage.set_x(x, async=True)
+        self._stage.set_y(y, async=True)
+        self._stage.set_z(z, async=True)
+
+    def _run(self, positions):
+        try:
+            self._move_to(positions[0][0])
+            for position_index, (position, steps) in enumerate(positions):
+                if self._aborted.is_set():
+                    break
+                self._sequencer.new_sequence(**self._spectra_x_intensities)
+                for step in steps:
+                    self._sequencer.add_step(**step)
+                # arm the camera while the stage is still moving
+                self._sequencer._start_run(before_program_start=self._stage.wait)
+                last_position = position_index == len(positions) - 1
+                for name, timestamp, step_index, exposure in iter(self._sequencer.next_frame, None):
+                    self._frame_queue.put((name, timestamp, position_index, step_index, exposure))
+                    if step_index == len(steps) - 1 and not last_position and not self._aborted.is_set():
+                        # all exposures here are done, so start moving while the run is cleaned up
+                        self._move_to(positions[position_index+1][0])
+        except Exception as e:
+            self._frame_queue.put(e)
+        finally:
+            self._frame_queue.put(None)
+
+    def next_frame(self, timeout=None):
+        """Return the next frame of an acquisition plan started with start(),
+        as soon as it has been read out from the camera.
+
+        Parameters:
+            timeout: seconds to wait for the frame; if None, wait until the
+                frame arrives or the acquisition fails.
+
+        Returns: (image_name, camera_timestamp, position_index, step_index,
+            exposure_ms) tuple, or None once all frames have been returned and
+            the plan has finished. exposure_ms is the full exposure time, as
+            for acquisition_sequencer.next_frame().
+        """
+        if self._run_thread is None:
+            raise RuntimeError('No acquisition plan is running')
+        frame = self._frame_queue.get(timeout=timeout)
+        if isinstance(frame, Exception):
+            # wait for the run to be cleaned up before reporting the error
+            self._finish_run()
+            raise frame
+        if frame is None:
+            self._run_thread.join()
+            self._run_thread = None
+        return frame
+
+    def abort(self):
+        """Stop a plan started with start() without retrieving its remaining
+        frames (e.g. if the client stopped partway through): no further positions
+        are started, and once the current position's acquisition ends, any
+        frames not yet retrieved with next_frame() are discarded. Does nothing
+        if no plan is running."""
+        if self._run_thread is not None:
+            self._aborted.set()
+            self._finish_run()
+
+    def _finish_run(self):
+        for frame in iter(self._frame_queue.get, None):
+            if not isinstance(frame, Exception):
+                # the frame will never be transferred: free it
+                transfer_ism_buffer._release_array(frame[0])
+        self._run_thread.join()
+        self._run_thread = None
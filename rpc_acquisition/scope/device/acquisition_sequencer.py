@@ -24,8 +24,13 @@
 
 import time
 import math
+import queue
+import threading
 
 from ..config import scope_configuration
+from ..util import image_correction
+from ..util import state_stack
+from ..util import transfer_ism_buffer
 
 class AcquisitionSequencer:
     def __init__(self, scope):
@@ -39,6 +44,9 @@ class AcquisitionSequencer:
         self._exposures = None
         self._compiled = False
         self._num_acquisitions = 0
+        self._image_corrector = None
+        self._flat_fields = None
+        self._run_thread = None
 
     def new_sequence(self, **spectra_x_intensities):
         """Create a new acquisition sequence of camera exposures with different
@@ -142,26 +150,94 @@ class AcquisitionSequencer:
         if lamp_off_delay:
             self.add_delay_us(lamp_off_delay)
 
+    def enable_image_correction(self, dark_exposures, dark_image_names, flat_field_names=None):
+        """Correct images for dark currents (and optionally flat-field effects)
+        on the server, in place, as they are read out by run(). This setting
+        persists across calls to new_sequence().
+
+        The calibration images must first be sent to the server: see
+        client_util.calibrate.enable_server_image_correction() for a convenient
+        way to do this.
+
+        Parameters:
+            dark_exposures: sorted list of exposure times (in ms) at which the
+                dark-current images were acquired.
+            dark_image_names: names of the uploaded dark-current images, one
+                for each exposure time.
+            flat_field_names: None, or a list with one entry for each step of
+                the acquisition sequence: either the name of an uploaded
+                float32 flat-field image or None for no flat-field correction.
+        """
+        dark_images = [transfer_ism_buffer.server_take_uploaded_array(name) for name in dark_image_names]
+        if flat_field_names is None:
+            flat_fields = None
+        else:
+            flat_fields = [None if name is None else transfer_ism_buffer.server_take_uploaded_array(name)
+                for name in flat_field_names]
+        self.disable_image_correction()
+        self._image_corrector = image_correction.ImageCorrector(dark_exposures, dark_images)
+        self._flat_fields = flat_fields
+
+    def disable_image_correction(self):
+        """Stop correcting images acquired by run()."""
+        if self._image_corrector is not None:
+            self._image_corrector.shutdown()
+        self._image_corrector = None
+        self._flat_fields = None
+
     def _compile(self):
         """Send the acquisition sequence to the IOTool box"""
-        if self._compiled:
-            return
-        assert self._num_acquisitions > 0
-        # send one last trigger to end the final acquisition
-        steps = list(self._steps)
-        steps.append(self._iotool.commands.set_high(self._config.IOTool.CAMERA_PINS['trigger']))
-        steps.append(self._iotool.commands.set_low(self._config.IOTool.CAMERA_PINS['trigger']))
-        self._iotool.store_program(*steps)
-        self._compiled = True
-        self._program = steps
+        if not self._compiled:
+            assert self._num_acquisitions > 0
+            # send one last trigger to end the final acquisition
+            steps = list(self._steps)
+            steps.append(self._iotool.commands.set_high(self._config.IOTool.CAMERA_PINS['trigger']))
+            steps.append(self._iotool.commands.set_low(self._config.IOTool.CAMERA_PINS['trigger']))
+            self._program = steps
+            self._compiled = True
+        # Store the program even if it was compiled before: another program
+        # (e.g. from the acquisition plan's sequencer) may have been stored since.
+        # An unchanged program is not re-sent.
+        self._iotool.store_program(*self._program)
 
     def get_program(self):
         self._compile()
         return self._program
 
     def run(self):
-        """Run the assembled acquisition steps and return the images obtained."""
+        """Run the assembled acquisition steps and return the images obtained.
+        If enable_image_correction() has been called, the images will be
+        corrected for dark currents and flat-field effects."""
+        self.start_run()
+        names = []
+        for name, timestamp, step_index, exposure in iter(self.next_frame, None):
+            names.append(name)
+        return names
+
+    def start_run(self):
+        """Start running the assembled acquisition steps and return immediately.
+
+        Frames are read from the camera (and corrected, if enable_image_correction()
+        has been called) in a background thread as soon as each exposure ends.
+        Retrieve them in order with next_frame(), which must be called until it
+        returns None to complete the run (or else abort_run() must be called)."""
+        self._start_run()
+
+    def _start_run(self, before_program_start=None):
+        """Start the run as in start_run(). If before_program_start is not None,
+        it is called after the camera has been armed but just before the
+        IOTool program (and thus the first exposure) starts. This allows other
+        server-side code to overlap work (e.g. a stage move) with the camera
+        setup."""
         self._compile()
+        if self._flat_fields is None:
+            flat_fields = [None] * self._num_acquisitions
+        else:
+            flat_fields = self._flat_fields
+            if len(flat_fields) != self._num_acquisitions:
+                raise ValueError('The number of flat-field images ({}) does not match the number of acquisition steps ({})'.format(len(flat_fields), self._num_acquisitions))
+        if self._run_thread is not None:
+            raise RuntimeError('An acquisition sequence is already running')
         # state stack: set tl_intensity to current intensity, so that if it gets set
         # as part of the acquisition, it will be returned to the current value. Must set it to
         # the current value here because if it's not set, setting it to something else
@@ -171,18 +247,93 @@ class AcquisitionSequencer:
         self._camera.set_selected_io_pin_inverted(False)
         self._camera.start_image_sequence_acquisition(self._num_acquisitions, trigger_mode='External Exposure',
             overlap_enabled=True, auxiliary_out_source='FireAll')
-        with self._spectra_x.in_state(**self._starting_fl_lamp_state), \
-             self._tl_lamp.in_state(enabled=False, intensity=self._tl_lamp.get_intensity()):
+        with state_stack.transaction(self._spectra_x, self._tl_lamp):
+            self._spectra_x.push_state(**self._starting_fl_lamp_state)
+            self._tl_lamp.push_state(enabled=False, intensity=self._tl_lamp.get_intensity())
+        try:
             readout_ms = self._camera.get_readout_time() # get this after setting the relevant camera modes above
             self._exposures = [exp + readout_ms for exp in self._base_exposures]
+            self._latest_timestamps = []
+            if before_program_start is not None:
+                before_program_start()
             self._iotool.start_program()
-            names, self._latest_timestamps = [], []
-            for exposure in self._exposures:
-                names.append(self._camera.next_image(read_timeout_ms=exposure+1000))
-                self._latest_timestamps.append(self._camera.get_latest_timestamp())
+        except:
+            self._end_run()
+            raise
+        self._frame_queue = queue.Queue()
+        self._run_thread = threading.Thread(target=self._read_frames, args=(flat_fields,), daemon=True)
+        self._run_thread.start()
+
+    def _read_frames(self, flat_fields):
+        try:
+            for step_index, (exposure, flat_field) in enumerate(zip(self._exposures, flat_fields)):
+                name = self._camera.next_image(read_timeout_ms=exposure+1000)
+                timestamp = self._camera.get_latest_timestamp()
+                self._latest_timestamps.append(timestamp)
+                if self._image_corrector is not None:
+                    # correct in place while the camera buffers the next frame
+                    image = transfer_ism_buffer._borrow_array(name)
+                    self._image_corrector.correct(image, exposure, flat_field, out=image)
+                self._frame_queue.put((name, timestamp, step_index, exposure))
             self._output = self._iotool.wait_until_done()
-            self._camera.end_image_sequence_acquisition()
-        return names
+        except Exception as e:
+            self._frame_queue.put(e)
+        finally:
+            try:
+                self._end_run()
+            except Exception as e:
+                self._frame_queue.put(e)
+            self._frame_queue.put(None)
+
+    def _end_run(self):
+        # the camera's state is restored concurrently with the lamps'
+        with state_stack.transaction(self._camera, self._tl_lamp, self._spectra_x):
+            try:
+                self._camera.end_image_sequence_acquisition()
+            finally:
+                self._tl_lamp.pop_state()
+                self._spectra_x.pop_state()
+
+    def next_frame(self, timeout=None):
+        """Return the next frame of an acquisition sequence started with
+        start_run(), as soon as it has been read out from the camera.
+
+        Parameters:
+            timeout: seconds to wait for the frame; if None, wait until the
+                frame arrives or the acquisition fails.
+
+        Returns: (image_name, camera_timestamp, step_index, exposure_ms) tuple,
+            or None once all frames have been returned and the acquisition
+            has finished. exposure_ms is the full exposure time, as returned
+            by get_exposure_times().
+        """
+        if self._run_thread is None:
+            raise RuntimeError('No acquisition sequence is running')
+        frame = self._frame_queue.get(timeout=timeout)
+        if isinstance(frame, Exception):
+            # wait for the run to be cleaned up before reporting the error
+            self._finish_run()
+            raise frame
+        if frame is None:
+            self._run_thread.join()
+            self._run_thread = None
+        return frame
+
+    def abort_run(self):
+        """Finish a run started with start_run() without retrieving its
+        remaining frames (e.g. if the client stopped partway through): wait for
+        the acquisition to end and discard any frames not yet retrieved with
+        next_frame(). Does nothing if no run is in progress."""
+        if self._run_thread is not None:
+            self._finish_run()
+
+    def _finish_run(self):
+        for frame in iter(self._frame_queue.get, None):
+            if not isinstance(frame, Exception):
+                # the frame will never be transferred: free it
+                transfer_ism_buffer._release_array(frame[0])
+        self._run_thread.join()
+        self._run_thread = None
 
     def get_latest_timestamps(self):
         return self._latest_timestamps
@@ -161,6 +161,11 @@ class Camera(property_device.PropertyDevice):
         #('VerticallyCenterAOI', lowlevel.SetBool, False)
     ]
 
+    # If True, use internal triggering (with the frame rate adjusted on the fly)
+    # for live mode whenever the camera is in rolling-shutter mode. Otherwise,
+    # always use software triggering.
+    _LIVE_INTERNAL_TRIGGERING = True
+
     _PROPERTIES_THAT_CAN_CHANGE_FRAME_RATE_RANGE = set([
         'AOITop',
         'AOIHeight',
@@ -425,11 +430,11 @@ class Camera(property_device.PropertyDevice):
         lowlevel.SetFloat('ExposureTime', ms / 1000)
         self._maybe_update_frame_rate_and_range('ExposureTime')
         if self._live_mode:
-            trigger_interval = self._calculate_live_trigger_interval()
-            self._live_trigger.trigger_interval = trigger_interval
-            self._live_reader.set_timeout(trigger_interval)
+            min_trigger_interval = self._calculate_live_trigger_interval()
+            self._live_trigger.set_min_trigger_interval(min_trigger_interval)
+            self._live_reader.set_timeout(min_trigger_interval)
             # ... and clear recent FPS data
-            self._live_reader.latest_intervals.clear()
+            self._live_reader.reset_statistics()
 
     def get_exposure_time_range(self):
         """Return current exposure time minimum and maximum values in ms"""
@@ -554,38 +559,56 @@ class Camera(property_device.PropertyDevice):
         self._update_property('frame_number', self._frame_number)
 
     def _enable_live(self):
-        """Turn on live-imaging mode. The basic strategy is to put the camera
-        into software triggering mode with continuous cycling and then have a
-        thread that simply executes a software trigger at the maximum possible
-        rate given how fast the camera can operate (as determined by the logic
-        in _calculate_live_trigger_interval()). A single buffer is created and
+        """Turn on live-imaging mode. Where possible (i.e. in rolling-shutter
+        mode), the camera is put into internal triggering mode with continuous
+        cycling and overlap enabled, so that the camera hardware paces the
+        frames itself. Otherwise, the camera is put into software triggering
+        mode, and a thread executes software triggers at the fastest rate that
+        the camera and the host can sustain. A single buffer is created and
         repeatedly queued and waited on by a separate thread, which exists to
         copy the result out to the output array via convert_buffer() as fast as
         possible. Note that tight coupling between the trigger and the reader
         threads is not required, as the camera has some RAM in which images
         that have been acquired can be buffered before getting read out to the
-        computer via the Andor queue / wait commands."""
+        computer via the Andor queue / wait commands.
+
+        In either case, the frame rate is continuously adjusted based on how far
+        the reader thread is lagging behind the camera (see LiveRateController),
+        starting from the theoretical maximum rate as determined by the logic in
+        _calculate_live_trigger_interval()."""
         if self._live_mode:
             return
         lowlevel.Flush()
-        self.push_state(cycle_mode='Continuous', trigger_mode='Software', readout_rate='280 MHz')
-        trigger_interval = self._calculate_live_trigger_interval()
+        internal_triggering = self._LIVE_INTERNAL_TRIGGERING and self.get_shutter_mode() == 'Rolling'
+        if internal_triggering:
+            self.push_state(cycle_mode='Continuous', trigger_mode='Internal', overlap_enabled=True, readout_rate='280 MHz')
+        else:
+            self.push_state(cycle_mode='Continuous', trigger_mode='Software', readout_rate='280 MHz')
+        min_trigger_interval = self._calculate_live_trigger_interval()
         namebase = 'live@-'+str(time.time())
         buffer_maker = BufferFactory(namebase, frame_count=1, cycle=True)
         self._live_mode = True
+        timestamp_hz = lowlevel.GetInt('TimestampClockFrequency')
+        if internal_triggering:
+            lowlevel.SetFloat('FrameRate', 1/(min_trigger_interval * LiveRateController.START_MARGIN))
         lowlevel.Command('AcquisitionStart')
         def update():
-            self._update_image_data(*buffer_maker.convert_buffer())
-        self._live_reader = LiveReader(buffer_maker.queue_buffer, update, trigger_interval)
-        self._live_trigger = LiveTrigger(trigger_interval, self._live_reader)
+            name, array, timestamp = buffer_maker.convert_buffer()
+            self._update_image_data(name, array, timestamp)
+            return timestamp
+        self._live_reader = LiveReader(buffer_maker.queue_buffer, update, min_trigger_interval, timestamp_hz)
+        if internal_triggering:
+            self._live_trigger = LiveFrameRateController(min_trigger_interval, self._live_reader)
+        else:
+            self._live_trigger = LiveTrigger(min_trigger_interval, self._live_reader)
 
     def _calculate_live_trigger_interval(self):
-        """Determine how long to wait between sending acquisition triggers in
-        live mode, based on data from the andor API.
+        """Determine the shortest possible interval between frames in live mode,
+        based on data from the andor API. The live-mode controller threads will
+        not trigger frames any faster than this.
         Returns trigger interval in seconds."""
         sustainable_rate = min(self.get_frame_rate(), self.get_max_interface_fps())
-        trigger_interval = 1/sustainable_rate * 1.05
-        return trigger_interval
+        return 1/sustainable_rate
 
     def _disable_live(self):
         if not self._live_mode:
@@ -602,6 +625,8 @@ class Camera(property_device.PropertyDevice):
         self.pop_state()
 
     def get_live_fps(self):
+        """Return the frame rate actually achieved in live mode, as measured
+        from the most recent frames read out from the camera."""
         if not self._live_mode:
             return
         if not self._live_reader.latest_intervals:
@@ -609,6 +634,21 @@ class Camera(property_device.PropertyDevice):
             return 0
         return 1/numpy.mean(self._live_reader.latest_intervals)
 
+    def get_live_target_fps(self):
+        """Return the frame rate that the live-mode controller is currently
+        aiming for, which backs off from the theoretical rate when the computer
+        can't keep up with the camera."""
+        if not self._live_mode:
+            return
+        return 1/self._live_trigger.trigger_interval
+
+    def get_live_theoretical_fps(self):
+        """Return the maximum frame rate that the camera could achieve in live
+        mode, given its current settings."""
+        if not self._live_mode:
+            return
+        return 1/self._live_trigger.min_trigger_interval
+
     def acquire_image(self, **camera_params):
         """Acquire a single image from the camera, with its current settings.
         NB: This is a SLOW way to acquire multiple images. In that case,
@@ -621,6 +661,65 @@ class Camera(property_device.PropertyDevice):
         self.end_image_sequence_acquisition()
         return name
 
+    _REDUCTION_DTYPES = dict(mean=numpy.float32, median=numpy.float32, sum=numpy.uint32, max=numpy.uint16)
+
+    def acquire_reduced(self, frame_count, reduction='mean', dtype=None, trigger_mode='Internal', **camera_params):
+        """Acquire a number of images and combine them into a single image on
+        the server, so that only the combined image needs to be transferred to
+        the client.
+
+        Parameters
+            frame_count: number of frames to acquire.
+            reduction: how to combine the frames: 'mean', 'median', 'sum', or 'max'.
+            dtype: dtype of the output image. If None, use float32 for 'mean'
+                and 'median', uint32 for 'sum', and uint16 for 'max'. For 'mean',
+                'sum', and 'max', frames are accumulated into the output as they
+                arrive, so the dtype must be able to hold the accumulated values.
+                For 'median', all frames must be retained until the end.
+            trigger_mode: 'Internal' to acquire as fast as possible, or
+                'Software', in which case a software trigger will be sent for
+                each frame.
+            All other keyword arguments will be used to set the camera state (e.g.
+            exposure_time, readout_rate, etc.)
+
+        Returns the name of the combined image; scope_client retrieves the
+        image data itself transparently.
+        """
+        if reduction not in self._REDUCTION_DTYPES:
+            raise ValueError('reduction must be one of: {}'.format(', '.join(sorted(self._REDUCTION_DTYPES))))
+        if dtype is None:
+            dtype = self._REDUCTION_DTYPES[reduction]
+        name = 'reduced@'+str(time.time())
+        self.start_image_sequence_acquisition(frame_count, trigger_mode=trigger_mode, **camera_params)
+        try:
+            read_timeout_ms = self.get_exposure_time() + 1000 # exposure time + 1 second
+            for i in range(frame_count):
+                if trigger_mode == 'Software':
+                    self.send_software_trigger()
+                frame = transfer_ism_buffer._release_array(self.next_image(read_timeout_ms))
+                if i == 0:
+                    output = transfer_ism_buffer.server_create_array(name, shape=frame.shape, dtype=dtype, order='Fortran')
+                    if reduction == 'median':
+                        frames = numpy.empty((frame_count,) + frame.shape, dtype=frame.dtype)
+                    else:
+                        output[:] = frame
+                if reduction == 'median':
+                    frames[i] = frame
+                elif i == 0:
+                    pass
+                elif reduction == 'max':
+                    numpy.maximum(output, frame, out=output, casting='unsafe')
+                else:
+                    numpy.add(output, frame, out=output, casting='unsafe')
+        finally:
+            self.end_image_sequence_acquisition()
+        if reduction == 'median':
+            output[:] = numpy.median(frames, axis=0)
+        elif reduction == 'mean':
+            numpy.divide(output, frame_count, out=output, casting='unsafe')
+        transfer_ism_buffer.server_register_array_for_transfer(name, output)
+        return name
+
     def send_software_trigger(self):
         """Send a software trigger command to the camera to start an acquisition.
         Only valid when used between start_image_sequence_acquisition() and
@@ -697,8 +796,9 @@ class Camera(property_device.PropertyDevice):
         """Stop an image-acquisition sequence and perform necessary cleanup."""
         lowlevel.Command('AcquisitionStop')
         lowlevel.Flush()
-        self.pop_state() # need to pop twice because we pushed twice in start_image_sequence_acquisition() (see above)
-        self.pop_state()
+        with self.state_transaction(): # restore each property once, even if both pushes changed it
+            self.pop_state() # need to pop twice because we pushed twice in start_image_sequence_acquisition() (see above)
+            self.pop_state()
         del self._buffer_maker
 
 
@@ -891,19 +991,71 @@ class LiveModeThread(threading.Thread):
     def loop(self):
         raise NotImplementedError()
 
-class LiveTrigger(LiveModeThread):
-    def __init__(self, trigger_interval, live_reader):
-        self.trigger_interval = trigger_interval
-        self.trigger_count = 0 # number of triggers
+class LiveRateController(LiveModeThread):
+    """Superclass for threads that set the pace of live-mode acquisition.
+
+    The controller starts out by asking for frames slightly slower than the
+    theoretical maximum rate, and then continuously adjusts the interval between
+    frames based on the number of frames that have been acquired by the camera
+    but not yet read out by the LiveReader (the "backlog"). If the backlog grows
+    beyond TARGET_BACKLOG frames, the interval is multiplicatively increased
+    (up to MAX_SLOWDOWN times the fastest interval); otherwise it decays back
+    toward the fastest interval that is sustainable, which is the larger of
+    the camera's theoretical minimum interval and the time the host actually
+    takes to read out and convert a frame. The LiveReader's timeout follows
+    the interval.
+
+    Subclasses must implement loop() and call _adapt() with the current backlog.
+    """
+    START_MARGIN = 1.05 # start out 5% slower than the theoretical max
+    TARGET_BACKLOG = 2 # frames allowed to pile up in camera RAM before backing off
+    BACKOFF = 1.2 # factor to increase the interval by when backlogged
+    SPEEDUP = 0.1 # fraction of the gap to the fastest interval to close each adjustment
+    MAX_SLOWDOWN = 4 # largest interval, as a multiple of the fastest interval
+
+    def __init__(self, min_trigger_interval, live_reader):
         self.live_reader = live_reader
+        self.set_min_trigger_interval(min_trigger_interval)
         super().__init__() # do this last b/c superclass auto-starts the thread on init
 
+    def set_min_trigger_interval(self, min_trigger_interval):
+        """Update the theoretical minimum interval (e.g. after an exposure time
+        change) and restart the rate adaptation from there."""
+        self.min_trigger_interval = min_trigger_interval
+        self.trigger_interval = min_trigger_interval * self.START_MARGIN
+
+    def _adapt(self, backlog):
+        """Adjust trigger_interval given the current backlog, in frames."""
+        fastest_interval = max(self.min_trigger_interval, self.live_reader.get_read_time())
+        old_interval = self.trigger_interval
+        if backlog > self.TARGET_BACKLOG:
+            trigger_interval = old_interval * self.BACKOFF
+        else:
+            trigger_interval = old_interval - (old_interval - fastest_interval) * self.SPEEDUP
+        trigger_interval = min(max(trigger_interval, fastest_interval), fastest_interval * self.MAX_SLOWDOWN)
+        self.trigger_interval = trigger_interval
+        if trigger_interval != old_interval:
+            # otherwise, once the interval had backed off to more than the
+            # timeout, the reader would time out between frames
+            self.live_reader.set_timeout(trigger_interval)
+
+
+class LiveTrigger(LiveRateController):
+    """Send software triggers at the rate determined by LiveRateController."""
+    MAX_BACKLOG = 10
+
+    def __init__(self, min_trigger_interval, live_reader):
+        self.trigger_count = 0 # number of triggers
+        super().__init__(min_trigger_interval, live_reader)
+
     def loop(self):
         """Sleep the prescribed sleep time and then send a software trigger.
         If the triggering gets too far ahead of image reading, stop sending
         triggers until the situation improves."""
         time.sleep(self.trigger_interval)
-        if self.trigger_count - self.live_reader.image_count > 10:
+        backlog = self.trigger_count - self.live_reader.image_count
+        self._adapt(backlog)
+        if backlog > self.MAX_BACKLOG:
             while self.trigger_count - self.live_reader.image_count > 1:
                 # make sure that we break out of the loop if the thread is
                 # asked to stop while we're waiting here:
@@ -914,30 +1066,97 @@ class LiveTrigger(LiveModeThread):
         self.trigger_count += 1
 
 
+class LiveFrameRateController(LiveRateController):
+    """When the camera is triggering itself internally, periodically update
+    the camera's frame rate to the rate determined by LiveRateController.
+
+    The backlog is estimated from the camera timestamps of the frames read out
+    (see LiveReader.get_backlog()), since there is no trigger count to compare
+    the number of frames read against."""
+    ADJUST_INTERVAL = 0.25 # seconds between frame-rate adjustments
+
+    def __init__(self, min_trigger_interval, live_reader):
+        self._frame_rate_writable = True
+        super().__init__(min_trigger_interval, live_reader)
+        self._camera_interval = self.trigger_interval # _enable_live() sets the starting frame rate
+
+    def set_min_trigger_interval(self, min_trigger_interval):
+        super().set_min_trigger_interval(min_trigger_interval)
+        self._camera_interval = None # force the new rate to be sent to the camera
+
+    def loop(self):
+        time.sleep(self.ADJUST_INTERVAL)
+        if not self._frame_rate_writable:
+            return
+        self._adapt(self.live_reader.get_backlog(self.trigger_interval))
+        if (self._camera_interval is not None and
+                abs(self.trigger_interval - self._camera_interval) / self._camera_interval < 0.01):
+            # don't bother the camera with tiny frame-rate changes
+            return
+        try:
+            lowlevel.SetFloat('FrameRate', 1/self.trigger_interval)
+            self._camera_interval = self.trigger_interval
+        except lowlevel.AndorError:
+            # camera doesn't allow frame-rate changes during acquisition: just
+            # keep running at whatever rate it is at now.
+            logger.log_exception('Could not adjust live-mode frame rate:')
+            self._frame_rate_writable = False
+            self.trigger_interval = 1/lowlevel.GetFloat('FrameRate')
+
+
 class LiveReader(LiveModeThread):
-    def __init__(self, queue_buffer, update, trigger_interval):
+    def __init__(self, queue_buffer, update, trigger_interval, timestamp_hz):
         """Repeatedly queue a buffer with the given queue_buffer() function,
         wait for it to be filled via the Andor API, then call
         update() which (presumably) will deal with the buffer
-        contents. The argument image_count is the index of the frame retrieved
+        contents, and which must return the camera timestamp of the frame.
+        The attribute image_count is the number of frames retrieved
         since the start of this round of live imaging.
         NB: update() is called in this background thread, so any operations
         therein must be thread-safe."""
         self.queue_buffer = queue_buffer
         self.update = update
+        self.timestamp_hz = timestamp_hz
         self.latest_intervals = collections.deque(maxlen=10) # cyclic buffer containing intervals between recent image reads (for FPS calculations)
+        self.latest_read_times = collections.deque(maxlen=10) # time spent converting and handling recent frames
+        # lag between camera timestamp and host read time for recent frames. The smallest lag seen
+        # corresponds to an empty camera RAM, so the excess lag over that indicates the backlog.
+        self.latest_lags = collections.deque(maxlen=200)
         self.image_count = 0 # number of frames retrieved
         self.ready = threading.Event()
         self.set_timeout(trigger_interval)
         self.timeout_count = 0
+        self._last_read = None
         super().__init__()
         self.ready.wait() # don't return from init until a buffer is queued
 
     def set_timeout(self, trigger_interval):
         self.timeout = int(1000 * trigger_interval) * 3 # convert to ms and triple for safety margin
 
+    def reset_statistics(self):
+        self.latest_intervals.clear()
+        self.latest_read_times.clear()
+        self.latest_lags.clear()
+        self._last_read = None
+
+    def get_read_time(self):
+        """Return the median time, in seconds, that the host has recently taken
+        to convert and handle a frame after the camera delivered it. Frames can't
+        be read out any faster than this."""
+        if not self.latest_read_times:
+            return 0
+        return numpy.median(self.latest_read_times)
+
+    def get_backlog(self, frame_interval):
+        """Estimate how many frames are waiting in the camera RAM, given the
+        current interval between frames, by comparing recent camera-to-host
+        latencies to the smallest latency seen."""
+        if len(self.latest_lags) < 2:
+            return 0
+        recent_lags = list(itertools.islice(reversed(self.latest_lags), 5))
+        return (numpy.median(recent_lags) - min(self.latest_lags)) / frame_interval
+
     def loop(self):
-        t = time.time()
         self.queue_buffer()
         self.ready.set()
         try:
@@ -956,11 +1175,16 @@ class LiveReader(LiveModeThread):
             if e.args[0] == 'TIMEDOUT':
                 self.timeout_count += 1
                 if self.timeout_count > 10:
-                    raise AndorError('Live image retrieval timing out.')
+                    raise lowlevel.AndorError('Live image retrieval timing out.')
                 return
             else:
                 raise
-        self.update()
+        t = time.time()
+        timestamp = self.update()
         self.image_count += 1
-        self.latest_intervals.append(time.time() - t)
-
+        self.latest_read_times.append(time.time() - t)
+        if timestamp is not None:
+            self.latest_lags.append(t - timestamp / self.timestamp_hz)
+        if self._last_read is not None:
+            self.latest_intervals.append(t - self._last_read)
+        self._last_read = t
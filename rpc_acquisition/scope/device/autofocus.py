@@ -132,6 +132,7 @@ class Autofocus:
         camera_state.update(self._CAMERA_MODE)
         self._camera.push_state(**camera_state)
         self._metric = get_metric(metric, self._camera.get_aoi_shape())
+        self._start_cache_hits = self._stage.get_cache_statistics()['hits']
 
     def _stop_autofocus(self, z_positions):
         self._camera.pop_state()
@@ -140,6 +141,8 @@ class Autofocus:
         del self._metric
         self._stage.set_z(best_z) # go to focal plane with highest score
         self._stage.wait() # no op if in sync mode, necessary in async mode
+        logger.debug('Autofocus avoided {} stage queries by using cached state',
+            self._stage.get_cache_statistics()['hits'] - self._start_cache_hits)
         return best_z, zip(z_positions, z_scores)
 
     def autofocus(self, start, end, steps, metric='high pass + brenner',
@@ -200,7 +203,8 @@ class Autofocus:
             time_required = steps / frame_rate
             speed = self._stage.calculate_required_z_speed(distance, time_required)
         runner = MetricRunner(self._camera, frame_rate, steps, self._metric, return_images)
-        zrecorder = ZRecorder(self._camera, self._stage)
+        zrecorder = ZTrajectoryRecorder(self._camera, self._stage)
+        z_ramp = self._stage.get_z_ramp()
         self._stage.set_z(start) # move to start position at original speed
         self._stage.wait()
         with self._stage.in_state(async=False, z_speed=speed):
@@ -208,8 +212,10 @@ class Autofocus:
             self._camera.start_image_sequence_acquisition(frame_count=steps, trigger_mode='Internal',
               frame_rate=frame_rate, overlap_enabled=overlap)
             runner.start()
+            zrecorder.mark_move_command()
             self._stage.set_z(end)
         zrecorder.stop()
+        zrecorder.fit(start, end, speed, z_ramp)
         image_names, camera_timestamps = runner.join()
         self._camera.end_image_sequence_acquisition()
         if len(camera_timestamps) != steps:
@@ -264,32 +270,113 @@ class MetricRunner(threading.Thread):
             self.exception = e
             
             
-class ZRecorder(threading.Thread):
-    def __init__(self, camera, stage, sleep_time=0.01):
-        super().__init__()
+class ZTrajectoryRecorder:
+    """Reconstruct the stage z trajectory during a continuous move from the
+    position and start/stop events that the stand sends as the stage moves,
+    rather than by polling the stage (which ties up the serial line while the
+    camera is streaming).
+
+    The events are timestamped with time.monotonic() as they arrive, and that
+    clock is correlated with the camera timestamp clock when the recorder is
+    constructed. A trapezoidal motion model (constant-acceleration ramp up,
+    constant speed, ramp down) is then fit to the events to give the z
+    position at any camera timestamp."""
+    def __init__(self, camera, stage):
+        self.camera = camera
         self.stage = stage
-        self.sleep_time = sleep_time
-        self.ts = []
-        self.zs = []
         self.ct_hz = camera.get_timestamp_hz()
+        t_before = time.monotonic()
         self.ct0 = camera.get_current_timestamp()
-        self.t0 = time.time()
+        self.t0 = (t_before + time.monotonic()) / 2
+        self.positions = [] # (time, z) pairs
+        self.status_changes = [] # (time, moving) pairs
+        self.move_command_time = None
+
+    def _on_z_event(self, t, z, moving):
+        if z is None:
+            self.status_changes.append((t, moving))
+        else:
+            self.positions.append((t, z))
+
+    def start(self):
+        self.stage._add_z_listener(self._on_z_event)
+
+    def mark_move_command(self):
+        """Call immediately before commanding the stage to move, to provide a
+        fallback estimate of the start of motion."""
+        self.move_command_time = time.monotonic()
 
     def stop(self):
-        self.running = False
-        self.join()
-        self.zs = numpy.array(self.zs)
-        self.ts = numpy.array(self.ts)
-        self.ts -= self.t0
-        self.ts *= self.ct_hz # now ts is in camera-timestamp units
-        self.ts += self.ct0 # now ts has same zero as the camera timestamp
+        self.stage._remove_z_listener(self._on_z_event)
 
-    def interpolate_zs(self, camera_timestamps):
-        return numpy.interp(camera_timestamps, self.ts, self.zs)
+    def fit(self, start, end, speed, ramp):
+        """Fit the motion model for a move from start to end (in mm) with the
+        given z speed (mm/s) and ramp (mm/s^2) settings."""
+        self.start_z = start
+        distance = abs(end - start)
+        if self.positions and self.positions[-1][1] != start:
+            # the last position event is reported when the stage comes to rest
+            distance = abs(self.positions[-1][1] - start)
+        self.direction = 1 if end >= start else -1
+        self.ramp = ramp
+        if distance >= speed**2 / ramp:
+            self.peak_speed = speed
+            self.ramp_time = speed / ramp
+            self.duration = speed / ramp + distance / speed
+        else:
+            # stage never gets up to the full speed
+            self.peak_speed = (distance * ramp)**0.5
+            self.ramp_time = (distance / ramp)**0.5
+            self.duration = 2 * self.ramp_time
+        self.distance = distance
+
+        move_start = move_stop = None
+        for t, moving in self.status_changes:
+            if moving and move_start is None:
+                move_start = t
+            elif not moving and move_start is not None:
+                move_stop = t
+                break
+        # allow the actual movement to take longer or shorter than the model predicts
+        if move_start is not None and move_stop is not None and self.duration > 0:
+            self.time_scale = (move_stop - move_start) / self.duration
+        else:
+            self.time_scale = 1
+        # intermediate position events give the most precise estimates of when the move began
+        offsets = []
+        for t, z in self.positions:
+            traveled = abs(z - start)
+            if 0 < traveled < distance:
+                offsets.append(t - self.time_scale * self._model_time(traveled))
+        if offsets:
+            self.move_start = numpy.median(offsets)
+        elif move_start is not None:
+            self.move_start = move_start
+        else:
+            self.move_start = self.move_command_time
+        logger.debug('Z trajectory fit from {} position and {} status events: time scale {:.3f}',
+            len(self.positions), len(self.status_changes), self.time_scale)
+
+    def _model_distance(self, model_t):
+        model_t = numpy.clip(model_t, 0, self.duration)
+        ramp_distance = 0.5 * self.ramp * self.ramp_time**2
+        return numpy.where(model_t < self.ramp_time,
+            0.5 * self.ramp * model_t**2,
+            numpy.where(model_t < self.duration - self.ramp_time,
+                ramp_distance + self.peak_speed * (model_t - self.ramp_time),
+                self.distance - 0.5 * self.ramp * (self.duration - model_t)**2))
+
+    def _model_time(self, traveled):
+        ramp_distance = 0.5 * self.ramp * self.ramp_time**2
+        if traveled < ramp_distance:
+            return (2 * traveled / self.ramp)**0.5
+        elif traveled < self.distance - ramp_distance:
+            return self.ramp_time + (traveled - ramp_distance) / self.peak_speed
+        else:
+            return self.duration - (2 * (self.distance - traveled) / self.ramp)**0.5
 
-    def run(self):
-        self.running = True
-        while self.running:
-            self.zs.append(self.stage.get_z())
-            self.ts.append(time.time())
-            time.sleep(self.sleep_time)
+    def interpolate_zs(self, camera_timestamps):
+        """Return the modeled z position at each of the given camera timestamps."""
+        ts = (numpy.asarray(camera_timestamps, dtype=float) - self.ct0) / self.ct_hz + self.t0
+        model_t = (ts - self.move_start) / self.time_scale
+        return self.start_z + self.direction * self._model_distance(model_t)
@@ -24,6 +24,7 @@
 
 import time
 import os
+import hashlib
 
 from . import commands
 from ...util import smart_serial
@@ -38,6 +39,7 @@ class IOTool:
     microscope hardware."""
     def __init__(self):
         self._config = scope_configuration.get_config()
+        self._program_hash = None
         try:
             self.reset()
         except (smart_serial.SerialTimeout, RuntimeError):
@@ -49,6 +51,7 @@ class IOTool:
         """Attempt to reset the IOTool device to a known-good state."""
         if hasattr(self, '_serial_port'):
             del self._serial_port
+        self._program_hash = None # rebooting clears the stored program
         self._serial_port = smart_serial.Serial(self._config.IOTool.SERIAL_PORT, timeout=2)
         self._serial_port.write(b'!\nreset\n')
         time.sleep(0.5) # give it time to reboot
@@ -67,6 +70,8 @@ class IOTool:
 
     def execute(self, *commands):
         """Run a series of commands on the IOTool microcontroller."""
+        if 'program' in commands:
+            self._program_hash = None # stored program is being changed behind store_program's back
         self._assert_empty_buffer()
         responses = []
         for command in commands:
@@ -86,12 +91,26 @@ class IOTool:
 
     def store_program(self, *commands):
         """Send a list of commands to IOTool to run as a program, but do not
-        run the program yet."""
+        run the program yet.
+
+        If the identical program is already stored on the device, it is not
+        re-sent. Otherwise the program is sent in a single write, and the
+        per-line responses are then checked for errors."""
+        program_hash = hashlib.sha1('\n'.join(commands).encode('ascii')).digest()
+        if program_hash == self._program_hash:
+            return
+        self._program_hash = None # if storing fails, the device program is in an unknown state
         all_commands = ['program'] + list(commands) + ['end']
-        responses = self.execute(*all_commands)
-        errors = ['{}: {}'.format(command, response) for command, response in zip(all_commands, responses) if response is not None]
+        self._assert_empty_buffer()
+        # Program lines are only stored, not executed, so there is no need to
+        # wait for each prompt before sending the next line.
+        self._serial_port.write(''.join(command+'\n' for command in all_commands).encode('ascii'))
+        responses = [self.wait_until_done() for command in all_commands]
+        self._assert_empty_buffer()
+        errors = ['{}: {}'.format(command, response) for command, response in zip(all_commands, responses) if response]
         if errors:
             raise RuntimeError('Program errors:\n'+'\n'.join(errors))
+        self._program_hash = program_hash
 
     def start_program(self, *commands, iters=1):
         """Run a program a given number of times. If no commands are given here,
@@ -22,6 +22,8 @@
 #
 # Authors: Zach Pincus, Erik Hvatum
 
+import time
+
 from . import stand
 
 GET_CONVERSION_FACTOR_X = 72034
@@ -94,6 +96,8 @@ Z_MOVE_FUDGE_FACTOR = 0.056
 
 class Stage(stand.LeicaComponent):
     def _setup_device(self):
+        self._z_listeners = []
+        self._moving = dict(x=False, y=False, z=False)
         self._x_mm_per_count = float(self.send_message(GET_CONVERSION_FACTOR_X, async=False).response) / 1000
         self._y_mm_per_count = float(self.send_message(GET_CONVERSION_FACTOR_Y, async=False).response) / 1000
         self._z_mm_per_count = float(self.send_message(GET_CONVERSION_FACTOR_Z, async=False).response) / 1000
@@ -194,6 +198,8 @@ class Stage(stand.LeicaComponent):
 
     def _set_pos(self, value, conversion_factor, command, async):
         if value is None: return
+        # the new position will be cached when the stand reports it in a position event
+        self._invalidate_cache({POS_ABS_X:'x', POS_ABS_Y:'y', POS_ABS_Z:'z'}[command])
         counts = int(round(value / conversion_factor))
         self.send_message(command, counts, async=async, intent="move stage to position")
 
@@ -226,33 +232,58 @@ class Stage(stand.LeicaComponent):
 
     def get_x(self):
         """Get x-axis position in mm."""
-        return self._get_pos(self._x_mm_per_count, GET_POS_X)
+        return self._cached_get('x', lambda: self._get_pos(self._x_mm_per_count, GET_POS_X))
 
     def get_y(self):
         """Get y-axis position in mm."""
-        return self._get_pos(self._y_mm_per_count, GET_POS_Y)
+        return self._cached_get('y', lambda: self._get_pos(self._y_mm_per_count, GET_POS_Y))
 
     def get_z(self):
         """Get z-axis position in mm."""
-        return self._get_pos(self._z_mm_per_count, GET_POS_Z)
+        return self._cached_get('z', lambda: self._get_pos(self._z_mm_per_count, GET_POS_Z))
 
     def _on_pos_x_event(self, event):
         counts = int(event.response)
         mm = counts * self._x_mm_per_count
-        self._update_property('x', mm)
+        self._update_position('x', mm)
 
     def _on_pos_y_event(self, event):
         counts = int(event.response)
         mm = counts * self._y_mm_per_count
-        self._update_property('y', mm)
+        self._update_position('y', mm)
 
     def _on_pos_z_event(self, event):
+        t = time.monotonic()
         counts = int(event.response)
         mm = counts * self._z_mm_per_count
-        self._update_property('z', mm)
+        self._update_position('z', mm)
+        for listener in self._z_listeners:
+            listener(t, mm, None)
+
+    def _update_position(self, axis, mm):
+        self._update_property(axis, mm)
+        if self._moving[axis]:
+            # a position reported mid-move will soon be out of date (and the final
+            # position may be reported only after a synchronous move returns), so
+            # don't answer get_x() etc. from it
+            self._invalidate_cache(axis)
+
+    def _add_z_listener(self, listener):
+        """Call listener(timestamp, z, moving) from the message manager thread
+        whenever the stand reports a new z position (moving is None) or that
+        the z-drive has started or stopped (z is None). The timestamp is the
+        value of time.monotonic() when the event was received. This allows the
+        z trajectory to be followed without polling the stand."""
+        self._z_listeners.append(listener)
+
+    def _remove_z_listener(self, listener):
+        self._z_listeners.remove(listener)
 
     def _on_status_x_event(self, event):
         moving, lh, hh, ls, hs = (bool(int(v)) for v in event.response.split())
+        self._moving['x'] = moving
+        # the position may have changed since it was cached, whether the move is starting or ending
+        self._invalidate_cache('x')
         self._update_property('moving_along_x', moving)
         self._update_property('at_x_low_hard_limit', lh)
         self._update_property('at_x_high_hard_limit', hh)
@@ -261,6 +292,9 @@ class Stage(stand.LeicaComponent):
 
     def _on_status_y_event(self, event):
         moving, lh, hh, ls, hs = (bool(int(v)) for v in event.response.split())
+        self._moving['y'] = moving
+        # the position may have changed since it was cached, whether the move is starting or ending
+        self._invalidate_cache('y')
         self._update_property('moving_along_y', moving)
         self._update_property('at_y_low_hard_limit', lh)
         self._update_property('at_y_high_hard_limit', hh)
@@ -268,7 +302,13 @@ class Stage(stand.LeicaComponent):
         self._update_property('at_y_high_soft_limit', hs)
 
     def _on_status_z_event(self, event):
+        t = time.monotonic()
         moving, lh, hh, ls, hs = (bool(int(v)) for v in event.response.split())
+        self._moving['z'] = moving
+        # the position may have changed since it was cached, whether the move is starting or ending
+        self._invalidate_cache('z')
+        for listener in self._z_listeners:
+            listener(t, None, moving)
         self._update_property('moving_along_z', moving)
         self._update_property('at_z_low_hard_limit', lh)
         self._update_property('at_z_high_hard_limit', hh)
@@ -363,14 +403,17 @@ class Stage(stand.LeicaComponent):
 
     def stop_x(self):
         """Immediately cease movement of the stage along the x axis"""
+        self._invalidate_cache('x')
         self.send_message(BREAK_X, async=False, intent="stop stage movement along x axis")
 
     def stop_y(self):
         """Immediately cease movement of the stage along the y axis"""
+        self._invalidate_cache('y')
         self.send_message(BREAK_Y, async=False, intent="stop stage movement along y axis")
 
     def stop_z(self):
         """Immediately cease movement of the stage along the z axis"""
+        self._invalidate_cache('z')
         self.send_message(BREAK_Z, async=False, intent="stop stage movement along z axis")
 
     def set_x_speed(self, speed):
@@ -379,13 +422,15 @@ class Stage(stand.LeicaComponent):
         assert self._x_speed_min <= speed <= self._x_speed_max
         counts = int(round(speed / self._x_mm_per_count_second))
         self.send_message(SET_SPEED_X, counts, intent="set x auto move speed")
+        self._cache_value('x_speed', counts * self._x_mm_per_count_second) # no events for speed changes, so cache what was set
 
     def set_y_speed(self, speed):
         """Set the speed at which, when commanded to move to a specified position, the stage
         travels along y-axis, in mm/second"""
         assert self._y_speed_min <= speed <= self._y_speed_max
-        counts = int(round(speed / self._x_mm_per_count_second))
+        counts = int(round(speed / self._y_mm_per_count_second))
         self.send_message(SET_SPEED_Y, counts, intent="set y auto move speed")
+        self._cache_value('y_speed', counts * self._y_mm_per_count_second)
 
     def set_z_speed(self, speed):
         """Set the speed at which, when commanded to move to a specified position, the stage
@@ -393,24 +438,25 @@ class Stage(stand.LeicaComponent):
         assert self._z_speed_min <= speed <= self._z_speed_max
         counts = int(round(speed / self._z_mm_per_count / Z_SPEED_MM_PER_SECOND_PER_UNIT))
         self.send_message(SET_SPEED_Z, counts, intent="set z auto move speed")
+        self._cache_value('z_speed', counts * self._z_mm_per_count * Z_SPEED_MM_PER_SECOND_PER_UNIT)
 
     def get_x_speed(self):
         """Get the speed at which, when commanded to move to a specified position, the stage
         moves along x-axis, in mm/second"""
-        counts = int(self.send_message(GET_SPEED_X, async=False, intent="get x auto move speed").response)
-        return counts * self._x_mm_per_count_second
+        return self._cached_get('x_speed', lambda:
+            int(self.send_message(GET_SPEED_X, async=False, intent="get x auto move speed").response) * self._x_mm_per_count_second)
 
     def get_y_speed(self):
         """Get the speed at which, when commanded to move to a specified position, the stage
         moves along y-axis, in mm/second"""
-        counts = int(self.send_message(GET_SPEED_Y, async=False, intent="get y auto move speed").response)
-        return counts * self._y_mm_per_count_second
+        return self._cached_get('y_speed', lambda:
+            int(self.send_message(GET_SPEED_Y, async=False, intent="get y auto move speed").response) * self._y_mm_per_count_second)
 
     def get_z_speed(self):
         """Get the speed at which, when commanded to move to a specified position, the stage
         moves along z-axis, in mm/second"""
-        counts = int(self.send_message(GET_SPEED_Z, async=False, intent="get z auto move speed").response)
-        return counts * self._z_mm_per_count * Z_SPEED_MM_PER_SECOND_PER_UNIT
+        return self._cached_get('z_speed', lambda:
+            int(self.send_message(GET_SPEED_Z, async=False, intent="get z auto move speed").response) * self._z_mm_per_count * Z_SPEED_MM_PER_SECOND_PER_UNIT)
 
     def move_along_x(self, speed):
         """Command stage to move along x-axis at the specified speed, in mm/second"""
@@ -419,6 +465,7 @@ class Stage(stand.LeicaComponent):
             self.stop_x()
         else:
             counts = int(round(speed / self._x_mm_per_count_second))
+            self._invalidate_cache('x')
             self.send_message(POS_CONST_X, counts, intent="set x speed")
 
     def move_along_y(self, speed):
@@ -428,6 +475,7 @@ class Stage(stand.LeicaComponent):
             self.stop_y()
         else:
             counts = int(round(speed / self._y_mm_per_count_second))
+            self._invalidate_cache('y')
             self.send_message(POS_CONST_Y, counts, intent="set y speed")
 
     def move_along_z(self, speed):
@@ -437,6 +485,7 @@ class Stage(stand.LeicaComponent):
             self.stop_z()
         else:
             counts = int(round(speed / self._z_mm_per_count / Z_SPEED_MM_PER_SECOND_PER_UNIT))
+            self._invalidate_cache('z')
             self.send_message(POS_CONST_Z, counts, intent="set z speed")
 
     def get_x_min_speed(self):
@@ -485,14 +534,17 @@ class Stage(stand.LeicaComponent):
 
     def reinit_x(self):
         """Reinitialize x axis to correct for drift or "stuck" stage. Executes synchronously."""
+        self._invalidate_cache('x', 'x_speed')
         self.send_message(INIT_X, async=False, intent="init stage x axis")
 
     def reinit_y(self):
         """Reinitialize y axis to correct for drift or "stuck" stage. Executes synchronously."""
+        self._invalidate_cache('y', 'y_speed')
         self.send_message(INIT_Y, async=False, intent="init stage y axis")
 
     def reinit_z(self):
         """Reinitialize z axis to correct for drift or "stuck" stage. Executes synchronously."""
+        self._invalidate_cache('z', 'z_speed', 'z_ramp')
         self.send_message(INIT_RANGE_Z, async=False, intent="init stage z axis")
 
     def set_xy_fine_manual_control(self, fine):
@@ -502,10 +554,12 @@ class Stage(stand.LeicaComponent):
         self.send_message(SET_Z_STEP_MODE, int(not fine), async=False)
 
     def get_xy_fine_manual_control(self):
-        return not bool(int(self.send_message(GET_XY_STEP_MODE, async=False).response))
+        return self._cached_get('xy_fine_manual_control', lambda:
+            not bool(int(self.send_message(GET_XY_STEP_MODE, async=False).response)))
 
     def get_z_fine_manual_control(self):
-        return not bool(int(self.send_message(GET_Z_STEP_MODE, async=False).response))
+        return self._cached_get('z_fine_manual_control', lambda:
+            not bool(int(self.send_message(GET_Z_STEP_MODE, async=False).response)))
 
     def _on_xy_step_mode_event(self, response):
         self._update_property('xy_fine_manual_control', not bool(int(response.response)))
@@ -519,14 +573,15 @@ class Stage(stand.LeicaComponent):
 
     def get_z_ramp(self):
         """Get z-axis ramp in mm/second^2"""
-        counts = int(self.send_message(GET_RAMP_Z, async=False, intent="get z ramp").response)
-        return counts * self._z_mm_per_count * Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT
+        return self._cached_get('z_ramp', lambda:
+            int(self.send_message(GET_RAMP_Z, async=False, intent="get z ramp").response) * self._z_mm_per_count * Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT)
 
     def set_z_ramp(self, ramp):
         """Get z-axis ramp in mm/second^2"""
         assert self._z_ramp_min <= ramp <= self._z_ramp_max
         counts = int(round(ramp / self._z_mm_per_count / Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT))
         self.send_message(SET_RAMP_Z, counts, intent="set z ramp")
+        self._cache_value('z_ramp', counts * self._z_mm_per_count * Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT)
 
     def calculate_z_movement_time(self, distance):
         """Calculate how long it will take the stage to move a given z distance (in mm)
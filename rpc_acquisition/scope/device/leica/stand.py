@@ -23,6 +23,7 @@
 # Authors: Erik Hvatum, Zach Pincus
 
 import contextlib
+import time
 
 from ...messaging import message_device
 from ...util import property_device
@@ -35,12 +36,68 @@ SET_ACT_METHOD = 70029
 SET_STAND_EVENT_SUBSCRIPTIONS = 70003
 
 class LeicaComponent(message_device.LeicaAsyncDevice, property_device.PropertyDevice):
+    # Cached values older than this (in seconds) are not trusted, even if they
+    # have not been explicitly invalidated.
+    _CACHE_MAX_AGE = 30
+
     def __init__(self, message_manager, property_server=None, property_prefix=''):
+        # The cache of device state is kept current by the values that the Leica
+        # auto-events (and this class's own setters) report via _update_property().
+        # Getters that use _cached_get() can then avoid a serial round trip.
+        self._property_cache = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
         # init LeicaAsyncDevice last because that calls the subclasses _setup_device() method, which might need
         # access to the property_server etc.
         property_device.PropertyDevice.__init__(self, property_server, property_prefix)
         message_device.LeicaAsyncDevice.__init__(self, message_manager)
 
+    def _update_property(self, name, value):
+        self._cache_value(name, value)
+        super()._update_property(name, value)
+
+    def _cached_get(self, name, query):
+        """Return the named value from the cache if it is present and fresh,
+        or else call query() to obtain it from the device."""
+        value, timestamp = self._property_cache.get(name, (None, None))
+        if timestamp is not None and time.monotonic() - timestamp <= self._CACHE_MAX_AGE:
+            self._cache_hits += 1
+            return value
+        self._cache_misses += 1
+        value = query()
+        self._cache_value(name, value)
+        return value
+
+    def _cache_value(self, name, value):
+        """Record a known-current value that is not reported by an auto-event
+        (e.g. a setting that only this class can change)."""
+        self._property_cache[name] = value, time.monotonic()
+
+    def _invalidate_cache(self, *names):
+        """Discard cached values that are known to be out of date (e.g. because
+        the device has been commanded to change them)."""
+        for name in names:
+            self._property_cache.pop(name, None)
+
+    def refresh(self):
+        """Discard all cached device state, so that subsequent requests for
+        device state will query the microscope directly."""
+        self._property_cache.clear()
+
+    def get_cache_statistics(self):
+        """Return a dict with the number of requests for device state that
+        were answered from the cache ('hits', i.e. serial round trips avoided)
+        and that required querying the microscope ('misses')."""
+        return dict(hits=self._cache_hits, misses=self._cache_misses)
+
+    def reset_cache_statistics(self):
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def _write_state(self, properties_and_values):
+        super()._write_state(properties_and_values)
+        self.wait() # no-op if not in async, otherwise wait for all setting to be done.
+
     # set async first when pushing, revert async last when popping
     def _get_push_weights(self, state):
         return {'async':-1}
@@ -89,6 +146,15 @@ class Stand(LeicaComponent):
     def get_available_function_unit_IDs(self):
         return self._available_function_unit_IDs
 
+    def get_message_statistics(self):
+        """Return response latency histograms and timeout / unexpected-response
+        counts for each command code sent to the microscope, along with the
+        number of commands in flight and queued for each function unit."""
+        return self._message_manager.get_statistics()
+
+    def reset_message_statistics(self):
+        self._message_manager.reset_statistics()
+
     def _on_method_event(self, response):
         self._update_property('active_microscopy_method', microscopy_method_names.NAMES[int(response.response)])
 
@@ -22,18 +22,19 @@
 #
 # Authors: Zach Pincus
 
-import threading
-import time
-
 from ..util import smart_serial
 from ..util import property_device
 from ..config import scope_configuration
+from ..messaging import serial_io
 
 class Peltier(property_device.PropertyDevice):
     def __init__(self, property_server=None, property_prefix=''):
         super().__init__(property_server, property_prefix)
         config = scope_configuration.get_config()
-        self._serial_port = smart_serial.Serial(config.Peltier.SERIAL_PORT, baudrate=config.Peltier.SERIAL_BAUD, timeout=1)
+        self._serial_port = smart_serial.Serial(config.Peltier.SERIAL_PORT, baudrate=config.Peltier.SERIAL_BAUD)
+        io_loop = serial_io.get_io_loop()
+        self._channel = io_loop.add_channel(self._serial_port, serial_io.TerminatorParser(b'\r'),
+            priority=serial_io.PRIORITY_LOW, name='Peltier')
         try:
             self.get_temperature()
         except smart_serial.SerialTimeout:
@@ -43,30 +44,27 @@ class Peltier(property_device.PropertyDevice):
             self._update_property('temperature', self.get_temperature())
             self._update_property('target_temperature', self.get_target_temperature())
             self._sleep_time = 10
-            self._timer_running = True
-            self._timer_thread = threading.Thread(target=self._timer_update_temp, daemon=True)
-            self._timer_thread.start()
+            io_loop.call_periodically(self._sleep_time, self._poll_temperature)
 
-    def _timer_update_temp(self):
-        while self._timer_running:
-            self._update_property('temperature', self.get_temperature())
-            time.sleep(self._sleep_time)
+    def _poll_temperature(self):
+        # runs in the serial I/O loop thread, so must not wait for the reply
+        future = self._request('a', priority=serial_io.PRIORITY_LOW)
+        future.add_done_callback(self._temperature_polled)
 
-    def _read(self):
-        return self._serial_port.read_until(b'\r')[:-1].decode('ascii')
+    def _temperature_polled(self, future):
+        if future.exception() is None:
+            self._update_property('temperature', float(future.result().decode('ascii')))
 
-    def _write(self, val):
-        self._serial_port.write(val.encode('ascii') + b'\r')
+    def _request(self, val, priority=serial_io.PRIORITY_NORMAL):
+        return self._channel.request(val.encode('ascii') + b'\r', priority, timeout=1)
 
     def _call_response(self, val):
-        self._write(val)
-        return self._read()
+        return self._request(val).result().decode('ascii')
 
     def _call(self, val, param=''):
         if param:
             val = val + ' ' + param
-        self._write(val)
-        if not self._read().endswith('OK'):
+        if not self._call_response(val).endswith('OK'):
             raise RuntimeError('Invalid command to incubator.')
 
     def get_temperature(self):
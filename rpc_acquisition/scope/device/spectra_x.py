@@ -22,13 +22,11 @@
 #
 # Authors: Zach Pincus
 
-import threading
-import time
-
 from ..util import smart_serial
 from ..util import property_device
 from ..util import state_stack
 from ..config import scope_configuration
+from ..messaging import serial_io
 
 def _make_dac_bytes(IIC_Addr, bit):
     dac_bytes = bytearray(b'\x53\x00\x03\x00\x00\x00\x50')
@@ -75,16 +73,29 @@ class Lamp(state_stack.StateStackDevice):
     def get_enabled(self):
         return self._spectra_x._lamp_enableds[self._name]
 
+    def _get_hardware_key(self):
+        return self._spectra_x._get_hardware_key()
+
 class SpectraX(property_device.PropertyDevice):
+    # Note that we do not filter out identical states from being pushed.
+    # Since the enabled state can be fiddled with IOTool, there is good reason
+    # for pushing an enabled state identical to the current one, so that it
+    # will be restored after any such fiddling.
+    _filter_unchanged_pushes = False
+
     def __init__(self, iotool, property_server=None, property_prefix=''):
         super().__init__(property_server, property_prefix)
         config = scope_configuration.get_config()
-        self._serial_port = smart_serial.Serial(config.SpectraX.SERIAL_PORT, baudrate=config.SpectraX.SERIAL_BAUD, timeout=1)
+        self._serial_port = smart_serial.Serial(config.SpectraX.SERIAL_PORT, baudrate=config.SpectraX.SERIAL_BAUD)
+        io_loop = serial_io.get_io_loop()
+        # the only replies from the Spectra X are two-byte temperature readings
+        self._channel = io_loop.add_channel(self._serial_port, serial_io.FixedLengthParser(2),
+            priority=serial_io.PRIORITY_NORMAL, name='SpectraX')
         # RS232 Lumencor docs state: "The [following] two commands MUST be issued after every power cycle to properly configure controls for further commands."
         # "Set GPIO0-3 as open drain output"
-        self._serial_port.write(b'\x57\x02\xFF\x50')
+        self._channel.write(b'\x57\x02\xFF\x50')
         # "Set GPI05-7 push-pull out, GPIO4 open drain out"
-        self._serial_port.write(b'\x57\x03\xAB\x50')
+        self._channel.write(b'\x57\x03\xAB\x50')
         # test if we can connect:
         try:
             self.get_temperature()
@@ -95,9 +106,7 @@ class SpectraX(property_device.PropertyDevice):
         if property_server:
             self._update_property('temperature', self.get_temperature())
             self._sleep_time = 10
-            self._timer_running = True
-            self._timer_thread = threading.Thread(target=self._timer_update_temp, daemon=True)
-            self._timer_thread.start()
+            io_loop.call_periodically(self._sleep_time, self._poll_temperature)
 
         self._lamp_intensities = {}
         self._lamp_enableds = {}
@@ -106,10 +115,21 @@ class SpectraX(property_device.PropertyDevice):
         for name in LAMP_NAMES:
             setattr(self, name, Lamp(name, self))
 
-    def _timer_update_temp(self):
-        while self._timer_running:
-            self._update_property('temperature', self.get_temperature())
-            time.sleep(self._sleep_time)
+    def _poll_temperature(self):
+        # runs in the serial I/O loop thread, so must not wait for the reply
+        future = self._request_temperature(serial_io.PRIORITY_LOW)
+        future.add_done_callback(self._temperature_polled)
+
+    def _temperature_polled(self, future):
+        if future.exception() is None:
+            self._update_property('temperature', self._decode_temperature(future.result()))
+
+    def _request_temperature(self, priority=serial_io.PRIORITY_NORMAL):
+        return self._channel.request(b'\x53\x91\x02\x50', priority, timeout=1)
+
+    @staticmethod
+    def _decode_temperature(r):
+        return ((r[0] << 3) | (r[1] >> 5)) * 0.125
 
     def _lamp_intensity(self, lamp, value):
         assert 0 <= value <= 255
@@ -120,7 +140,7 @@ class SpectraX(property_device.PropertyDevice):
         dac_bytes = LAMP_DAC_COMMANDS[lamp]
         dac_bytes[4] = intensity_bytes >> 8
         dac_bytes[5] = intensity_bytes & 0x00FF
-        self._serial_port.write(bytes(dac_bytes))
+        self._channel.write(bytes(dac_bytes))
         self._lamp_intensities[lamp] = value
         self._update_property(lamp+'.intensity', value)
 
@@ -136,17 +156,27 @@ class SpectraX(property_device.PropertyDevice):
         return LAMP_SPECS
 
     def get_temperature(self):
-        self._serial_port.write(b'\x53\x91\x02\x50')
-        r = self._serial_port.read(2)
-        return ((r[0] << 3) | (r[1] >> 5)) * 0.125
+        return self._decode_temperature(self._request_temperature().result())
 
-    def _set_state(self, properties_and_values):
+    def _write_state(self, properties_and_values):
         for lamp_prop, value in properties_and_values:
             lamp, prop = self._get_lamp_and_prop(lamp_prop)
             if prop == 'intensity':
                 self._lamp_intensity(lamp, value)
             else:
                 self._lamp_enable(lamp, value)
+            self._state_writes += 1
+
+    def _read_state_value(self, lamp_prop):
+        lamp, prop = self._get_lamp_and_prop(lamp_prop)
+        if prop == 'intensity':
+            return self._lamp_intensities[lamp]
+        else:
+            return self._lamp_enableds[lamp]
+
+    def _get_hardware_key(self):
+        # lamps are enabled and disabled via the IOTool
+        return self._iotool
 
     def lamps(self, **lamp_parameters):
         """Set a number of lamp parameters at once using keyword arguments, e.g.
@@ -155,7 +185,7 @@ class SpectraX(property_device.PropertyDevice):
         Intensity values must be in the range [0, 255]. Valid lamp names can be
         retrieved with get_lamp_specs().
         """
-        self._set_state(lamp_parameters.items())
+        self._write_state(lamp_parameters.items())
 
     def _get_lamp_and_prop(self, lamp_prop):
         """Split a 'lamp_property' style string into a lamp and property value,
@@ -172,16 +202,4 @@ class SpectraX(property_device.PropertyDevice):
         saving the old values of those parameters. (See lamps() for a description
         of valid parameters.) pop_state() will restore those previous values.
         push_state/pop_state pairs can be nested arbitrarily."""
-        # Also note that we do not filter out identical states from being pushed.
-        # Since the enabled state can be fiddled with IOTool, there is good reason
-        # for pushing an enabled state identical to the current one, so that it
-        # will be restored after any such fiddling.
-        old_state = {}
-        for lamp_prop in lamp_parameters.keys():
-            lamp, prop = self._get_lamp_and_prop(lamp_prop)
-            if prop == 'intensity':
-                old_state[lamp_prop] = self._lamp_intensities[lamp]
-            else:
-                old_state[lamp_prop] = self._lamp_enableds[lamp]
-        self._set_state(lamp_parameters.items())
-        self._state_stack.append(old_state)
+        super().push_state(**lamp_parameters)
@@ -25,6 +25,12 @@
 from ..util import property_device
 
 class TL_Lamp_Base(property_device.PropertyDevice):
+    # superclass prevents pushing a state identical to the current one.
+    # But for TL_Lamp, this is useful in case something is going to use
+    # IOTool to change the intensity behind the scenes and thus wants to
+    # push the current intensity/enabled state onto the stack.
+    _filter_unchanged_pushes = False
+
     def __init__(self, iotool, property_server=None, property_prefix=''):
         super().__init__(property_server, property_prefix)
         self._iotool = iotool
@@ -40,12 +46,8 @@ class TL_Lamp_Base(property_device.PropertyDevice):
     def get_enabled(self):
         return self._enabled
 
-    def _update_push_states(self, state, old_state):
-        # superclass prevents pushing a state identical to the current one.
-        # But for TL_Lamp, this is useful in case something is going to use
-        # IOTool to change the intensity behind the scenes and thus wants to
-        # push the current intensity/enabled state onto the stack.
-        pass
+    def _get_hardware_key(self):
+        return self._iotool
 
 
 class SutterLED_Lamp(TL_Lamp_Base):
@@ -28,6 +28,9 @@ import collections
 from ..util import logging
 logger = logging.get_logger(__name__)
 
+class ResponseTimeout(RuntimeError):
+    pass
+
 class Response:
     """A container for a value to be provided by a background thread at some
     point in the future.
@@ -39,7 +42,7 @@ class Response:
     Foreground Thread:
     res = Response()
     bg_thread.send(res) # pass the Response to the background thread somehow
-    value = res.wait()
+    value = res.wait() # or res.wait(timeout) to raise ResponseTimeout if no value arrives in time
 
     Background Thread:
     res = receive() # receive the response.
@@ -53,8 +56,9 @@ class Response:
         self.response = response
         self.ready.set()
 
-    def wait(self):
-        self.ready.wait()
+    def wait(self, timeout=None):
+        if not self.ready.wait(timeout):
+            raise ResponseTimeout('No response received within {} seconds.'.format(timeout))
         return self.response
 
 class AsyncDevice:
@@ -68,10 +72,18 @@ class AsyncDevice:
         self._message_manager = message_manager
 
     def wait(self):
-        """Wait on all pending responses."""
+        """Wait on all pending responses. If the message manager has a
+        response_timeout, raise ResponseTimeout if any response is not received
+        within that time."""
         while self._pending_responses:
             response = self._pending_responses.pop()
-            response.wait()
+            try:
+                response.wait(self._message_manager.response_timeout)
+            except ResponseTimeout:
+                # don't make the next wait() sit through a timeout for each
+                # of the other responses, which are likely also lost
+                self._pending_responses.clear()
+                raise
 
     def has_pending(self):
         """Return true if there are any responses to async messages still pending."""
@@ -118,7 +130,7 @@ class AsyncDevice:
         if async or (async is None and self._async):
             self._pending_responses.add(response)
         else:
-            return response.wait()
+            return response.wait(self._message_manager.response_timeout)
 
     def _generate_response_key(self, message):
         """Subclasses must implement a method to generate the appropriate
@@ -162,7 +174,8 @@ class LeicaResponse(Response):
     error_code: just the error code
     response: everything after the header.
 
-    If an error code was generated, raise a LeicaError on wait(). If constructed
+    If an error code was generated, raise a LeicaError on wait(), or a
+    ResponseTimeout if no response arrives within the timeout. If constructed
     with an 'intent' help text, this will help create a better LeicaError.
     """
     def __init__(self, message, intent=None):
@@ -176,8 +189,15 @@ class LeicaResponse(Response):
             logger.warning('Microscope error. (message to scope: "{}", error response: "{}")', self.message, response.full_response)
         super().__call__(response)
 
-    def wait(self):
-        response = super().wait()
+    def wait(self, timeout=None):
+        try:
+            response = super().wait(timeout)
+        except ResponseTimeout:
+            if self.intent is not None:
+                error_text = 'Could not {}: no response from microscope within {} seconds (message to scope: "{}")'.format(self.intent, timeout, self.message)
+            else:
+                error_text = 'No response from microscope within {} seconds (message to scope: "{}")'.format(timeout, self.message)
+            raise ResponseTimeout(error_text) from None
         if response.error_code != '0':
             if self.intent is not None:
                 error_text = 'Could not {} (message to scope: "{}", error response: "{}")'.format(self.intent, self.message, response.full_response)
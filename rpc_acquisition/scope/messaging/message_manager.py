@@ -22,15 +22,62 @@
 #
 # Authors: Zach Pincus, Erik Hvatum
 
-import threading
+import bisect
 import collections
+import threading
+import time
 
 from ..util import logging
 logger = logging.get_logger(__name__)
 
 from ..util import smart_serial
+from . import serial_io
+
+class CommandStatistics:
+    """Response-latency histogram and error counts for one kind of command."""
+    # upper edges, in seconds, of the latency histogram bins; the final bin
+    # counts everything slower than the last edge.
+    LATENCY_BIN_EDGES = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100]
+
+    def __init__(self):
+        self.responses = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.latency_histogram = [0] * (len(self.LATENCY_BIN_EDGES) + 1)
+        self.timeouts = 0
+        self.unexpected = 0
+
+    def add_latency(self, latency):
+        self.responses += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.latency_histogram[bisect.bisect_left(self.LATENCY_BIN_EDGES, latency)] += 1
+
+    def as_dict(self):
+        return dict(responses=self.responses,
+            mean_latency=self.total_latency / self.responses if self.responses else None,
+            max_latency=self.max_latency, latency_histogram=list(self.latency_histogram),
+            timeouts=self.timeouts, unexpected=self.unexpected)
+
+class _PendingCommand:
+    """Callback wrapper for a command that expects a response, which keeps
+    track of when the command was sent so that the MessageManager can retire
+    it from the in-flight window when the response arrives or the command
+    times out."""
+    def __init__(self, manager, message, queue_key, response_key, callback, coalesce):
+        self.manager = manager
+        self.message = message
+        self.queue_key = queue_key
+        self.response_key = response_key
+        self.callback = callback
+        self.coalesce = coalesce
+        self.sent = None
 
-class MessageManager(threading.Thread):
+    def __call__(self, response):
+        self.manager._retire_command(self)
+        self.callback(response)
+
+class MessageManager:
     """Base class for managing messages and responses sent to/from a
     device that can operate asynchronously and may respond out-of-order.
 
@@ -38,59 +85,65 @@ class MessageManager(threading.Thread):
     indexed by "response keys". When a response is received that matches the key,
     the callback is called.
 
-    Subclasses must implement a method for generating a response key from an
-    incoming response, as well as methods for sending and receiving messages.
-    Message sending is done from a separate thread.
-
-    This class is a thread that starts itself running in the background upon
-    construction, by default in daemonic form so that it will close itself
-    on exit.
+    Messages that expect a response are sent through per-device command
+    queues (see _generate_queue_key()): at most max_in_flight messages from
+    each queue may be awaiting a response at once, and the rest are sent in
+    order as responses arrive. Commands with no response after
+    response_timeout seconds are abandoned (freeing their place in the
+    window) once _expire_commands() is called. Per-response-key latency and
+    error statistics are available from get_statistics().
 
-    To cause the thread to stop running, set the 'running' attribute to False.
+    Subclasses must implement a method for generating a response key from an
+    incoming response, as well as a method for sending messages. Subclasses
+    must arrange for _handle_response() to be called with each incoming
+    response from a background thread.
      """
-    thread_name = 'MessageManager'
-
-    def __init__(self, daemon=True):
+    def __init__(self, max_in_flight=None, response_timeout=None):
+        """Parameters:
+            max_in_flight: maximum number of messages from a given command
+                queue awaiting responses at any time. If None, there is no limit.
+            response_timeout: time in seconds after which commands with no
+                response are considered lost, or None to wait forever."""
         # pending_xxx_responses holds lists of callbacks to call for each response key
         self.pending_grouped_responses = collections.defaultdict(list)
         self.pending_standalone_responses = collections.defaultdict(list)
         self.pending_persistent_responses = collections.defaultdict(list)
         self.latest_callback = None
-        super().__init__(name=self.thread_name, daemon=daemon)
-        self.start()
-
-    def run(self):
-        """Thread target: do not call directly."""
-        self.running = True
-        while self.running: # better than 'while True' because can alter self.running from another thread
-            response = self._receive_message()
-            if response is None:
-                break
-            response_key = self._generate_response_key(response)
-            logger.debug('received response: {} with response key: {}', response, response_key)
-
-            handled = False
-            if response_key in self.pending_grouped_responses:
-                callbacks = self.pending_grouped_responses.pop(response_key)
-                for callback in callbacks:
-                    self._run_callback_safely(callback, response)
-                handled = True
-
-            if response_key in self.pending_standalone_responses:
-                callback, *remaining_callbacks = self.pending_standalone_responses.pop(response_key)
+        self.max_in_flight = max_in_flight
+        self.response_timeout = response_timeout
+        self._lock = threading.Lock()
+        self._command_queues = collections.defaultdict(collections.deque)
+        self._in_flight = collections.defaultdict(list)
+        self._statistics = collections.defaultdict(CommandStatistics)
+
+    def _handle_response(self, response):
+        """Dispatch a response to the appropriate callbacks."""
+        response_key = self._generate_response_key(response)
+        logger.debug('received response: {} with response key: {}', response, response_key)
+
+        handled = False
+        if response_key in self.pending_grouped_responses:
+            callbacks = self.pending_grouped_responses.pop(response_key)
+            for callback in callbacks:
                 self._run_callback_safely(callback, response)
-                if remaining_callbacks:
-                    self.pending_standalone_responses[response] = remaining_callbacks
-                handled = True
+            handled = True
+
+        if response_key in self.pending_standalone_responses:
+            callback, *remaining_callbacks = self.pending_standalone_responses.pop(response_key)
+            self._run_callback_safely(callback, response)
+            if remaining_callbacks:
+                self.pending_standalone_responses[response_key] = remaining_callbacks
+            handled = True
 
-            if response_key in self.pending_persistent_responses:
-                callbacks = self.pending_persistent_responses[response_key]
-                for callback in callbacks:
-                    self._run_callback_safely(callback, response)
-                handled = True
+        if response_key in self.pending_persistent_responses:
+            callbacks = self.pending_persistent_responses[response_key]
+            for callback in callbacks:
+                self._run_callback_safely(callback, response)
+            handled = True
 
-            if not handled:
-                self._handle_unexpected_response(response, response_key)
+        if not handled:
+            self._statistics[response_key].unexpected += 1
+            self._handle_unexpected_response(response, response_key)
 
     def _run_callback_safely(self, callback, response):
         """Catch errors from callbacks and log them. Not much else to do
@@ -110,7 +163,7 @@ class MessageManager(threading.Thread):
 
     def send_message(self, message, response_key=None, response_callback=None, coalesce=True):
         """Send a message from a foreground thread.
-        (I.e. not the thread that the MessageManager is running.)
+        (I.e. not the thread that dispatches responses.)
 
         Arguments
         message: message to send.
@@ -141,61 +194,138 @@ class MessageManager(threading.Thread):
         # locking primitives and just hope for the best.
 
         logger.debug('sending message: {!r} with response key: {!r}', message, response_key)
-        if response_key is not None and response_callback is not None:
-            response_dict = self.pending_grouped_responses if coalesce else self.pending_standalone_responses
-            response_dict[response_key].append(response_callback)
-            self.latest_callback = response_callback
-        self._send_message(message)
+        if response_key is None or response_callback is None:
+            self._send_message(message)
+            return
+        queue_key = self._generate_queue_key(message)
+        command = _PendingCommand(self, message, queue_key, response_key, response_callback, coalesce)
+        with self._lock:
+            self._command_queues[queue_key].append(command)
+            self._send_queued_commands(queue_key)
+
+    def _send_queued_commands(self, queue_key):
+        """Send as many commands from the given queue as the in-flight window
+        allows. Must be called with self._lock held."""
+        queue = self._command_queues[queue_key]
+        in_flight = self._in_flight[queue_key]
+        while queue and (self.max_in_flight is None or len(in_flight) < self.max_in_flight):
+            command = queue.popleft()
+            # Register the response callback only as the message is actually
+            # sent, so that a response to an earlier message can't be mistaken
+            # for the response to one still waiting in the queue.
+            response_dict = self.pending_grouped_responses if command.coalesce else self.pending_standalone_responses
+            response_dict[command.response_key].append(command)
+            self.latest_callback = command
+            command.sent = time.monotonic()
+            in_flight.append(command)
+            self._send_message(command.message)
+
+    def _retire_command(self, command):
+        """Remove a command from the in-flight window upon receipt of its response."""
+        with self._lock:
+            in_flight = self._in_flight[command.queue_key]
+            if command not in in_flight:
+                return # already expired
+            in_flight.remove(command)
+            self._statistics[command.response_key].add_latency(time.monotonic() - command.sent)
+            self._send_queued_commands(command.queue_key)
+
+    def _expire_commands(self):
+        """Abandon any in-flight commands that have gone unanswered for longer
+        than response_timeout. A response that arrives afterward will be
+        treated as unexpected."""
+        if self.response_timeout is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for queue_key, in_flight in list(self._in_flight.items()):
+                expired = [command for command in in_flight if now - command.sent > self.response_timeout]
+                for command in expired:
+                    logger.warn('No response to message {!r} after {} seconds.', command.message, self.response_timeout)
+                    in_flight.remove(command)
+                    self._statistics[command.response_key].timeouts += 1
+                    for response_dict in (self.pending_grouped_responses, self.pending_standalone_responses):
+                        callbacks = response_dict.get(command.response_key)
+                        if callbacks and command in callbacks:
+                            callbacks.remove(command)
+                            if not callbacks:
+                                del response_dict[command.response_key]
+                if expired:
+                    self._send_queued_commands(queue_key)
+
+    def get_statistics(self):
+        """Return a dict describing message traffic:
+            latency_bin_edges: upper edges (in seconds) of the latency histogram
+                bins; the last histogram bin counts slower responses.
+            commands: dict mapping response keys to dicts with the number of
+                responses, mean and max latency, latency histogram, and counts
+                of timeouts and unexpected responses.
+            in_flight, queued: dicts mapping command queue keys to the number
+                of messages awaiting responses and waiting to be sent."""
+        with self._lock:
+            return dict(latency_bin_edges=CommandStatistics.LATENCY_BIN_EDGES,
+                commands={str(key): stats.as_dict() for key, stats in self._statistics.items()},
+                in_flight={str(key): len(in_flight) for key, in_flight in self._in_flight.items()},
+                queued={str(key): len(queue) for key, queue in self._command_queues.items()})
+
+    def reset_statistics(self):
+        with self._lock:
+            self._statistics.clear()
 
     def _send_message(self, message):
         """Send a message to the device from a foreground thread."""
         raise NotImplementedError()
 
-    def _receive_message(self, message):
-        """Block until a message is received. Return None if an error-condition
-        occurs during the read and the run() loop should be terminated."""
-        raise NotImplementedError()
-
     def _generate_response_key(self, response):
         """Generate an appropriate response key from an incoming message."""
         raise NotImplementedError()
 
+    def _generate_queue_key(self, message):
+        """Generate the key for the command queue (and in-flight window) that
+        an outgoing message belongs to. By default all messages share a queue."""
+        return None
+
     def _handle_unexpected_response(self, response, response_key):
         """Handle a response that could not be matched to a response key."""
         logger.debug('received UNPROMPTED response: {} with response key: {}', response, response_key)
 
 class SerialMessageManager(MessageManager):
-    """MessageManager subclass that sends and receives from a serial port."""
-    def __init__(self, serial_port, serial_baud, response_terminator, daemon=True):
+    """MessageManager subclass that sends and receives from a serial port,
+    serviced by the shared serial I/O loop."""
+    def __init__(self, serial_port, serial_baud, response_terminator, priority=serial_io.PRIORITY_HIGH,
+            max_in_flight=None, response_timeout=None):
         """Parameters:
             serial_port, serial_baud: information for connecting to serial device
             response_terminator: byte or bytes that terminate a response message
-            daemon: quit running in the background automatically when the interpreter is exited
-                    (otherwise must set self.running to False to quit)"""
-        # need a timeout on the serial port so that _receive_message can
-        # occasionally check its 'running' attribute to decide if it needs to return.
-        self.serial_port = smart_serial.Serial(serial_port, baudrate=serial_baud, timeout=1)
-        self.thread_name = 'SerialMessageManager({})'.format(self.serial_port.port)
+            priority: priority of this port relative to others in the serial I/O loop
+            max_in_flight, response_timeout: see MessageManager"""
+        self.serial_port = smart_serial.Serial(serial_port, baudrate=serial_baud)
         self.response_terminator = response_terminator
-        super().__init__(daemon)
+        super().__init__(max_in_flight, response_timeout)
+        io_loop = serial_io.get_io_loop()
+        self._channel = io_loop.add_channel(self.serial_port,
+            serial_io.TerminatorParser(response_terminator), self._receive_message, priority)
+        if response_timeout is not None:
+            io_loop.call_periodically(min(1, response_timeout), self._expire_commands)
 
     def _send_message(self, message):
         if type(message) != bytes:
             message = bytes(message, encoding='ascii')
-        self.serial_port.write(message)
+        self._channel.write(message)
 
-    def _receive_message(self):
-        while self.running:
-            try:
-                response = self.serial_port.read_until(self.response_terminator)
-            except smart_serial.SerialTimeout:
-                continue
-            return str(response[:-len(self.response_terminator)], encoding='ascii')
+    def _receive_message(self, message):
+        self._handle_response(str(message, encoding='ascii'))
 
 class LeicaMessageManager(SerialMessageManager):
-    """MessageManager subclass appropriate for routing messages from Leica API"""
-    def __init__(self, serial_port, serial_baud, daemon=True):
-        super().__init__(serial_port, serial_baud, response_terminator=b'\r', daemon=daemon)
+    """MessageManager subclass appropriate for routing messages from Leica API.
+    Each function unit has its own command queue."""
+    def __init__(self, serial_port, serial_baud, max_in_flight=None, response_timeout=None):
+        super().__init__(serial_port, serial_baud, response_terminator=b'\r',
+            max_in_flight=max_in_flight, response_timeout=response_timeout)
+
+    def _generate_queue_key(self, message):
+        # function unit ID
+        return message[:2]
 
     def _generate_response_key(self, response):
         if response[0] == '$':
@@ -0,0 +1,383 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus, Erik Hvatum
+
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import selectors
+import threading
+import time
+from concurrent import futures
+
+from ..util import smart_serial
+from ..util import logging
+logger = logging.get_logger(__name__)
+
+# Priorities for channels and for requests within a channel: lower values are
+# serviced first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class TerminatorParser:
+    """Split a byte stream into messages that end with a given terminator.
+    The terminator is not included in the returned messages."""
+    def __init__(self, terminator):
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self._scan_start = 0
+
+    def feed(self, data):
+        """Add newly-read data and return a list of all complete messages."""
+        self.buffer += data
+        tl = len(self.terminator)
+        last = self.buffer.rfind(self.terminator, self._scan_start)
+        if last == -1:
+            messages = []
+        else:
+            # copy out all the complete messages at once and split them in a single
+            # pass, rather than finding and copying each message separately
+            messages = bytes(self.buffer[:last]).split(self.terminator)
+            del self.buffer[:last+tl]
+        # next time, don't re-scan data already known not to contain a terminator
+        self._scan_start = max(0, len(self.buffer) - tl + 1)
+        return messages
+
+class FixedLengthParser:
+    """Split a byte stream into messages of a fixed number of bytes."""
+    def __init__(self, length):
+        self.length = length
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        count = len(self.buffer) // self.length
+        messages = [bytes(self.buffer[i*self.length:(i+1)*self.length]) for i in range(count)]
+        del self.buffer[:count*self.length]
+        return messages
+
+class LatencyStatistics:
+    """Accumulate request/response latencies and error counts for a port."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.timeouts = 0
+        self.unexpected = 0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def as_dict(self):
+        mean = self.total / self.count if self.count else None
+        return dict(requests=self.count, mean_latency=mean, max_latency=self.max,
+            timeouts=self.timeouts, unexpected=self.unexpected)
+
+class Channel:
+    """A serial port registered with a SerialIOLoop.
+
+    Data can be written without expecting a reply with write(), or sent as a
+    request with request(), which returns a Future for the next message parsed
+    from the port. Requests are sent one at a time, in priority order, each
+    after the reply to the previous one has arrived (or timed out). Messages
+    that arrive when no request is outstanding are passed to the
+    message_callback given when the channel was created.
+
+    All callbacks (including those added to the Futures) are run in the I/O
+    loop thread, so they must not block waiting for other serial traffic.
+    """
+    def __init__(self, io_loop, serial_port, parser, message_callback, priority, name):
+        self.io_loop = io_loop
+        self.serial_port = serial_port
+        self.fd = serial_port.fileno()
+        self.parser = parser
+        self.message_callback = message_callback
+        self.priority = priority
+        self.name = name
+        self.statistics = LatencyStatistics()
+        self._lock = threading.Lock()
+        self._write_buffer = bytearray()
+        self._requests = [] # heap of (priority, sequence number, data, future, timeout)
+        self._in_flight = None # (future, send time, deadline) of the request awaiting a reply
+        self._request_counter = itertools.count()
+        self._events = selectors.EVENT_READ
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def write(self, data):
+        """Write data to the port without waiting for any reply."""
+        with self._lock:
+            self._write_buffer += data
+        self.io_loop.wake()
+
+    def request(self, data, priority=PRIORITY_NORMAL, timeout=None):
+        """Send data to the port and return a Future for the next message
+        received in reply. If timeout (in seconds) is not None, the Future will
+        raise smart_serial.SerialTimeout if no reply has been received that
+        long after the request was sent."""
+        future = futures.Future()
+        with self._lock:
+            heapq.heappush(self._requests, (priority, next(self._request_counter), data, future, timeout))
+        self.io_loop.wake()
+        return future
+
+    def _send_next_request(self):
+        with self._lock:
+            while self._in_flight is None and self._requests:
+                priority, count, data, future, timeout = heapq.heappop(self._requests)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                now = time.monotonic()
+                deadline = None if timeout is None else now + timeout
+                self._in_flight = future, now, deadline
+                self._write_buffer += data
+
+    def _get_deadline(self):
+        in_flight = self._in_flight
+        return None if in_flight is None else in_flight[2]
+
+    def _check_deadline(self, now):
+        if self._in_flight is not None:
+            future, sent, deadline = self._in_flight
+            if deadline is not None and now > deadline:
+                self._in_flight = None
+                self.statistics.timeouts += 1
+                future.set_exception(smart_serial.SerialTimeout('No reply from {} within {:.1f} seconds'.format(self.name, deadline - sent)))
+
+    def _fail_requests(self, exception):
+        with self._lock:
+            requests, self._requests = self._requests, []
+            if self._in_flight is not None:
+                requests.append((None, None, None, self._in_flight[0], None))
+                self._in_flight = None
+        for priority, count, data, future, timeout in requests:
+            if future.running() or future.set_running_or_notify_cancel():
+                future.set_exception(exception)
+
+    def _wants_write(self):
+        return bool(self._write_buffer)
+
+    def _handle_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            logger.error('Error reading from {}: {}', self.name, e)
+            self.io_loop._remove_channel(self)
+            return
+        if not data:
+            # Disconnected devices, at least on Linux, show the behavior that
+            # they are always ready to read immediately but reading returns nothing.
+            logger.error('{} reports readiness to read but returned no data (device disconnected?)', self.name)
+            self.io_loop._remove_channel(self)
+            return
+        for message in self.parser.feed(data):
+            self._handle_message(message)
+
+    def _handle_message(self, message):
+        if self._in_flight is not None:
+            future, sent, deadline = self._in_flight
+            self._in_flight = None
+            self.statistics.add(time.monotonic() - sent)
+            future.set_result(message)
+        elif self.message_callback is not None:
+            try:
+                self.message_callback(message)
+            except:
+                logger.error('Exception in serial message callback for {}: {}', self.name, message, exc_info=True)
+        else:
+            self.statistics.unexpected += 1
+            logger.warn('Unexpected message from {}: {!r}', self.name, message)
+
+    def _handle_writable(self):
+        with self._lock:
+            try:
+                written = os.write(self.fd, self._write_buffer)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                error = e
+            else:
+                del self._write_buffer[:written]
+                return
+            # the unwritten data can never be sent
+            self._write_buffer.clear()
+        # as in _handle_readable(); outside the lock, which _fail_requests() takes
+        logger.error('Error writing to {}: {}', self.name, error)
+        self.io_loop._remove_channel(self)
+
+class SerialIOLoop(threading.Thread):
+    """A single background thread that services all registered serial ports
+    with non-blocking reads and writes, multiplexed with a selector.
+
+    Ready ports are serviced in order of channel priority, so that e.g.
+    stage traffic is never held up behind a temperature poll. Functions can be
+    scheduled to run in the loop thread with call_later() and
+    call_periodically().
+    """
+    def __init__(self):
+        super().__init__(name='SerialIOLoop', daemon=True)
+        self._selector = selectors.DefaultSelector()
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in (self._wake_read, self._wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._selector.register(self._wake_read, selectors.EVENT_READ, None)
+        self._lock = threading.Lock()
+        self._channels = []
+        self._new_channels = []
+        self._timers = [] # heap of (time, sequence number, callback)
+        self._timer_counter = itertools.count()
+        self.start()
+
+    def add_channel(self, serial_port, parser, message_callback=None, priority=PRIORITY_NORMAL, name=None):
+        """Register a serial port with the loop and return its Channel.
+
+        Parameters:
+            serial_port: an open serial port object.
+            parser: object with a feed(data) method that returns a list of the
+                complete messages in the data read so far.
+            message_callback: function to call with each message received
+                that is not a reply to a request.
+            priority: PRIORITY_HIGH, PRIORITY_NORMAL, or PRIORITY_LOW.
+            name: name for the port in logs and statistics.
+        """
+        if name is None:
+            name = serial_port.port
+        channel = Channel(self, serial_port, parser, message_callback, priority, name)
+        with self._lock:
+            self._new_channels.append(channel)
+        self.wake()
+        return channel
+
+    def _remove_channel(self, channel):
+        self._selector.unregister(channel.fd)
+        self._channels.remove(channel)
+        channel._fail_requests(smart_serial.SerialException('{} can no longer be read or written'.format(channel.name)))
+
+    def call_later(self, delay, callback):
+        """Call callback() in the loop thread after delay seconds."""
+        with self._lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_counter), callback))
+        self.wake()
+
+    def call_periodically(self, interval, callback):
+        """Call callback() in the loop thread every interval seconds."""
+        def run_and_reschedule():
+            try:
+                callback()
+            finally:
+                self.call_later(interval, run_and_reschedule)
+        self.call_later(interval, run_and_reschedule)
+
+    def wake(self):
+        """Make the loop re-check its channels for pending writes."""
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass # pipe is full, so the loop will certainly wake up
+
+    def get_statistics(self):
+        """Return a dict mapping port names to dicts of request latency
+        statistics (in seconds) and error counts."""
+        return {channel.name: channel.statistics.as_dict() for channel in list(self._channels)}
+
+    def reset_statistics(self):
+        for channel in list(self._channels):
+            channel.statistics.reset()
+
+    def _run_timers(self):
+        """Run all due timers, and return the time of the next one (or None)."""
+        while True:
+            with self._lock:
+                if not self._timers:
+                    return None
+                when, count, callback = self._timers[0]
+                if when > time.monotonic():
+                    return when
+                heapq.heappop(self._timers)
+            try:
+                callback()
+            except:
+                logger.error('Exception in serial I/O timer callback', exc_info=True)
+
+    def run(self):
+        while True:
+            with self._lock:
+                new_channels, self._new_channels = self._new_channels, []
+            for channel in new_channels:
+                self._selector.register(channel.fd, channel._events, channel)
+                self._channels.append(channel)
+            for channel in self._channels:
+                channel._send_next_request()
+                events = selectors.EVENT_READ
+                if channel._wants_write():
+                    events |= selectors.EVENT_WRITE
+                if events != channel._events:
+                    self._selector.modify(channel.fd, events, channel)
+                    channel._events = events
+            wakeups = [channel._get_deadline() for channel in self._channels]
+            wakeups.append(self._run_timers())
+            wakeups = [wakeup for wakeup in wakeups if wakeup is not None]
+            timeout = max(0, min(wakeups) - time.monotonic()) if wakeups else None
+            ready = self._selector.select(timeout)
+            ready.sort(key=lambda key_events: -1 if key_events[0].data is None else key_events[0].data.priority)
+            for key, events in ready:
+                channel = key.data
+                if channel is None:
+                    try:
+                        while os.read(self._wake_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if channel not in self._channels:
+                    continue # removed due to an error while handling a higher-priority port
+                if events & selectors.EVENT_READ:
+                    channel._handle_readable()
+                if events & selectors.EVENT_WRITE and channel in self._channels:
+                    channel._handle_writable()
+            now = time.monotonic()
+            for channel in self._channels:
+                channel._check_deadline(now)
+
+_io_loop = None
+_io_loop_lock = threading.Lock()
+
+def get_io_loop():
+    """Return the process-wide SerialIOLoop, starting it if necessary."""
+    global _io_loop
+    with _io_loop_lock:
+        if _io_loop is None:
+            _io_loop = SerialIOLoop()
+        return _io_loop
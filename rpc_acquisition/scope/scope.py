@@ -22,21 +22,27 @@
 #
 # Authors: Zach Pincus
 
+import functools
+import time
+from concurrent import futures
+
 from serial import SerialException
 
-from .messaging import message_manager, message_device
+from .messaging import message_manager, message_device, serial_io
 from .device.leica import stand, stage, objective_turret, illumination_axes
 from .device.andor import camera
 from .device.io_tool import io_tool
 from .device import spectra_x
 from .device import tl_lamp
 from .device import acquisition_sequencer
+from .device import acquisition_plan
 from .device import autofocus
 from .device import peltier
 from .device import footpedal
 
 from .config import scope_configuration
 
+from .util import lazy_device
 from .util import logging
 logger = logging.get_logger(__name__)
 
@@ -54,78 +60,144 @@ class Scope(message_device.AsyncDeviceNamespace):
         if property_server:
             self.rebroadcast_properties = property_server.rebroadcast_properties
 
+        io_loop = serial_io.get_io_loop()
+        self.get_serial_statistics = io_loop.get_statistics
+        self.reset_serial_statistics = io_loop.reset_statistics
+
+        # The Leica stand, IOTool (and the Spectra X, which needs it), camera,
+        # and Peltier controller are independent, so initialize them concurrently.
+        self._startup_times = {}
+        startup_start = time.time()
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            leica_init = executor.submit(self._init_leica, config, property_server)
+            iotool_init = executor.submit(self._init_iotool, property_server)
+            camera_init = executor.submit(self._init_camera, property_server)
+            peltier_init = None
+            if 'Peltier' in config:
+                if config.Peltier.get('LAZY_INIT', False):
+                    # Rarely used: don't wait for it to connect at startup
+                    self.peltier = lazy_device.LazyDevice(peltier.Peltier, functools.partial(self._time_init,
+                        'peltier', peltier.Peltier, property_server, property_prefix='scope.peltier.'))
+                else:
+                    peltier_init = executor.submit(self._init_peltier, property_server)
+        has_scope, has_leica_LED = leica_init.result()
+        has_iotool, spectra_x_device = iotool_init.result()
+        has_spectra_x = spectra_x_device is not None
+        has_camera = camera_init.result()
+        if peltier_init is not None:
+            peltier_init.result() # re-raise any unexpected errors
+
+        if (not has_scope) and has_iotool:
+            self.il = Namespace()
+            self.tl = Namespace()
+
+        if has_iotool:
+            if has_spectra_x:
+                self.il.spectra_x = spectra_x_device
+            if has_leica_LED: # using DMi8, and scope is turned on
+                self.tl.lamp = tl_lamp.LeicaLED_Lamp(self.tl, self.iotool, property_server, property_prefix='scope.tl.lamp.')
+            else:
+                self.tl.lamp = tl_lamp.SutterLED_Lamp(self.iotool, property_server, property_prefix='scope.tl.lamp.')
+            self.footpedal = footpedal.Footpedal(self.iotool)
+
+        if has_camera and has_iotool and has_spectra_x:
+            self.camera.acquisition_sequencer = acquisition_sequencer.AcquisitionSequencer(self)
+
+        if has_scope and has_camera:
+            self.camera.autofocus = autofocus.Autofocus(self.camera, self.stage)
+            if has_iotool and has_spectra_x:
+                self.camera.acquisition_plan = acquisition_plan.AcquisitionPlan(self.stage,
+                    acquisition_sequencer.AcquisitionSequencer(self))
+
+        self._startup_times['total'] = time.time() - startup_start
+        logger.info('Device initialization times: {}', ', '.join('{}: {:.2f} s'.format(name, elapsed)
+            for name, elapsed in sorted(self._startup_times.items(), key=lambda item: item[1])))
+
+    def get_startup_times(self):
+        """Return a dict mapping device names to the time, in seconds, taken to
+        initialize them at startup (or on first use, for lazily-initialized
+        devices), plus the 'total' wall-clock time of startup."""
+        return dict(self._startup_times)
+
+    def _time_init(self, name, init_function, *args, **kwargs):
+        """Call init_function(*args, **kwargs), recording how long it took."""
+        t0 = time.time()
+        try:
+            return init_function(*args, **kwargs)
+        finally:
+            self._startup_times[name] = time.time() - t0
+
+    def _init_leica(self, config, property_server):
+        """Initialize the stand and its function units. Return (has_scope, has_leica_LED)."""
         try:
             logger.info('Looking for microscope.')
-            manager = message_manager.LeicaMessageManager(config.Stand.SERIAL_PORT, config.Stand.SERIAL_BAUD)
-            self.stand = stand.Stand(manager, property_server, property_prefix='scope.stand.')
+            manager = message_manager.LeicaMessageManager(config.Stand.SERIAL_PORT, config.Stand.SERIAL_BAUD,
+                max_in_flight=config.Stand.get('MAX_COMMANDS_IN_FLIGHT', 4),
+                response_timeout=config.Stand.get('RESPONSE_TIMEOUT', 120))
+            self.stand = self._time_init('stand', stand.Stand, manager, property_server, property_prefix='scope.stand.')
             function_units = self.stand.get_available_function_unit_IDs()
             is_dm6000 = all(FU in function_units for FU in [81, 83, 84, 94])
             has_leica_LED = not is_dm6000 and 77 in function_units
-            
+
             has_obj_safe_mode = is_dm6000
-            self.nosepiece = objective_turret.ObjectiveTurret(has_obj_safe_mode, manager, property_server, property_prefix='scope.nosepiece.')
-            self.stage = stage.Stage(manager, property_server, property_prefix='scope.stage.')
             if is_dm6000:
                 il = illumination_axes.DM6000B_IL
                 tl = illumination_axes.DM6000B_TL
-                self._shutter_watcher = illumination_axes.DM6000B_ShutterWatcher(manager, property_server, property_prefix='scope.')
             else:
                 il = illumination_axes.DMi8_IL
                 if has_leica_LED:
                     tl = illumination_axes.DMi8_LeicaLED_TL
                 else:
                     tl = illumination_axes.DMi8_TL
-            self.il = il(manager, property_server, property_prefix='scope.il.')
-            self.tl = tl(manager, property_server, property_prefix='scope.tl.')
-            has_scope = True
+            def init_illumination():
+                self.il = il(manager, property_server, property_prefix='scope.il.')
+                self.tl = tl(manager, property_server, property_prefix='scope.tl.')
+                if is_dm6000:
+                    self._shutter_watcher = illumination_axes.DM6000B_ShutterWatcher(manager, property_server, property_prefix='scope.')
+            # The nosepiece, stage, and illumination axes are separate function
+            # units, each with its own command queue, so set them up concurrently.
+            with futures.ThreadPoolExecutor(max_workers=3) as executor:
+                nosepiece_init = executor.submit(self._time_init, 'nosepiece', objective_turret.ObjectiveTurret,
+                    has_obj_safe_mode, manager, property_server, property_prefix='scope.nosepiece.')
+                stage_init = executor.submit(self._time_init, 'stage', stage.Stage, manager, property_server, property_prefix='scope.stage.')
+                illumination_init = executor.submit(self._time_init, 'illumination', init_illumination)
+            self.nosepiece = nosepiece_init.result()
+            self.stage = stage_init.result()
+            illumination_init.result()
+            return True, has_leica_LED
         except SerialException:
-            has_scope = False
             logger.log_exception('Could not connect to microscope:')
+            return False, False
 
+    def _init_iotool(self, property_server):
+        """Initialize the IOTool and then the Spectra X, which requires it.
+        Return (has_iotool, spectra_x_device or None)."""
         try:
             logger.info('Looking for IOTool.')
-            self.iotool = io_tool.IOTool()
-            has_iotool = True
+            self.iotool = self._time_init('iotool', io_tool.IOTool)
         except SerialException:
-            has_iotool = False
             logger.log_exception('Could not connect to IOTool:')
+            return False, None
+        try:
+            logger.info('Looking for Spectra X.')
+            spectra_x_device = self._time_init('spectra_x', spectra_x.SpectraX, self.iotool, property_server, property_prefix='scope.il.spectra_x.')
+        except SerialException:
+            logger.log_exception('Could not connect to Spectra X:')
+            return True, None
+        return True, spectra_x_device
 
-        if (not has_scope) and has_iotool:
-            self.il = Namespace()
-            self.tl = Namespace()
-
-        if has_iotool:
-            try:
-                logger.info('Looking for Spectra X.')
-                self.il.spectra_x = spectra_x.SpectraX(self.iotool, property_server, property_prefix='scope.il.spectra_x.')
-                has_spectra_x = True
-            except SerialException:
-                has_spectra_x = False
-                logger.log_exception('Could not connect to Spectra X:')
-            if has_leica_LED: # using DMi8, and scope is turned on
-                self.tl.lamp = tl_lamp.LeicaLED_Lamp(self.tl, self.iotool, property_server, property_prefix='scope.tl.lamp.')
-            else:
-                self.tl.lamp = tl_lamp.SutterLED_Lamp(self.iotool, property_server, property_prefix='scope.tl.lamp.')
-            self.footpedal = footpedal.Footpedal(self.iotool)
-
+    def _init_camera(self, property_server):
         try:
             logger.info('Looking for camera.')
-            self.camera = camera.Camera(property_server, property_prefix='scope.camera.')
-            has_camera = True
+            self.camera = self._time_init('camera', camera.Camera, property_server, property_prefix='scope.camera.')
+            return True
         except camera.lowlevel.AndorError:
-            has_camera = False
             logger.log_exception('Could not connect to camera:')
+            return False
 
-        if has_camera and has_iotool and has_spectra_x:
-            self.camera.acquisition_sequencer = acquisition_sequencer.AcquisitionSequencer(self)
-
-        if has_scope and has_camera:
-            self.camera.autofocus = autofocus.Autofocus(self.camera, self.stage)
-
-        if 'Peltier' in config:
-            try:
-                logger.info('Looking for peltier controller.')
-                self.peltier = peltier.Peltier(property_server, property_prefix='scope.peltier.')
-            except SerialException:
-                logger.log_exception('Could not connect to peltier controller:')
-
+    def _init_peltier(self, property_server):
+        try:
+            logger.info('Looking for peltier controller.')
+            self.peltier = self._time_init('peltier', peltier.Peltier, property_server, property_prefix='scope.peltier.')
+        except SerialException:
+            logger.log_exception('Could not connect to peltier controller:')
@@ -60,6 +60,7 @@ def _make_rpc_client(rpc_addr, interrupt_addr, async_addr, context=None):
     async_client = rpc_client.BaseZMQClient(async_addr, context)
     is_local, get_data = transfer_ism_buffer.client_get_data_getter(client)
     is_local, async_get_data = transfer_ism_buffer.client_get_data_getter(async_client)
+    put_data = transfer_ism_buffer.client_get_data_putter(client, is_local)
 
     # define additional client wrapper functions
     def get_many_data(data_list):
@@ -74,22 +75,36 @@ def _make_rpc_client(rpc_addr, interrupt_addr, async_addr, context=None):
             return best_z, positions_and_scores, get_many_data(image_names)
         else:
             return best_z, positions_and_scores
+    def get_frame_data(frame):
+        if frame is None:
+            return None
+        name, timestamp, step_index, exposure = frame
+        return get_data(name), timestamp, step_index, exposure
+    def get_plan_frame_data(frame):
+        if frame is None:
+            return None
+        name, timestamp, position_index, step_index, exposure = frame
+        return get_data(name), timestamp, position_index, step_index, exposure
     def get_config(config_dict):
         return scope_configuration.ConfigDict(config_dict)
 
     client_wrappers = {
         'get_configuration': get_config,
         'camera.acquire_image': get_data,
+        'camera.acquire_reduced': get_data,
         'camera.latest_image': get_data,
         'camera.next_image': get_data,
         'camera.stream_acquire': get_stream_data,
         'camera.acquisition_sequencer.run': get_many_data,
+        'camera.acquisition_sequencer.next_frame': get_frame_data,
+        'camera.acquisition_plan.next_frame': get_plan_frame_data,
         'camera.autofocus.autofocus': get_autofocus_data,
         'camera.autofocus.autofocus_continuous_move': get_autofocus_data
     }
     scope = client.proxy_namespace(client_wrappers)
     _replace_in_state(client, scope)
     scope._get_data = get_data
+    scope._put_data = put_data
     scope._is_local = is_local
     if not is_local:
         scope.camera.set_network_compression = get_data.set_network_compression
@@ -105,6 +120,43 @@ def _make_rpc_client(rpc_addr, interrupt_addr, async_addr, context=None):
         latest_image.__doc__ = scope.camera.latest_image.__doc__
         scope.camera._synchronous_latest_image = scope.camera.latest_image
         scope.camera.latest_image = latest_image
+        if hasattr(scope.camera, 'acquisition_sequencer'):
+            sequencer = scope.camera.acquisition_sequencer
+            def iter_run():
+                """Run the assembled acquisition steps, yielding an
+                (image, camera_timestamp, step_index, exposure_ms) tuple for
+                each frame as soon as it has been read out on the server. Each
+                image is transferred while the next exposure is in progress.
+                If the iteration is stopped early (or raises), the rest of the
+                run's frames are discarded on the server."""
+                sequencer.start_run()
+                finished = False
+                try:
+                    for frame in iter(sequencer.next_frame, None):
+                        yield frame
+                    finished = True
+                finally:
+                    if not finished:
+                        sequencer.abort_run()
+            sequencer.iter_run = iter_run
+        if hasattr(scope.camera, 'acquisition_plan'):
+            plan = scope.camera.acquisition_plan
+            def iter_plan():
+                """Run the acquisition plan, yielding an
+                (image, camera_timestamp, position_index, step_index, exposure_ms)
+                tuple for each frame as soon as it has been read out on the server.
+                If the iteration is stopped early (or raises), the rest of the
+                plan is abandoned on the server."""
+                plan.start()
+                finished = False
+                try:
+                    for frame in iter(plan.next_frame, None):
+                        yield frame
+                    finished = True
+                finally:
+                    if not finished:
+                        plan.abort()
+            plan.iter_run = iter_plan
     scope._lock_attrs() # prevent unwary users from setting new attributes that won't get communicated to the server
     return scope
 
@@ -24,15 +24,20 @@
 
 import sys
 import time
-import pathlib
 import json
+import pathlib
 import logging
 import inspect
+import threading
 import concurrent.futures as futures
 
-from ..util import json_encode
+from ..util import metadata_journal
 from ..util import threaded_image_io
+from ..util import image_store
+from ..util import metadata_index
+from ..util import analysis_pool
 from ..util import log_util
+from ..client_util import stage_route
 
 class DummyIO:
     def __init__(self, logger):
@@ -41,9 +46,56 @@ class DummyIO:
         self.logger.warn('Trying to write files, but file writing was disabled!')
 
 class TimepointHandler:
+    # A threaded_image_io.COMPRESSION value, or a dict mapping image names (e.g.
+    # 'bf.png') to such values, with the entry for None (if any) used for
+    # images not otherwise listed.
     IMAGE_COMPRESSION = threaded_image_io.COMPRESSION.DEFAULT
     LOG_LEVEL = logging.INFO
     IO_THREADS = 4
+    # If nonzero, encode and write images in this many worker processes
+    # (threaded_image_io.ProcessIO) rather than in IO_THREADS threads, and
+    # continue to the next position while the images are written.
+    IO_PROCESSES = 0
+    # If True, append each position's images to the experiment's
+    # util.image_store.ImageStore (a few large files per position and channel)
+    # rather than writing a separate file per image. Stored images can be
+    # exported to individual files with image_store.export_pngs().
+    IMAGE_STORE = False
+    # SQLite database (util.metadata_index.MetadataIndex) to which the metadata
+    # for each position and timepoint is added as the experiment runs. Relative
+    # paths are relative to the experiment directory; use an absolute path to
+    # index several experiments together (e.g. 'metadata_index.sqlite'), or None
+    # for no index. If the database can't be opened, acquisition continues
+    # without it.
+    METADATA_INDEX = None
+    # If nonzero, run the functions passed to add_analysis_job() in this many
+    # worker processes (util.analysis_pool.AnalysisPool) while acquisition
+    # continues, with at most MAX_ANALYSIS_JOBS queued or running at once (if
+    # None, twice ANALYSIS_PROCESSES). Otherwise, run them immediately.
+    ANALYSIS_PROCESSES = 0
+    MAX_ANALYSIS_JOBS = None
+    # visit positions in the order that minimizes stage travel time, rather than sorted by name.
+    # (This changes the interval between acquisitions of each position, so is
+    # best enabled only at the start of an experiment.)
+    OPTIMIZE_ROUTE = False
+    # plan the route once and keep it for all timepoints, so that each position
+    # is imaged at regular intervals (otherwise, re-plan at each timepoint)
+    STABLE_ROUTE = True
+    # Position metadata are appended to journals as each position is acquired,
+    # and changes to the experiment metadata at the end of each timepoint;
+    # every this-many timepoints (and at the end of the experiment) the
+    # position_metadata.json and experiment_metadata.json files are rewritten
+    # in full from the journals. (If experiment_metadata.json is edited by hand
+    # while its journal holds changes, the next timepoint refuses to start
+    # rather than lose either: see util.metadata_journal.DictJournal.)
+    METADATA_COMPACTION_INTERVAL = 12
+    # The progress of each timepoint is recorded in a checkpoint file as each
+    # position is acquired. If a timepoint fails (e.g. from a hardware error)
+    # and the job is re-run within this many hours of the timepoint's start,
+    # the timepoint is resumed: positions already acquired are not acquired
+    # again, and the timepoint's configuration (see get_timepoint_state()) is
+    # reused. If None, failed timepoints are never resumed.
+    RESUME_WITHIN_HOURS = 2
 
     def __init__(self, data_dir, log_level=None, scope_host='127.0.0.1', dry_run=False):
         """Setup the basic code to take a single timepoint from a timecourse experiment.
@@ -63,8 +115,8 @@ class TimepointHandler:
         """
         self.data_dir = pathlib.Path(data_dir)
         self.experiment_metadata_path = self.data_dir / 'experiment_metadata.json'
-        with self.experiment_metadata_path.open('r') as f:
-            self.experiment_metadata = json.load(f)
+        self.experiment_journal = metadata_journal.DictJournal(self.experiment_metadata_path)
+        self.experiment_metadata = self.experiment_journal.load()
         self.positions = self.experiment_metadata['positions'] # dict mapping names to (x,y,z) stage positions
         self.skip_positions = set(self.experiment_metadata.setdefault('skip_positions', []))
         if scope_host is not None:
@@ -81,39 +133,90 @@ class TimepointHandler:
         elif isinstance(log_level, str):
             log_level = getattr(logging, log_level)
         self.logger.setLevel(log_level)
+        self.metadata_index = None
+        self.checkpoint_path = self.data_dir / 'timepoint_checkpoint.json'
+        self._checkpoint_lock = threading.Lock()
         if self.write_files:
-            self.image_io = threaded_image_io.ThreadedIO(self.IO_THREADS)
+            if self.IMAGE_STORE:
+                self.image_store = image_store.ImageStore(self.data_dir)
+            if self.IO_PROCESSES:
+                self.image_io = threaded_image_io.ProcessIO(self.IO_PROCESSES)
+            else:
+                self.image_io = threaded_image_io.ThreadedIO(self.IO_THREADS)
             handler = logging.FileHandler(str(self.data_dir/'acquisitions.log'))
         else:
             self.image_io = DummyIO(self.logger)
             handler = logging.StreamHandler()
         handler.setFormatter(log_util.get_formatter())
         self.logger.addHandler(handler)
+        if self.write_files and self.METADATA_INDEX is not None:
+            # as in _update_metadata_index(), a missing index shouldn't stop the acquisition
+            try:
+                self.metadata_index = metadata_index.MetadataIndex(self.data_dir / self.METADATA_INDEX)
+            except Exception:
+                self.logger.warning('Could not open metadata index; continuing without it', exc_info=True)
         self._job_thread = futures.ThreadPoolExecutor(max_workers=1)
+        if self.ANALYSIS_PROCESSES:
+            self.analysis_pool = analysis_pool.AnalysisPool(self.ANALYSIS_PROCESSES, self.MAX_ANALYSIS_JOBS)
+        else:
+            self.analysis_pool = None
 
     def run_timepoint(self, scheduled_start):
         try:
-            self.timepoint_prefix = time.strftime('%Y-%m-%dt%H%M')
-            self.scheduled_start = scheduled_start
-            self.start_time = time.time()
             self._job_futures = []
-            self.logger.info('Starting timepoint {} ({:.0f} minutes after scheduled)', self.timepoint_prefix,
-                (self.start_time-self.scheduled_start)/60)
+            self._completed_positions = set()
+            checkpoint = self._read_checkpoint()
+            if checkpoint is None:
+                self.timepoint_prefix = time.strftime('%Y-%m-%dt%H%M')
+                self.scheduled_start = scheduled_start
+                self.start_time = time.time()
+                self.resumed_state = None
+                self.logger.info('Starting timepoint {} ({:.0f} minutes after scheduled)', self.timepoint_prefix,
+                    (self.start_time-self.scheduled_start)/60)
+            else:
+                self.timepoint_prefix = checkpoint['timepoint_prefix']
+                self.scheduled_start = checkpoint['scheduled_start']
+                self.start_time = checkpoint['start_time']
+                self.resumed_state = checkpoint['state']
+                self._completed_positions.update(checkpoint['completed_positions'])
+                self.skip_positions.update(checkpoint['skip_positions'])
+                self.logger.info('Resuming timepoint {} ({:.0f} minutes after it started; {} positions already acquired)',
+                    self.timepoint_prefix, (time.time()-self.start_time)/60, len(self._completed_positions))
             # record the timepoint prefix and timestamp for this timepoint into the
             # experiment metadata
             self.experiment_metadata.setdefault('timepoints', []).append(self.timepoint_prefix)
             self.experiment_metadata.setdefault('timestamps', []).append(self.start_time)
             self.configure_timepoint()
-            for position_name, position_coords in sorted(self.positions.items()):
-                if position_name not in self.skip_positions:
-                    self.run_position(position_name, position_coords)
+            self._write_checkpoint()
+            self._stage_travel_time = 0
+            for position_name in self.get_position_order():
+                if position_name not in self.skip_positions and position_name not in self._completed_positions:
+                    self.run_position(position_name, self.positions[position_name])
+                if self.analysis_pool is not None:
+                    self.analysis_pool.deliver_results()
+            analysis_error = None
+            if self.analysis_pool is not None:
+                analysis_error = self._wait_for_analysis()
+            if self.write_files and self.IO_PROCESSES:
+                t0 = time.time()
+                self.image_io.wait()
+                self.logger.debug('Waited {:.1f} seconds for image writing to finish', time.time()-t0)
+            if self._estimated_travel_time is not None:
+                self.logger.info('Stage travel time: {:.1f} seconds (estimated {:.1f} seconds)',
+                    self._stage_travel_time, self._estimated_travel_time)
             self.experiment_metadata['skip_positions'] = list(self.skip_positions)
             self.finalize_timepoint()
             self.end_time = time.time()
             self.experiment_metadata.setdefault('durations', []).append(self.end_time - self.start_time)
-            if self.write_files:
-                self._write_atomic_json(self.experiment_metadata_path, self.experiment_metadata)
             run_again = self.skip_positions != self.positions.keys() # don't run again if we're skipping all the positions
+            if self.write_files:
+                self._save_experiment_metadata(compact=not run_again)
+                self._update_metadata_index('add_timepoint', self.data_dir, self.timepoint_prefix, self.start_time,
+                    self.end_time - self.start_time, self.scheduled_start,
+                    self.experiment_metadata.get('brightfield metering', {}).get(self.timepoint_prefix),
+                    self.skip_positions)
+                # the timepoint is now safely recorded, so must not be resumed
+                self.checkpoint_path.unlink()
             if self._job_futures:
                 self.logger.debug('Waiting for background jobs')
                 t0 = time.time()
@@ -123,6 +226,9 @@ class TimepointHandler:
                 # during the execution.
                 [f.result() for f in self._job_futures]
                 self.logger.debug('Background jobs complete ({:.1f} seconds)', time.time()-t0)
+            if analysis_error is not None:
+                # like errors in background jobs, raised only once the timepoint is recorded
+                raise analysis_error
             self.logger.info('Timepoint {} ended ({:.0f} minutes after starting)', self.timepoint_prefix,
                              (time.time()-self.start_time)/60)
             if run_again:
@@ -143,12 +249,103 @@ class TimepointHandler:
         """
         self._job_futures.append(self._job_thread.submit(function, *args, **kws))
 
+    def add_analysis_job(self, function, images, *args, callback=None, name=None, **kws):
+        """Run function(images, *args, **kws) to analyze a list of images (e.g.
+        those just acquired at a position), and if specified, call
+        callback(result) with its return value.
+
+        If ANALYSIS_PROCESSES is nonzero, the function is run in a worker
+        process while acquisition continues, so it must be defined at module
+        level, and its other arguments and its return value must be picklable.
+        (The images are passed through shared memory.) The callback is called in
+        the acquisition thread, between positions, so it may safely modify
+        self.skip_positions. All analysis jobs are complete (and their
+        callbacks called) before finalize_timepoint() is called, and their
+        run times are logged under the given name. As with background jobs, an
+        exception from a job or callback is propagated only after the
+        timepoint's metadata has been saved.
+
+        Otherwise, the function and callback are called immediately.
+        """
+        if self.analysis_pool is None:
+            result = function(images, *args, **kws)
+            if callback is not None:
+                callback(result)
+        else:
+            self.analysis_pool.submit(function, images, *args, callback=callback, name=name, **kws)
+
+    def _wait_for_analysis(self):
+        # Return (rather than raise) any analysis error, so that the timepoint's
+        # metadata can be saved before it is raised.
+        t0 = time.time()
+        error = None
+        try:
+            self.analysis_pool.wait()
+        except Exception as e:
+            error = e
+        timings, self.analysis_pool.timings = self.analysis_pool.timings, []
+        for name, queued_seconds, run_seconds in timings:
+            self.logger.debug('Analysis job {} took {:.1f} seconds ({:.1f} seconds queued)',
+                name, run_seconds, queued_seconds)
+        if timings:
+            run_times = [run_seconds for name, queued_seconds, run_seconds in timings]
+            self.logger.info('{} analysis jobs: {:.1f} seconds mean, {:.1f} seconds max; waited {:.1f} seconds for the last to finish',
+                len(timings), sum(run_times) / len(timings), max(run_times), time.time()-t0)
+        return error
+
+    def get_position_order(self):
+        """Return the names of the positions to acquire at this timepoint, in
+        the order in which they should be visited.
+
+        If OPTIMIZE_ROUTE is True, the order minimizes the stage travel time
+        from the current stage position (see client_util.stage_route). If
+        STABLE_ROUTE is also True, the route is planned once for all positions
+        and stored in the experiment metadata as 'route'; later timepoints
+        follow it (omitting skipped positions) until the set of positions
+        changes. Otherwise, positions are visited in order of their names.
+
+        Positions already acquired before a resumed timepoint was interrupted
+        are omitted.
+        """
+        excluded = self.skip_positions | self._completed_positions
+        names = [name for name in sorted(self.positions.keys()) if name not in excluded]
+        self._estimated_travel_time = None
+        if not self.OPTIMIZE_ROUTE or self.scope is None or not hasattr(self.scope, 'stage'):
+            return names
+        start = self.scope.stage.position
+        speeds, ramps = stage_route.get_stage_kinetics(self.scope)
+        if self.STABLE_ROUTE:
+            route = self.experiment_metadata.get('route')
+            if route is None or set(route) != self.positions.keys():
+                route, estimate = stage_route.plan_route(self.positions, start, speeds, ramps)
+                self.experiment_metadata['route'] = route
+                self.logger.info('Planned stage route for {} positions', len(route))
+            names = [name for name in route if name not in excluded]
+            self._estimated_travel_time = stage_route.route_time(self.positions, names, start, speeds, ramps)
+        else:
+            names, self._estimated_travel_time = stage_route.plan_route(
+                {name: self.positions[name] for name in names}, start, speeds, ramps)
+        return names
+
     def configure_timepoint(self):
         """Override this method with global configuration for the image acquisitions
         (e.g. camera configuration). Member variables 'scope', 'experiment_metadata',
-        'timepoint_prefix', and 'positions' may be specifically useful."""
+        'timepoint_prefix', and 'positions' may be specifically useful.
+
+        If the timepoint is being resumed after an interruption, 'resumed_state'
+        is the dict that get_timepoint_state() returned when the timepoint was
+        interrupted (and None otherwise), from which the configuration can be
+        restored rather than recalculated."""
         pass
 
+    def get_timepoint_state(self):
+        """Override this method to return a JSON-serializable dict of the state
+        (e.g. calibration results) needed to resume this timepoint if it is
+        interrupted. The state is recorded after configure_timepoint() and after
+        each position is acquired, and is provided as self.resumed_state to
+        configure_timepoint() when the timepoint is resumed."""
+        return {}
+
     def finalize_timepoint(self):
         """Override this method with global finalization after the images have been
         acquired for each position. Useful for altering the self.experiment_metadata
@@ -174,41 +371,132 @@ class TimepointHandler:
         position_dir = self.data_dir / position_name
         if not position_dir.exists():
             position_dir.mkdir()
-        metadata_path = position_dir / 'position_metadata.json'
-        if metadata_path.exists():
-            with metadata_path.open('r') as f:
-                position_metadata = json.load(f)
-        else:
-            position_metadata = []
+        position_metadata = self._get_position_journal(position_dir)
         timestamp = time.time()
 
         if self.scope is not None:
             self.scope.stage.position = position_coords
         t1 = time.time()
+        self._stage_travel_time += t1 - timestamp
         self.logger.debug('Stage Positioned ({:.1f} seconds)', t1-t0)
         images, image_names, new_metadata = self.acquire_images(position_name, position_dir,
             position_metadata)
         t2 = time.time()
         self.logger.debug('{} Images Acquired ({:.1f} seconds)', len(images), t2-t1)
+        compression = self.get_image_compression(image_names)
+        # the file extensions must match the formats written (e.g. 'bf.png' is saved as 'bf.tiff' with TIFF_ZSTD)
+        image_names = [threaded_image_io.fix_suffix(name, c) for name, c in zip(image_names, compression)]
         image_paths = [position_dir / (self.timepoint_prefix + ' ' + name) for name in image_names]
         if new_metadata is None:
             new_metadata = {}
         new_metadata['timestamp'] = timestamp
         new_metadata['timepoint'] = self.timepoint_prefix
-        position_metadata.append(new_metadata)
         if self.write_files:
-            self.image_io.write(images, image_paths, self.IMAGE_COMPRESSION)
-            self._write_atomic_json(metadata_path, position_metadata)
+            if self.IMAGE_STORE:
+                channels = [pathlib.PurePath(name).stem for name in image_names]
+                for channel, image in zip(channels, images):
+                    if self.resumed_state is not None and self.image_store.contains(position_name, channel, self.timepoint_prefix):
+                        # stored before the interruption, but the checkpoint wasn't written: the
+                        # store is append-only, so keep the earlier image
+                        self.logger.info('Keeping {} image for position {} stored before the interruption', channel, position_name)
+                        continue
+                    self.image_store.append(position_name, channel, self.timepoint_prefix, image)
+                self._record_position_metadata(position_name, position_metadata, new_metadata,
+                    [(channel, None) for channel in channels])
+            elif self.IO_PROCESSES:
+                # record the metadata only once the images are safely written
+                def images_written(error):
+                    if error is None:
+                        self._record_position_metadata(position_name, position_metadata, new_metadata,
+                            list(zip(image_names, image_paths)))
+                self.image_io.write_async(images, image_paths, compression, images_written)
+            else:
+                self.image_io.write(images, image_paths, compression)
+                self._record_position_metadata(position_name, position_metadata, new_metadata,
+                    list(zip(image_names, image_paths)))
         t3 = time.time()
         self.logger.debug('Images saved ({:.1f} seconds)', t3-t2)
         self.logger.debug('Position done (total: {:.1f} seconds)', t3-t0)
 
-    def _write_atomic_json(self, out_path, data):
-        out_path = pathlib.Path(out_path)
-        tmp_path = out_path.parent / (out_path.name + '-' +self.timepoint_prefix)
-        with tmp_path.open('w') as f:
-             json_encode.encode_legible_to_file(position_metadata, f)
-        os.replace(str(tmp_path), str(out_path))
+    def _record_position_metadata(self, position_name, position_metadata, new_metadata, indexed_images):
+        position_metadata.append(new_metadata)
+        if len(position_metadata) % self.METADATA_COMPACTION_INTERVAL == 0:
+            position_metadata.compact(self.data_dir / position_name / 'position_metadata.json')
+        self._update_metadata_index('add_acquisition', self.data_dir, position_name, self.timepoint_prefix,
+            new_metadata, indexed_images)
+        self._write_checkpoint(position_name)
+
+    def _read_checkpoint(self):
+        """Return the checkpoint of an interrupted timepoint that should be
+        resumed, or None if a new timepoint should be started."""
+        if not self.write_files or self.RESUME_WITHIN_HOURS is None or not self.checkpoint_path.exists():
+            return None
+        with self.checkpoint_path.open() as f:
+            checkpoint = json.load(f)
+        if checkpoint['timepoint_prefix'] in self.experiment_metadata.get('timepoints', []):
+            # the timepoint was completed, but the checkpoint was not removed
+            return None
+        age_hours = (time.time() - checkpoint['start_time']) / 60**2
+        if age_hours > self.RESUME_WITHIN_HOURS:
+            self.logger.warning('Not resuming interrupted timepoint {} ({:.1f} hours old; {} positions acquired)',
+                checkpoint['timepoint_prefix'], age_hours, len(checkpoint['completed_positions']))
+            return None
+        return checkpoint
+
+    def _write_checkpoint(self, completed_position=None):
+        # May be called from ProcessIO's callback thread (if IO_PROCESSES is set),
+        # hence the lock.
+        if not self.write_files:
+            return
+        with self._checkpoint_lock:
+            if completed_position is not None:
+                self._completed_positions.add(completed_position)
+            checkpoint = dict(timepoint_prefix=self.timepoint_prefix, start_time=self.start_time,
+                scheduled_start=self.scheduled_start, completed_positions=sorted(self._completed_positions),
+                skip_positions=sorted(self.skip_positions), state=self.get_timepoint_state())
+            metadata_journal.write_json_atomic(self.checkpoint_path, checkpoint)
+
+    def _update_metadata_index(self, method, *args):
+        # The index is a convenience for later analysis: don't let a problem with
+        # it (e.g. a database locked by a long-running query) stop the acquisition.
+        if self.metadata_index is None:
+            return
+        try:
+            getattr(self.metadata_index, method)(*args)
+        except Exception:
+            self.logger.warning('Could not update metadata index', exc_info=True)
+
+    def get_image_compression(self, image_names):
+        """Return the list of compression values to write the named images with.
+        (If a compression value requires a particular file format, the image's
+        file extension is changed to match: see threaded_image_io.fix_suffix().)"""
+        compression = self.IMAGE_COMPRESSION
+        if isinstance(compression, dict):
+            default = compression.get(None, threaded_image_io.COMPRESSION.DEFAULT)
+            return [compression.get(name, default) for name in image_names]
+        return [compression] * len(image_names)
+
+    def _get_position_journal(self, position_dir):
+        # Experiments started before the journal existed have only a position_metadata.json
+        # file, which the journal reads from until the first new record is appended.
+        return metadata_journal.RecordJournal(position_dir / 'position_metadata.jsonl',
+            legacy_path=position_dir / 'position_metadata.json')
+
+    def _save_experiment_metadata(self, compact=False):
+        """Record the changes to the experiment metadata, and if compact is True,
+        rewrite experiment_metadata.json and the position_metadata.json files
+        in full."""
+        t0 = time.time()
+        if compact or len(self.experiment_metadata['timepoints']) % self.METADATA_COMPACTION_INTERVAL == 0:
+            self.experiment_journal.compact(self.experiment_metadata)
+        else:
+            self.experiment_journal.save(self.experiment_metadata)
+        if compact: # position journals are otherwise compacted in run_position()
+            for position_name in self.positions:
+                position_dir = self.data_dir / position_name
+                if position_dir.exists():
+                    self._get_position_journal(position_dir).compact(position_dir / 'position_metadata.json')
+        self.logger.debug('Metadata saved ({:.1f} seconds)', time.time()-t0)
 
     def acquire_images(self, position_name, position_dir, position_metadata):
         """Override this method in a subclass to define the image-acquisition sequence.
@@ -237,8 +525,10 @@ class TimepointHandler:
                 position-specific data files and outputs should be written. Useful
                 only if additional data needs to be read in or out during
                 acquisition. (E.g. a background model or similar.)
-            position_metadata: list of all the stored position metadata from the
-                previous timepoints, in chronological order. In particular, this
+            position_metadata: sequence of all the stored position metadata from the
+                previous timepoints, in chronological order. (This is a
+                metadata_journal.RecordJournal, which reads each entry from disk
+                only when it is accessed.) In particular, this
                 dictionary is guaranteed to contain 'timestamp' which is the
                 time.time() at which that acquisition was started. Other values
                 (such as the latest focal plane) stored by previous acquisition
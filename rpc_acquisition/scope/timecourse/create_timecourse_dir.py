@@ -39,7 +39,8 @@ class Handler(timecourse_handler.BasicAcquisitionHandler):
     PIXEL_READOUT_RATE = '100 MHz'
     USE_LAST_FOCUS_POSITION = True
     INTERVAL_MODE = 'scheduled start'
-    IMAGE_COMPRESSION = timecourse_handler.COMPRESSION.DEFAULT # useful options include PNG_FAST, PNG_NONE, TIFF_NONE
+    IMAGE_COMPRESSION = timecourse_handler.COMPRESSION.DEFAULT # useful options include PNG_FAST, PNG_NONE, TIFF_NONE, TIFF_ZSTD, BLOSC_LZ4
+    # (images are saved with the file extension the option requires, e.g. 'bf.tiff' for TIFF_ZSTD)
     LOG_LEVEL = timecourse_handler.logging.INFO # DEBUG may be useful
     # Set the following to have the script set the microscope apertures as desired:
     TL_FIELD_DIAPHRAGM = None
@@ -0,0 +1,109 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for resuming an interrupted timepoint: run with
+python -m unittest scope.timecourse.test_resume"""
+
+import json
+import pathlib
+import tempfile
+import time
+import types
+import unittest
+
+import numpy
+
+from . import timecourse_handler
+
+class GeneratorIO:
+    """Stand-in for threaded_image_io.ThreadedIO that, like it, returns an
+    iterator (not a list) from read()."""
+    def __init__(self, images):
+        self.images = images
+
+    def read(self, paths):
+        return (self.images[pathlib.Path(path).name] for path in paths)
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.data_dir = pathlib.Path(self.tempdir.name)
+        metadata = dict(positions={'000': [0, 0, 0], '001': [1, 0, 0]}, timepoints=[], timestamps=[])
+        with (self.data_dir / 'experiment_metadata.json').open('w') as f:
+            json.dump(metadata, f)
+        self.handler = timecourse_handler.BasicAcquisitionHandler(self.data_dir, scope_host=None)
+        self.handler.scope = types.SimpleNamespace(camera=types.SimpleNamespace(exposure_time=None))
+
+    def tearDown(self):
+        logger = self.handler.logger.logger # the handlers add file handlers to a shared logger
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        self.tempdir.cleanup()
+
+    def _write_checkpoint(self, start_time):
+        handler = self.handler
+        handler.timepoint_prefix = '2015-01-01t0000'
+        handler.start_time = start_time
+        handler.scheduled_start = start_time
+        handler._completed_positions = set()
+        handler.bf_exposure, handler.tl_intensity = 10, 100
+        handler.experiment_metadata['brightfield metering'] = {handler.timepoint_prefix:
+            dict(exposure=10, intensity=100, ref_intensity=20000)}
+        handler.focal_surface = types.SimpleNamespace(drifts=[1.5], errors=[0.5])
+        handler._write_checkpoint('000')
+
+    def test_resume(self):
+        self._write_checkpoint(time.time())
+        checkpoint = self.handler._read_checkpoint()
+        self.assertIsNotNone(checkpoint)
+        self.assertEqual(checkpoint['completed_positions'], ['000'])
+        self.assertEqual(checkpoint['state']['focus_drifts'], [1.5])
+
+        # as in run_timepoint(), for a fresh handler
+        self.handler = handler = timecourse_handler.BasicAcquisitionHandler(self.data_dir, scope_host=None)
+        handler.scope = types.SimpleNamespace(camera=types.SimpleNamespace(exposure_time=None))
+        handler.timepoint_prefix = checkpoint['timepoint_prefix']
+        mask = numpy.zeros((4, 4), numpy.uint8)
+        mask[1:3, 1:3] = 255
+        flatfield = numpy.ones((4, 4), numpy.float32)
+        prefix = handler.timepoint_prefix + ' '
+        handler.image_io = GeneratorIO({prefix+'vignette_mask.png': mask, prefix+'bf_flatfield.tiff': flatfield})
+        handler._restore_calibrations(checkpoint['state'])
+        self.assertTrue((handler.vignette_mask == (mask > 0)).all())
+        self.assertIs(handler.bf_flatfield, flatfield)
+        self.assertIsNone(handler.fl_flatfield)
+        self.assertEqual(handler.scope.camera.exposure_time, 10)
+        self.assertEqual(handler.experiment_metadata['brightfield metering'][handler.timepoint_prefix]['ref_intensity'], 20000)
+
+    def test_no_resume(self):
+        self.assertIsNone(self.handler._read_checkpoint())
+        # too old
+        self._write_checkpoint(time.time() - (self.handler.RESUME_WITHIN_HOURS + 1) * 60**2)
+        self.assertIsNone(self.handler._read_checkpoint())
+        # already completed
+        self._write_checkpoint(time.time())
+        self.handler.experiment_metadata['timepoints'].append(self.handler.timepoint_prefix)
+        self.assertIsNone(self.handler._read_checkpoint())
+
+if __name__ == '__main__':
+    unittest.main()
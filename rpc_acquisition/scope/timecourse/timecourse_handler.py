@@ -29,6 +29,7 @@ import time
 from . import base_handler
 from ..client_util import autofocus
 from ..client_util import calibrate
+from ..client_util import focal_surface
 
 from ..util.threaded_image_io import COMPRESSION
 
@@ -87,13 +88,43 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
     FINE_FOCUS_STEPS = 75
     PIXEL_READOUT_RATE = '100 MHz'
     USE_LAST_FOCUS_POSITION = True
+    # Predict each position's focal plane from the focus drift measured at the
+    # positions already acquired this timepoint, and narrow (or skip) the coarse
+    # autofocus accordingly. The search range is +/- FOCUS_PREDICTION_SIGMAS
+    # times the estimated uncertainty of the prediction.
+    PREDICT_FOCUS = True
+    FOCUS_PREDICTION_SIGMAS = 4
     INTERVAL_MODE = 'scheduled start'
-    IMAGE_COMPRESSION = COMPRESSION.DEFAULT # useful options include PNG_FAST, PNG_NONE, TIFF_NONE
+    IMAGE_COMPRESSION = COMPRESSION.DEFAULT # useful options include PNG_FAST, PNG_NONE, TIFF_NONE, TIFF_ZSTD, BLOSC_LZ4
+    # (or a dict mapping image names to options, e.g. {'bf.png': COMPRESSION.PNG_FAST, 'gfp.png': COMPRESSION.TIFF_ZSTD}).
+    # Images are saved with the file extension the option requires (e.g. 'gfp.tiff' for TIFF_ZSTD).
     LOG_LEVEL = logging.INFO
     # Set the following to have the script set the microscope apertures as desired:
     TL_FIELD_DIAPHRAGM = None
     TL_APERTURE_DIAPHRAGM = None
     IL_FIELD_WHEEL = None
+    # Set the following to have the server multiply each image by a flat-field
+    # image: the brightfield flat-field for the brightfield image, and the
+    # fluorescent flat-field (if FLUORESCENCE_FLATFIELD_LAMP is set) for all
+    # additional acquisition steps. Otherwise, only dark-current correction is
+    # applied, and flat-field correction is left to downstream analysis.
+    APPLY_FLATFIELD = False
+    # Dark-current images are stored in DARK_LIBRARY_DIR (by default, the
+    # 'dark_library' directory inside the experiment's 'calibrations' directory)
+    # and reused by later timepoints with the same camera configuration and
+    # sensor temperature band, until they are DARK_LIBRARY_MAX_AGE_HOURS old.
+    DARK_LIBRARY_DIR = None
+    DARK_LIBRARY_MAX_AGE_HOURS = 24
+    DARK_LIBRARY_TEMPERATURE_BAND = 2 # degrees C
+    # Reuse the previous timepoint's vignette mask if the newly-thresholded one
+    # is nearly identical, skipping the (slow) hole-filling step.
+    REUSE_PREVIOUS_VIGNETTE_MASK = True
+    # Set to a function defined at module level, to be called as
+    # SKIP_FUNCTION(images, position_dir, position_metadata) instead of
+    # should_skip(). If ANALYSIS_PROCESSES is nonzero, it is run in a worker
+    # process while acquisition continues (see add_analysis_job()), and
+    # positions are skipped starting from the next timepoint.
+    SKIP_FUNCTION = None
 
     def configure_additional_acquisition_steps(self):
         """Add more steps to the acquisition_sequencer's sequence as desired,
@@ -123,12 +154,14 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
 
     def should_skip(self, position_dir, position_metadata, images):
         """Return whether this position should be skipped for future timepoints.
+        (Not called if SKIP_FUNCTION is set.)
 
         Parameters:
             position_dir: pathlib.Path object representing the directory where
                 position-specific data files and outputs are written. Useful for
-                reading previous image data.
-            position_metadata: list of all the stored position metadata from the
+                reading previous image data. (If IMAGE_STORE is True, previous
+                images are instead available from self.image_store.)
+            position_metadata: sequence of all the stored position metadata from the
                 previous timepoints, in chronological order.
             images: list of images acquired at this timepoint.
 
@@ -140,6 +173,19 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
 
 
     # Internal implementation functions are below. Override with care.
+    def run_timepoint(self, scheduled_start):
+        try:
+            return super().run_timepoint(scheduled_start)
+        finally:
+            # the server-side image correction uses this timepoint's calibrations: don't
+            # leave it applied to images acquired by anyone else before the next timepoint
+            if self.scope is not None:
+                try:
+                    self.scope.camera.acquisition_sequencer.disable_image_correction()
+                except Exception:
+                    # e.g. the connection to the scope was lost: don't mask the original error
+                    self.logger.warning('Could not disable server-side image correction', exc_info=True)
+
     def configure_timepoint(self):
         t0 = time.time()
         self.logger.info('Configuring acquisitions')
@@ -166,16 +212,36 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
         self.scope.camera.readout_rate = self.PIXEL_READOUT_RATE
         self.scope.camera.shutter_mode = 'Rolling'
         self.configure_calibrations() # sets self.bf_exposure and self.tl_intensity
+        self.focal_surface = focal_surface.FocalSurfacePredictor(self.positions)
+        if self.resumed_state is not None:
+            # continue to predict focus from the positions acquired before the interruption
+            self.focal_surface.drifts = self.resumed_state['focus_drifts']
+            self.focal_surface.errors = self.resumed_state['focus_errors']
         self.scope.camera.acquisition_sequencer.new_sequence(**{lamp:255 for lamp in lamps}) # set all Spectra X lamps to max. No reason to use less light!
         self.scope.camera.acquisition_sequencer.add_step(exposure_ms=self.bf_exposure,
             tl_enabled=True, tl_intensity=self.tl_intensity, lamp_off_delay=25) # delay is in microseconds
         self.image_names = ['bf.png']
         self.configure_additional_acquisition_steps()
+        flat_fields = None
+        if self.APPLY_FLATFIELD:
+            flat_fields = [self.bf_flatfield] + [self.fl_flatfield] * (len(self.image_names) - 1)
+        calibrate.enable_server_image_correction(self.scope, self.dark_corrector, flat_fields)
         t1 = time.time()
         self.logger.debug('Configuration done ({:.1f} seconds)', t1-t0)
 
     def configure_calibrations(self):
-        self.dark_corrector = calibrate.DarkCurrentCorrector(self.scope)
+        if self.DARK_LIBRARY_DIR is None:
+            library_dir = self.data_dir / 'calibrations' / 'dark_library'
+        else:
+            library_dir = self.DARK_LIBRARY_DIR
+        dark_library = calibrate.DarkCurrentLibrary(library_dir, self.DARK_LIBRARY_MAX_AGE_HOURS,
+            self.DARK_LIBRARY_TEMPERATURE_BAND, read_only=not self.write_files)
+        self.dark_corrector = calibrate.DarkCurrentCorrector(self.scope, library=dark_library)
+        self.logger.info('Dark-current images: {} reused, {} acquired (spot-check difference: {})',
+            dark_library.reused_count, dark_library.acquired_count, dark_library.spot_check_difference)
+        if self.resumed_state is not None:
+            self._restore_calibrations(self.resumed_state)
+            return
         ref_positions = self.experiment_metadata['reference_positions']
 
         # go to a data-acquisition position and figure out the right brightfield exposure
@@ -193,13 +259,14 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
             exposure_ratio = self.bf_exposure / exposure
             bf_avg = calibrate.get_averaged_images(self.scope, ref_positions,
                 self.dark_corrector, frames_to_average=2)
-        self.vignette_mask = calibrate.get_vignette_mask(bf_avg)
-        bf_flatfield, ref_intensity = calibrate.get_flat_field(bf_avg, self.vignette_mask)
+        self.vignette_mask = calibrate.get_vignette_mask(bf_avg, self._read_previous_vignette_mask())
+        self.bf_flatfield, ref_intensity = calibrate.get_flat_field(bf_avg, self.vignette_mask)
         ref_intensity *= exposure_ratio
         cal_image_names = ['vignette_mask.png', 'bf_flatfield.tiff']
-        cal_images = [self.vignette_mask.astype(numpy.uint8)*255, bf_flatfield]
+        cal_images = [self.vignette_mask.astype(numpy.uint8)*255, self.bf_flatfield]
 
         # calculate a fluorescent flatfield if requested
+        self.fl_flatfield = None
         if self.FLUORESCENCE_FLATFIELD_LAMP:
             self.scope.stage.position = ref_positions[0]
             lamp = getattr(self.scope.il.spectra_x, self.FLUORESCENCE_FLATFIELD_LAMP)
@@ -208,9 +275,9 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
                     min_intensity_fraction=0.1)
                 fl_avg = calibrate.get_averaged_images(self.scope, ref_positions,
                     self.dark_corrector, frames_to_average=5)
-            fl_flatfield, fl_intensity = calibrate.get_flat_field(fl_avg, self.vignette_mask)
+            self.fl_flatfield, fl_intensity = calibrate.get_flat_field(fl_avg, self.vignette_mask)
             cal_image_names.append('fl_flatfield.tiff')
-            cal_images.append(fl_flatfield)
+            cal_images.append(self.fl_flatfield)
 
         # save out calibration information
         calibration_dir = self.data_dir / 'calibrations'
@@ -223,6 +290,44 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
         metering[self.timepoint_prefix] = dict(exposure=self.bf_exposure, intensity=self.tl_intensity, ref_intensity=ref_intensity)
         self.scope.camera.exposure_time = self.bf_exposure
 
+    def _restore_calibrations(self, state):
+        """Restore the calibrations made before a resumed timepoint was
+        interrupted, from the saved state and calibration images."""
+        self.bf_exposure, self.tl_intensity = state['bf_exposure'], state['tl_intensity']
+        cal_image_names = ['vignette_mask.png', 'bf_flatfield.tiff']
+        if self.FLUORESCENCE_FLATFIELD_LAMP:
+            cal_image_names.append('fl_flatfield.tiff')
+        calibration_dir = self.data_dir / 'calibrations'
+        # image_io.read() returns an iterator
+        cal_images = list(self.image_io.read([calibration_dir / (self.timepoint_prefix + ' ' + name) for name in cal_image_names]))
+        self.vignette_mask = cal_images[0] > 0
+        self.bf_flatfield = cal_images[1]
+        self.fl_flatfield = cal_images[2] if self.FLUORESCENCE_FLATFIELD_LAMP else None
+        metering = self.experiment_metadata.setdefault('brightfield metering', {})
+        metering[self.timepoint_prefix] = state['brightfield metering']
+        self.scope.camera.exposure_time = self.bf_exposure
+        self.logger.info('Reusing calibrations from before the interruption')
+
+    def get_timepoint_state(self):
+        return {
+            'bf_exposure': self.bf_exposure,
+            'tl_intensity': self.tl_intensity,
+            'brightfield metering': self.experiment_metadata['brightfield metering'][self.timepoint_prefix],
+            'focus_drifts': list(self.focal_surface.drifts),
+            'focus_errors': list(self.focal_surface.errors)
+        }
+
+    def _read_previous_vignette_mask(self):
+        """Return the vignette mask saved at the previous timepoint, or None if
+        unavailable (or not to be reused)."""
+        timepoints = self.experiment_metadata['timepoints']
+        if self.REUSE_PREVIOUS_VIGNETTE_MASK and self.write_files and len(timepoints) > 1:
+            path = self.data_dir / 'calibrations' / (timepoints[-2] + ' vignette_mask.png')
+            if path.exists():
+                mask, = self.image_io.read([path])
+                return mask > 0
+        return None
+
     def get_next_run_time(self):
         interval_mode = self.INTERVAL_MODE
         assert interval_mode in {'scheduled start', 'actual start', 'end'}
@@ -250,29 +355,67 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
             start = self.end_time
         return start + interval_seconds
 
+    def _at_fine_focus_edge(self, coarse_z, fine_z, z_max):
+        """Return whether fine_z is within one step of either end of the fine
+        autofocus range around coarse_z."""
+        step = self.FINE_FOCUS_RANGE / (self.FINE_FOCUS_STEPS - 1)
+        start = coarse_z - self.FINE_FOCUS_RANGE / 2
+        end = min(coarse_z + self.FINE_FOCUS_RANGE / 2, z_max)
+        return fine_z - start < step or end - fine_z < step
+
     def acquire_images(self, position_name, position_dir, position_metadata):
         t0 = time.time()
-        if self.USE_LAST_FOCUS_POSITION and position_metadata:
-            z_start = position_metadata[-1]['fine_z']
+        focus_history = position_metadata if self.USE_LAST_FOCUS_POSITION else []
+        coarse_range, coarse_steps = self.COARSE_FOCUS_RANGE, self.COARSE_FOCUS_STEPS
+        if self.PREDICT_FOCUS:
+            z_start, z_uncertainty = self.focal_surface.predict(position_name, focus_history)
+            if z_uncertainty is not None:
+                search_range = 2 * self.FOCUS_PREDICTION_SIGMAS * z_uncertainty
+                if search_range <= self.FINE_FOCUS_RANGE:
+                    coarse_range = None
+                elif search_range < self.COARSE_FOCUS_RANGE:
+                    # keep the same coarse step size over the narrower range
+                    coarse_steps = max(5, int(numpy.ceil(coarse_steps * search_range / coarse_range)))
+                    coarse_range = search_range
         else:
-            z_start = self.positions[position_name][2]
+            z_start = self.focal_surface.get_base_z(position_name, focus_history)[0]
         z_max = self.experiment_metadata['z_max']
         self.scope.camera.exposure_time = self.bf_exposure
         self.scope.tl.lamp.intensity = self.tl_intensity
         coarse_z, fine_z = autofocus.autofocus(self.scope, z_start, z_max,
-            self.COARSE_FOCUS_RANGE, self.COARSE_FOCUS_STEPS,
+            coarse_range, coarse_steps,
             self.FINE_FOCUS_RANGE, self.FINE_FOCUS_STEPS)
+        if coarse_range != self.COARSE_FOCUS_RANGE and self._at_fine_focus_edge(coarse_z, fine_z, z_max):
+            # the prediction was probably wrong: the focal plane may be outside the fine range
+            self.logger.info('Fine focus at edge of range (z {}): repeating with full coarse range', fine_z)
+            coarse_range, coarse_steps = self.COARSE_FOCUS_RANGE, self.COARSE_FOCUS_STEPS
+            coarse_z, fine_z = autofocus.autofocus(self.scope, z_start, z_max,
+                coarse_range, coarse_steps,
+                self.FINE_FOCUS_RANGE, self.FINE_FOCUS_STEPS)
         t1 = time.time()
         self.logger.debug('Autofocused ({:.1f} seconds)', t1-t0)
-        self.logger.info('Autofocus z: {}', fine_z)
-        images = self.scope.camera.acquisition_sequencer.run()
+        prediction_error = self.focal_surface.add_observation(position_name, focus_history, z_start, fine_z)
+        self.logger.info('Autofocus z: {} (predicted {:.4f}, error {:.4f} mm, coarse range {})', fine_z, z_start,
+            prediction_error, coarse_range)
+        # images are dark-corrected on the server, and each is transferred while the next is exposed
+        images, timestamps = [], []
+        for image, timestamp, step_index, exposure in self.scope.camera.acquisition_sequencer.iter_run():
+            images.append(image)
+            timestamps.append(timestamp)
         t2 = time.time()
         self.logger.debug('Acquisition sequence run ({:.1f} seconds)', t2-t1)
-        exposures = self.scope.camera.acquisition_sequencer.exposure_times
-        images = [self.dark_corrector.correct(image, exposure) for image, exposure in zip(images, exposures)]
-        timestamps = numpy.array(self.scope.camera.acquisition_sequencer.latest_timestamps)
+        timestamps = numpy.array(timestamps)
         timestamps = (timestamps - timestamps[0]) / self.scope.camera.timestamp_hz
-        metadata = dict(coarse_z=coarse_z, fine_z=fine_z, image_timestamps=dict(zip(self.image_names, timestamps)))
-        if self.should_skip(position_dir, position_metadata, images):
-            self.skip_positions.append(position_name)
+        metadata = dict(coarse_z=coarse_z, fine_z=fine_z, predicted_z=z_start, coarse_focus_range=coarse_range,
+            image_timestamps=dict(zip(self.image_names, timestamps)))
+        if self.SKIP_FUNCTION is None:
+            if self.should_skip(position_dir, position_metadata, images):
+                self.skip_positions.add(position_name)
+        else:
+            def analysis_done(skip):
+                if skip:
+                    self.skip_positions.add(position_name)
+            # get the function from the class, so that it is not bound as a method
+            self.add_analysis_job(type(self).SKIP_FUNCTION, images, position_dir, position_metadata,
+                callback=analysis_done, name=position_name)
         return images, self.image_names, metadata
@@ -0,0 +1,135 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+import collections
+import concurrent.futures as futures
+import itertools
+import os
+import time
+
+import ism_buffer
+import numpy
+
+JobTiming = collections.namedtuple('JobTiming', ('name', 'queued_seconds', 'run_seconds'))
+
+def _run_job(function, buffer_names, args, kws):
+    # runs in a worker process: the images are read directly from shared memory
+    t0 = time.time()
+    images = [ism_buffer.open(buffer_name).asarray() for buffer_name in buffer_names]
+    result = function(images, *args, **kws)
+    return result, t0, time.time() - t0
+
+_Job = collections.namedtuple('_Job', ('name', 'future', 'callback', 'submit_time', 'shared_images'))
+
+_buffer_counter = itertools.count()
+
+class AnalysisPool:
+    """Run image-analysis functions in a pool of worker processes, so that
+    analysis is not limited by the GIL and does not hold up acquisition.
+
+    Images are copied into ISM_Buffer shared memory, which the workers open
+    by name: the pixel data are never pickled. (The analysis functions and
+    their other arguments and results are pickled, so the functions must be
+    defined at module level.)
+
+    Results are not delivered in a background thread: callbacks are called
+    from the thread that calls submit(), deliver_results() or wait(), in the
+    order that the jobs were submitted. So callbacks may safely modify state
+    used by that thread (e.g. a timecourse handler's skip_positions).
+    """
+    def __init__(self, num_processes, max_jobs=None):
+        """Parameters:
+            num_processes: number of worker processes.
+            max_jobs: maximum number of jobs that may be queued or running.
+                When this many are pending, submit() waits for the oldest to
+                finish (and delivers its result) before submitting another.
+                If None, twice the number of processes.
+        """
+        self.pool = futures.ProcessPoolExecutor(num_processes)
+        self.max_jobs = 2 * num_processes if max_jobs is None else max_jobs
+        self.timings = []
+        self._jobs = collections.deque()
+        self._errors = []
+
+    def submit(self, function, images, *args, callback=None, name=None, **kws):
+        """Queue function(images, *args, **kws) to run in a worker process,
+        where images is a list of arrays in shared memory.
+
+        If specified, callback(result) will be called with the function's
+        return value once it completes (see the class documentation). The
+        timing of each job is appended to self.timings as a JobTiming tuple,
+        under the given name.
+        """
+        while len(self._jobs) >= self.max_jobs:
+            self._deliver_oldest()
+        shared_images = []
+        buffer_names = []
+        for image in images:
+            image = numpy.asarray(image)
+            order = 'F' if image.flags.f_contiguous and not image.flags.c_contiguous else 'C'
+            buffer_name = 'analysis@{}:{}'.format(os.getpid(), next(_buffer_counter))
+            shared_image = ism_buffer.new(buffer_name, image.shape, image.dtype, order).asarray()
+            shared_image[...] = image
+            # keep a reference to shared_image, so that the shared memory is retained
+            # until the job is done with it
+            shared_images.append(shared_image)
+            buffer_names.append(buffer_name)
+        submit_time = time.time()
+        future = self.pool.submit(_run_job, function, buffer_names, args, kws)
+        self._jobs.append(_Job(name, future, callback, submit_time, shared_images))
+
+    def deliver_results(self):
+        """Call the callbacks for the jobs that have completed, without waiting
+        for any others."""
+        while self._jobs and self._jobs[0].future.done():
+            self._deliver_oldest()
+
+    def _deliver_oldest(self):
+        # wait for the oldest job (if necessary) and call its callback
+        job = self._jobs.popleft()
+        try:
+            result, start_time, run_seconds = job.future.result()
+        except Exception as e:
+            self._errors.append(e)
+            return
+        self.timings.append(JobTiming(job.name, start_time - job.submit_time, run_seconds))
+        if job.callback is not None:
+            try:
+                job.callback(result)
+            except Exception as e:
+                self._errors.append(e)
+
+    def wait(self):
+        """Wait for all submitted jobs to complete and deliver their results.
+        Raise the first exception encountered by a job or callback, if any."""
+        while self._jobs:
+            self._deliver_oldest()
+        errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
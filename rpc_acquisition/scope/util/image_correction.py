@@ -0,0 +1,149 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+import collections
+import concurrent.futures as futures
+import numpy
+
+def interpolate_dark_image(exposures, dark_images, exposure_ms):
+    """Return the dark-current image for a given exposure time, linearly
+    interpolated from dark images acquired at a sorted list of exposure times.
+
+    Parameters:
+        exposures: sorted list of exposure times (in ms) of the dark images.
+        dark_images: list of dark-current images, one per exposure.
+        exposure_ms: the full length of time the camera was exposing.
+
+    Returns: uint16 dark-current image.
+    """
+    if exposure_ms < exposures[0] or exposure_ms > exposures[-1]:
+        raise ValueError('Exposure time is outside of the calibration range')
+    i = numpy.searchsorted(exposures, exposure_ms)
+    if exposure_ms == exposures[i]:
+        dark_image = dark_images[i]
+    else:
+        before_exp, after_exp = exposures[i-1], exposures[i]
+        before_img, after_img = dark_images[i-1], dark_images[i]
+        a = (exposure_ms - before_exp) / (after_exp - before_exp)
+        dark_image = (1-a) * before_img + a * after_img
+    return dark_image.round().astype(numpy.uint16)
+
+def _chunk_slices(array, num_chunks):
+    """Yield index tuples that split an array into num_chunks pieces, each of
+    which is a contiguous block of memory if the array is itself contiguous."""
+    axis = array.ndim - 1 if array.flags.f_contiguous and not array.flags.c_contiguous else 0
+    bounds = numpy.linspace(0, array.shape[axis], num_chunks+1).astype(int)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if start == stop:
+            continue
+        index = [slice(None)] * array.ndim
+        index[axis] = slice(start, stop)
+        yield tuple(index)
+
+def _correct_chunk(image, dark_image, flat_field, out):
+    # max(image, dark) - dark is a saturating subtraction that can't wrap around
+    numpy.maximum(image, dark_image, out=out)
+    numpy.subtract(out, dark_image, out=out)
+    if flat_field is not None:
+        scratch = numpy.multiply(out, flat_field, dtype=numpy.float32)
+        numpy.clip(scratch, 0, numpy.iinfo(out.dtype).max, out=scratch)
+        numpy.rint(scratch, out=scratch)
+        numpy.copyto(out, scratch, casting='unsafe')
+
+def correct_image(image, dark_image, flat_field=None, out=None, threadpool=None, num_chunks=1):
+    """Subtract a dark-current image from an image and optionally multiply the
+    result by a flat-field image, clipping the output to the range of the image
+    dtype.
+
+    No full-size temporary arrays are allocated: the dark-current subtraction is
+    done in the output array directly, and flat-fielding uses only a float32
+    scratch buffer the size of one chunk.
+
+    Parameters:
+        image: unsigned integer image to correct.
+        dark_image: dark-current image of the same shape and dtype.
+        flat_field: None, or a floating-point flat-field image of the same shape.
+        out: output array. If None, a new array is allocated; pass image itself
+            to correct in place.
+        threadpool: if not None, a concurrent.futures executor used to correct
+            chunks of the image in parallel. (Numpy releases the GIL for these
+            operations, so threads give a real speedup.)
+        num_chunks: number of pieces to split the image into.
+
+    Returns: corrected image (out, if provided).
+    """
+    if out is None:
+        out = numpy.empty_like(image)
+    if threadpool is None or num_chunks < 2:
+        _correct_chunk(image, dark_image, flat_field, out)
+        return out
+    jobs = []
+    for index in _chunk_slices(out, num_chunks):
+        chunk_flat_field = None if flat_field is None else flat_field[index]
+        jobs.append(threadpool.submit(_correct_chunk, image[index], dark_image[index], chunk_flat_field, out[index]))
+    for job in jobs:
+        job.result()
+    return out
+
+class ImageCorrector:
+    """Apply dark-current and flat-field corrections to images using a pool of
+    threads, with dark images interpolated for arbitrary exposure times."""
+    def __init__(self, exposures, dark_images, num_threads=4, max_cached=8):
+        """Parameters:
+            exposures: sorted list of exposure times (in ms) of the dark images.
+            dark_images: list of dark-current images, one per exposure.
+            num_threads: number of threads to split each correction across.
+            max_cached: number of interpolated dark images to keep (the least
+                recently used are discarded first).
+        """
+        self.exposures = numpy.asarray(exposures, dtype=float)
+        self.dark_images = dark_images
+        self.num_threads = num_threads
+        self.max_cached = max_cached
+        self.threadpool = futures.ThreadPoolExecutor(num_threads)
+        self._dark_cache = collections.OrderedDict()
+
+    def get_dark_image(self, exposure_ms):
+        """Return the dark-current image for the given exposure time. The
+        interpolated images are cached, as the same exposures are generally
+        used over and over. (The returned image must not be modified.)"""
+        dark_image = self._dark_cache.get(exposure_ms)
+        if dark_image is None:
+            dark_image = interpolate_dark_image(self.exposures, self.dark_images, exposure_ms)
+            self._dark_cache[exposure_ms] = dark_image
+            if len(self._dark_cache) > self.max_cached:
+                self._dark_cache.popitem(last=False)
+        else:
+            self._dark_cache.move_to_end(exposure_ms)
+        return dark_image
+
+    def correct(self, image, exposure_ms, flat_field=None, out=None):
+        """Correct an image acquired with the given full exposure time (see
+        correct_image() for details)."""
+        return correct_image(image, self.get_dark_image(exposure_ms), flat_field, out,
+            self.threadpool, self.num_threads)
+
+    def shutdown(self):
+        self.threadpool.shutdown(wait=False)
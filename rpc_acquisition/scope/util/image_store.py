@@ -0,0 +1,210 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+"""Store the images from a timecourse experiment in a few large files per
+position, rather than in one file per image per timepoint.
+
+For each position and channel (e.g. 'bf' or 'gfp'), frames are appended to a
+series of chunk files of up to FRAMES_PER_CHUNK frames each, and described
+by an index (a metadata_journal.RecordJournal) that records the timepoint,
+location, shape, dtype and compression of each frame. Frames are compressed
+individually (so any single frame can be read directly), or stored raw, in
+which case they are read as memory-mapped arrays.
+
+Layout:
+    <data_dir>/<position>/image_store/<channel>/index.jsonl
+    <data_dir>/<position>/image_store/<channel>/00000.frames, 00001.frames, ...
+"""
+
+import os
+import pathlib
+import zlib
+
+import numpy
+
+from . import metadata_journal
+from . import threaded_image_io
+
+FRAMES_PER_CHUNK = 100
+
+def _compress(data, compression, itemsize):
+    if compression is None:
+        return data
+    elif compression == 'blosc':
+        import blosc
+        return blosc.compress(data, typesize=itemsize, clevel=5, shuffle=blosc.BITSHUFFLE, cname='lz4')
+    elif compression == 'zlib':
+        return zlib.compress(data, 1)
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+def _decompress(data, compression):
+    if compression is None:
+        return data
+    elif compression == 'blosc':
+        import blosc
+        return blosc.decompress(data)
+    elif compression == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+def _default_compression():
+    try:
+        import blosc
+        return 'blosc'
+    except ImportError:
+        return 'zlib'
+
+class ImageStore:
+    """Append-only store of timecourse images, indexed by position, channel and
+    timepoint."""
+    def __init__(self, data_dir, compression='default', frames_per_chunk=FRAMES_PER_CHUNK):
+        """Parameters:
+            data_dir: experiment directory (containing the position directories).
+            compression: compression for newly-added frames: 'blosc' (fast;
+                requires the blosc package), 'zlib', or None (frames can then be
+                memory-mapped when read). 'default' uses blosc if available,
+                otherwise zlib.
+            frames_per_chunk: maximum number of frames per chunk file.
+        """
+        self.data_dir = pathlib.Path(data_dir)
+        self.compression = _default_compression() if compression == 'default' else compression
+        self.frames_per_chunk = frames_per_chunk
+        self._indices = {}
+
+    def _channel_dir(self, position, channel):
+        return self.data_dir / position / 'image_store' / channel
+
+    def _get_index(self, position, channel):
+        key = position, channel
+        if key not in self._indices:
+            self._indices[key] = metadata_journal.RecordJournal(self._channel_dir(position, channel) / 'index.jsonl')
+        return self._indices[key]
+
+    def positions(self):
+        """Return a sorted list of the positions with stored images."""
+        return sorted(path.parent.name for path in self.data_dir.glob('*/image_store'))
+
+    def channels(self, position):
+        """Return a sorted list of the channels stored for a position."""
+        return sorted(path.parent.name for path in (self.data_dir / position / 'image_store').glob('*/index.jsonl'))
+
+    def timepoints(self, position, channel):
+        """Return the list of timepoints stored for a position and channel, in order."""
+        return [record['timepoint'] for record in self._get_index(position, channel)]
+
+    def contains(self, position, channel, timepoint):
+        """Return whether an image is stored for the given position, channel and timepoint."""
+        return self._get_index(position, channel).find(timepoint, key='timepoint') is not None
+
+    def append(self, position, channel, timepoint, image):
+        """Add an image to the store. Timepoints must be added in increasing
+        (i.e. sorted) order for each position and channel."""
+        image = numpy.asarray(image)
+        index = self._get_index(position, channel)
+        latest = index.latest()
+        if latest is not None and timepoint <= latest['timepoint']:
+            raise ValueError('Timepoint {} is not after the latest stored timepoint {}'.format(timepoint, latest['timepoint']))
+        chunk = len(index) // self.frames_per_chunk
+        channel_dir = self._channel_dir(position, channel)
+        if not channel_dir.exists():
+            channel_dir.mkdir(parents=True)
+        order = 'F' if image.flags.f_contiguous and not image.flags.c_contiguous else 'C'
+        data = _compress(image.tobytes(order), self.compression, image.dtype.itemsize)
+        chunk_path = channel_dir / '{:05d}.frames'.format(chunk)
+        # The frame data are written (and fsynced) before the index entry, so a
+        # crash can at worst leave unindexed (and thus ignored) data at the end
+        # of the chunk.
+        new_chunk = not chunk_path.exists()
+        with chunk_path.open('ab') as f:
+            offset = f.seek(0, 2)
+            if self.compression is None:
+                # align raw frames so that they can be memory-mapped efficiently
+                padding = -offset % 64
+                f.write(b'\0' * padding)
+                offset += padding
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if new_chunk:
+            # make the new file's directory entry durable too
+            threaded_image_io._fsync_paths([chunk_path])
+        index.append(dict(timepoint=timepoint, chunk=chunk, offset=offset, nbytes=len(data),
+            shape=image.shape, dtype=image.dtype.str, order=order, compression=self.compression))
+
+    def _read_record(self, position, channel, record):
+        chunk_path = self._channel_dir(position, channel) / '{:05d}.frames'.format(record['chunk'])
+        dtype = numpy.dtype(record['dtype'])
+        if record['compression'] is None:
+            return numpy.memmap(str(chunk_path), dtype=dtype, mode='r', offset=record['offset'],
+                shape=tuple(record['shape']), order=record['order'])
+        with chunk_path.open('rb') as f:
+            f.seek(record['offset'])
+            data = _decompress(f.read(record['nbytes']), record['compression'])
+        return numpy.frombuffer(data, dtype=dtype).reshape(record['shape'], order=record['order'])
+
+    def read(self, position, channel, timepoint):
+        """Return the image for the given position, channel and timepoint."""
+        index = self._get_index(position, channel)
+        i = index.find(timepoint, key='timepoint')
+        if i is None:
+            raise KeyError('No {} image for position {} at timepoint {}'.format(channel, position, timepoint))
+        return self._read_record(position, channel, index[i])
+
+    def iter_channel(self, position, channel, start=None, end=None):
+        """Yield (timepoint, image) pairs for a position and channel, in order,
+        optionally only for timepoints in the range [start, end)."""
+        index = self._get_index(position, channel)
+        for record in index.between(start, end, key='timepoint'):
+            yield record['timepoint'], self._read_record(position, channel, record)
+
+def export_pngs(store, out_dir, positions=None, channels=None, compression=threaded_image_io.COMPRESSION.DEFAULT, io_threads=4):
+    """Write the images in an ImageStore out as individual files, named as
+    TimepointHandler names them: <out_dir>/<position>/<timepoint> <channel>.png
+
+    Parameters:
+        store: ImageStore instance
+        out_dir: directory to write to (may be the experiment directory itself).
+        positions: list of positions to export; if None, export all.
+        channels: list of channels to export; if None, export all.
+        compression: threaded_image_io.COMPRESSION value.
+        io_threads: number of threads to write with.
+    """
+    out_dir = pathlib.Path(out_dir)
+    image_io = threaded_image_io.ThreadedIO(io_threads)
+    if positions is None:
+        positions = store.positions()
+    for position in positions:
+        position_dir = out_dir / position
+        if not position_dir.exists():
+            position_dir.mkdir(parents=True)
+        for channel in (store.channels(position) if channels is None else channels):
+            images, paths = [], []
+            for timepoint, image in store.iter_channel(position, channel):
+                images.append(image)
+                paths.append(position_dir / '{} {}.png'.format(timepoint, channel))
+                if len(images) == io_threads:
+                    image_io.write(images, paths, compression)
+                    images, paths = [], []
+            image_io.write(images, paths, compression)
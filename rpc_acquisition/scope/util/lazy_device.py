@@ -0,0 +1,76 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+import functools
+import inspect
+import threading
+
+class LazyDevice:
+    """Stand-in for a device that is only constructed when first used.
+
+    Before the device is constructed, the stand-in exposes the public methods
+    of device_class (with their signatures and docstrings, so that RPC clients
+    can be built against it); calling any of them, or accessing any other
+    attribute of the device, constructs the device by calling factory().
+    Attributes that the device creates in its __init__ are therefore not
+    visible until after the first use.
+    """
+    def __init__(self, device_class, factory):
+        self._device_class = device_class
+        self._factory = factory
+        self._device = None
+        self._init_lock = threading.Lock()
+
+    def _get_device(self):
+        with self._init_lock:
+            if self._device is None:
+                self._device = self._factory()
+            return self._device
+
+    def _make_deferred_method(self, name):
+        unbound = getattr(self._device_class, name)
+        @functools.wraps(unbound)
+        def deferred_method(*args, **kwargs):
+            return getattr(self._get_device(), name)(*args, **kwargs)
+        # present the signature of the bound method (i.e. without 'self')
+        signature = inspect.signature(unbound)
+        deferred_method.__signature__ = signature.replace(parameters=list(signature.parameters.values())[1:])
+        del deferred_method.__wrapped__
+        return deferred_method
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the LazyDevice itself
+        if self._device is not None:
+            return getattr(self._device, name)
+        if name.startswith('_') or not inspect.isfunction(getattr(self._device_class, name, None)):
+            # don't construct the device just because someone is checking
+            # for an attribute the device class doesn't advertise
+            raise AttributeError(name)
+        return self._make_deferred_method(name)
+
+    def __dir__(self):
+        if self._device is not None:
+            return dir(self._device)
+        return [name for name in dir(self._device_class) if not name.startswith('_')]
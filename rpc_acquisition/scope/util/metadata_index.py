@@ -0,0 +1,250 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+"""SQLite index of timecourse experiment metadata, for queries across
+positions, timepoints and experiments without parsing every metadata file.
+
+TimepointHandler adds to the index as it runs; index_experiment() adds (or
+refreshes) the records for an existing experiment directory. A single index
+file may cover many experiments.
+"""
+
+import json
+import pathlib
+import sqlite3
+import threading
+
+from . import image_store
+from . import json_encode
+from . import metadata_journal
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timepoints (
+    experiment_id INTEGER NOT NULL REFERENCES experiments(id),
+    timepoint TEXT NOT NULL,
+    scheduled_start REAL,
+    start REAL,
+    duration REAL,
+    PRIMARY KEY (experiment_id, timepoint)
+);
+CREATE TABLE IF NOT EXISTS acquisitions (
+    experiment_id INTEGER NOT NULL REFERENCES experiments(id),
+    position TEXT NOT NULL,
+    timepoint TEXT NOT NULL,
+    timestamp REAL,
+    coarse_z REAL,
+    fine_z REAL,
+    predicted_z REAL,
+    metadata TEXT,
+    PRIMARY KEY (experiment_id, position, timepoint)
+);
+CREATE TABLE IF NOT EXISTS images (
+    experiment_id INTEGER NOT NULL REFERENCES experiments(id),
+    position TEXT NOT NULL,
+    timepoint TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT,
+    PRIMARY KEY (experiment_id, position, timepoint, name)
+);
+CREATE TABLE IF NOT EXISTS metering (
+    experiment_id INTEGER NOT NULL REFERENCES experiments(id),
+    timepoint TEXT NOT NULL,
+    exposure REAL,
+    intensity REAL,
+    ref_intensity REAL,
+    PRIMARY KEY (experiment_id, timepoint)
+);
+CREATE TABLE IF NOT EXISTS skips (
+    experiment_id INTEGER NOT NULL REFERENCES experiments(id),
+    position TEXT NOT NULL,
+    last_timepoint TEXT,
+    PRIMARY KEY (experiment_id, position)
+);
+CREATE INDEX IF NOT EXISTS acquisitions_by_position ON acquisitions (position, timepoint);
+"""
+
+class MetadataIndex:
+    """Index of experiment metadata stored in an SQLite database file.
+
+    All methods may be called from any thread. Experiments are identified by
+    their data directory (relative paths are resolved).
+    """
+    def __init__(self, db_path):
+        self.db_path = pathlib.Path(db_path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._experiment_ids = {}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _experiment_id(self, data_dir):
+        path = str(pathlib.Path(data_dir).resolve())
+        if path not in self._experiment_ids:
+            self._connection.execute('INSERT OR IGNORE INTO experiments (path) VALUES (?)', (path,))
+            self._experiment_ids[path], = self._connection.execute('SELECT id FROM experiments WHERE path = ?', (path,)).fetchone()
+        return self._experiment_ids[path]
+
+    def add_acquisition(self, data_dir, position, timepoint, metadata, image_paths=()):
+        """Record the metadata (as stored in the position metadata journal) for
+        one position at one timepoint, and the paths of the images acquired
+        (or, for images in an ImageStore, (name, None) pairs)."""
+        with self._lock, self._connection:
+            experiment_id = self._experiment_id(data_dir)
+            self._connection.execute('INSERT OR REPLACE INTO acquisitions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (experiment_id, position, timepoint, metadata.get('timestamp'), metadata.get('coarse_z'),
+                metadata.get('fine_z'), metadata.get('predicted_z'), json_encode.COMPACT_ENCODER.encode(metadata)))
+            self._connection.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                [(experiment_id, position, timepoint, name, None if path is None else str(pathlib.Path(path).resolve()))
+                    for name, path in image_paths])
+
+    def add_timepoint(self, data_dir, timepoint, start, duration, scheduled_start=None, metering=None, skip_positions=()):
+        """Record the start time and duration of a timepoint, the brightfield
+        metering results (a dict with 'exposure', 'intensity' and
+        'ref_intensity' keys) if any, and the positions that are to be skipped
+        in future (recorded as skipped after this timepoint, unless they were
+        already skipped earlier)."""
+        with self._lock, self._connection:
+            experiment_id = self._experiment_id(data_dir)
+            self._connection.execute('INSERT OR REPLACE INTO timepoints VALUES (?, ?, ?, ?, ?)',
+                (experiment_id, timepoint, scheduled_start, start, duration))
+            if metering is not None:
+                self._connection.execute('INSERT OR REPLACE INTO metering VALUES (?, ?, ?, ?, ?)',
+                    (experiment_id, timepoint, metering.get('exposure'), metering.get('intensity'), metering.get('ref_intensity')))
+            self._connection.executemany('INSERT OR IGNORE INTO skips VALUES (?, ?, ?)',
+                [(experiment_id, position, timepoint) for position in skip_positions])
+
+    def set_skipped(self, data_dir, position, last_timepoint):
+        """Record that a position was skipped after the given timepoint."""
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO skips VALUES (?, ?, ?)',
+                (self._experiment_id(data_dir), position, last_timepoint))
+
+    def query(self, sql, *parameters):
+        """Run an arbitrary SQL query and return the list of result rows."""
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _experiment_clause(self, data_dir, column='experiment_id'):
+        if data_dir is None:
+            return '1', ()
+        return '{} = (SELECT id FROM experiments WHERE path = ?)'.format(column), (str(pathlib.Path(data_dir).resolve()),)
+
+    def experiments(self):
+        """Return a list of the indexed experiment directories."""
+        return [path for path, in self.query('SELECT path FROM experiments ORDER BY path')]
+
+    def position_history(self, position, data_dir=None, keys=('fine_z',)):
+        """Return a list of (experiment, timepoint, timestamp, values...) rows
+        for a position, in order, where values are those of the given keys in
+        the position's metadata (e.g. 'fine_z' for its autofocus history)."""
+        where, parameters = self._experiment_clause(data_dir, 'a.experiment_id')
+        rows = self.query('SELECT e.path, a.timepoint, a.timestamp, a.metadata FROM acquisitions a '
+            'JOIN experiments e ON e.id = a.experiment_id WHERE a.position = ? AND {} '
+            'ORDER BY e.path, a.timepoint'.format(where), position, *parameters)
+        history = []
+        for path, timepoint, timestamp, metadata in rows:
+            metadata = json.loads(metadata)
+            history.append((path, timepoint, timestamp) + tuple(metadata.get(key) for key in keys))
+        return history
+
+    def skipped_positions(self, data_dir=None):
+        """Return a list of (experiment, position, last_timepoint) rows, where
+        last_timepoint is the last timepoint at which the position was acquired
+        before being skipped."""
+        where, parameters = self._experiment_clause(data_dir, 's.experiment_id')
+        return self.query('SELECT e.path, s.position, s.last_timepoint FROM skips s '
+            'JOIN experiments e ON e.id = s.experiment_id WHERE {} '
+            'ORDER BY e.path, s.last_timepoint, s.position'.format(where), *parameters)
+
+    def timepoint_starts(self, data_dir=None):
+        """Return a list of (experiment, timepoint, scheduled_start, start, delay,
+        duration) rows, where delay is how late (in seconds) the timepoint
+        started, or None if the scheduled start time is not known."""
+        where, parameters = self._experiment_clause(data_dir, 't.experiment_id')
+        return self.query('SELECT e.path, t.timepoint, t.scheduled_start, t.start, t.start - t.scheduled_start, t.duration '
+            'FROM timepoints t JOIN experiments e ON e.id = t.experiment_id WHERE {} '
+            'ORDER BY e.path, t.timepoint'.format(where), *parameters)
+
+    def metering_history(self, data_dir=None):
+        """Return a list of (experiment, timepoint, exposure, intensity, ref_intensity) rows."""
+        where, parameters = self._experiment_clause(data_dir, 'm.experiment_id')
+        return self.query('SELECT e.path, m.timepoint, m.exposure, m.intensity, m.ref_intensity '
+            'FROM metering m JOIN experiments e ON e.id = m.experiment_id WHERE {} '
+            'ORDER BY e.path, m.timepoint'.format(where), *parameters)
+
+    def image_paths(self, data_dir, position=None, timepoint=None, name=None):
+        """Return a list of (position, timepoint, name, path) rows for the images
+        of an experiment, optionally restricted to a given position, timepoint
+        and/or image name. path is None for images in an ImageStore."""
+        where, parameters = self._experiment_clause(data_dir)
+        conditions = [where]
+        for column, value in [('position', position), ('timepoint', timepoint), ('name', name)]:
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                parameters += (value,)
+        return self.query('SELECT position, timepoint, name, path FROM images WHERE {} '
+            'ORDER BY position, timepoint, name'.format(' AND '.join(conditions)), *parameters)
+
+def index_experiment(index, data_dir):
+    """Add the metadata from an existing experiment directory to a MetadataIndex.
+    Records already present are replaced. Scheduled start times are not stored
+    in the experiment metadata, and so are not available."""
+    data_dir = pathlib.Path(data_dir)
+    experiment_metadata = metadata_journal.DictJournal(data_dir / 'experiment_metadata.json').load()
+    timepoints = experiment_metadata.get('timepoints', [])
+    metering = experiment_metadata.get('brightfield metering', {})
+    durations = experiment_metadata.get('durations', [])
+    for i, (timepoint, start) in enumerate(zip(timepoints, experiment_metadata.get('timestamps', []))):
+        duration = durations[i] if i < len(durations) else None
+        index.add_timepoint(data_dir, timepoint, start, duration, metering=metering.get(timepoint))
+    store = image_store.ImageStore(data_dir)
+    last_timepoints = {}
+    for position in sorted(experiment_metadata.get('positions', {})):
+        position_dir = data_dir / position
+        if not position_dir.exists():
+            continue
+        images = {}
+        for path in position_dir.iterdir():
+            timepoint, space, name = path.name.partition(' ')
+            if space and path.is_file():
+                images.setdefault(timepoint, []).append((name, path))
+        for channel in store.channels(position):
+            for timepoint in store.timepoints(position, channel):
+                images.setdefault(timepoint, []).append((channel, None))
+        position_metadata = metadata_journal.RecordJournal(position_dir / 'position_metadata.jsonl',
+            legacy_path=position_dir / 'position_metadata.json')
+        for metadata in position_metadata:
+            timepoint = metadata['timepoint']
+            index.add_acquisition(data_dir, position, timepoint, metadata, images.get(timepoint, ()))
+            last_timepoints[position] = timepoint
+    for position in experiment_metadata.get('skip_positions', []):
+        index.set_skipped(data_dir, position, last_timepoints.get(position))
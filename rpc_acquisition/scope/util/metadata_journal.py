@@ -0,0 +1,331 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Authors: Zach Pincus
+
+
+"""Crash-safe, incrementally-written storage for timecourse metadata.
+
+RecordJournal stores a growing list of records (e.g. the per-timepoint
+metadata for a position) as an append-only file of JSON lines, with a
+binary index of line offsets so that any record can be read without parsing
+the others. DictJournal stores a dict that changes a little at a time (e.g.
+the experiment metadata) as a JSON snapshot plus a journal of changes.
+
+Both can be "compacted" to the plain, human-readable JSON files that were
+previously written in full after every change.
+"""
+
+import array
+import bisect
+import collections.abc
+import hashlib
+import json
+import os
+import pathlib
+
+from . import json_encode
+
+def _encode_line(data):
+    return (json_encode.COMPACT_ENCODER.encode(data) + '\n').encode('utf8')
+
+def _normalize(data):
+    """Return data as it would be read back from JSON (lists for tuples, etc.)"""
+    return json.loads(json_encode.COMPACT_ENCODER.encode(data))
+
+def write_json_atomic(path, data):
+    """Write data to path as readable JSON, replacing any existing file only
+    once the new one is completely written."""
+    path = pathlib.Path(path)
+    os.replace(str(_write_json_tmp(path, data)), str(path))
+
+def _write_json_tmp(path, data):
+    """Durably write data as readable JSON to a temporary file next to path,
+    and return the temporary file's path."""
+    tmp_path = path.parent / (path.name + '.tmp')
+    with tmp_path.open('w') as f:
+        json_encode.encode_legible_to_file(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp_path
+
+def _append_durably(path, data):
+    with open(str(path), 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+class _RecordKeys(collections.abc.Sequence):
+    """View of a single key from each record of a RecordJournal, for bisection."""
+    def __init__(self, journal, key):
+        self.journal = journal
+        self.key = key
+
+    def __len__(self):
+        return len(self.journal)
+
+    def __getitem__(self, i):
+        return self.journal[i][self.key]
+
+class RecordJournal(collections.abc.Sequence):
+    """Append-only list of JSON records, stored one record per line, with an
+    index of the byte offset of each line. Records are only read from disk
+    (and parsed) when accessed, so e.g. journal[-1] is cheap no matter how
+    many records there are.
+
+    Each append is fsynced before the index is updated, and on opening, a
+    record that was only partially written (e.g. in a crash) is ignored (and
+    removed at the next append), and any records missing from the index are
+    re-indexed.
+
+    If the journal file does not exist but legacy_path (a JSON file with a list
+    of records) does, the legacy records are read from that file, and are
+    copied into the journal upon the first append.
+    """
+    def __init__(self, path, legacy_path=None):
+        self.path = pathlib.Path(path)
+        self.index_path = self.path.parent / (self.path.name + '.idx')
+        self._legacy = None
+        if not self.path.exists():
+            self._offsets = array.array('Q')
+            self._end = 0
+            self._needs_repair = False
+            if legacy_path is not None and pathlib.Path(legacy_path).exists():
+                with pathlib.Path(legacy_path).open('r') as f:
+                    self._legacy = json.load(f)
+        else:
+            self._load_index()
+
+    def _load_index(self):
+        self._offsets = array.array('Q')
+        index_bytes = self.index_path.read_bytes() if self.index_path.exists() else b''
+        self._offsets.frombytes(index_bytes[:len(index_bytes) - len(index_bytes) % self._offsets.itemsize])
+        size = self.path.stat().st_size
+        self._end = 0
+        with self.path.open('rb') as f:
+            # discard index entries for records that never made it (completely) to disk
+            while self._offsets:
+                if self._offsets[-1] < size:
+                    line = self._read_line(f, self._offsets[-1])
+                    if line.endswith(b'\n'):
+                        self._end = self._offsets[-1] + len(line)
+                        break
+                self._offsets.pop()
+            # index any complete records written after the last index update
+            f.seek(self._end)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break # partially-written record
+                self._offsets.append(self._end)
+                self._end += len(line)
+        self._needs_repair = size != self._end or index_bytes != self._offsets.tobytes()
+
+    @staticmethod
+    def _read_line(f, offset):
+        f.seek(offset)
+        return f.readline()
+
+    def __len__(self):
+        if self._legacy is not None:
+            return len(self._legacy)
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if self._legacy is not None:
+            return self._legacy[i]
+        if isinstance(i, slice):
+            indices = range(*i.indices(len(self)))
+            if not indices:
+                return []
+            with self.path.open('rb') as f:
+                return [json.loads(self._read_line(f, self._offsets[j]).decode('utf8')) for j in indices]
+        with self.path.open('rb') as f:
+            return json.loads(self._read_line(f, self._offsets[i]).decode('utf8'))
+
+    def latest(self):
+        """Return the most recent record, or None if there are none."""
+        return self[-1] if len(self) else None
+
+    def between(self, start, end, key='timestamp'):
+        """Return the list of records whose 'key' value is in [start, end).
+        Records must be in increasing order of that key. Only O(log n) records
+        are parsed to find the range."""
+        keys = _RecordKeys(self, key)
+        lo = 0 if start is None else bisect.bisect_left(keys, start)
+        hi = len(self) if end is None else bisect.bisect_left(keys, end, lo)
+        return self[lo:hi]
+
+    def find(self, value, key='timestamp'):
+        """Return the index of the first record whose 'key' value equals the
+        given value, or None if there is none. Records must be in increasing
+        order of that key."""
+        keys = _RecordKeys(self, key)
+        i = bisect.bisect_left(keys, value)
+        if i < len(self) and keys[i] == value:
+            return i
+        return None
+
+    def append(self, record):
+        """Durably append a record to the journal."""
+        if self._legacy is not None:
+            legacy, self._legacy = self._legacy, None
+            for old_record in legacy:
+                self._append(old_record)
+        self._append(record)
+
+    def _append(self, record):
+        line = _encode_line(record)
+        if self._needs_repair:
+            # remove any partially-written record, and bring the index up to date
+            with self.path.open('r+b') as f:
+                f.truncate(self._end)
+            with self.index_path.open('wb') as f:
+                f.write(self._offsets.tobytes())
+            self._needs_repair = False
+        _append_durably(self.path, line)
+        # The index need not be fsynced: it is rebuilt from the journal if needed.
+        with self.index_path.open('ab') as f:
+            f.write(array.array('Q', [self._end]).tobytes())
+        self._offsets.append(self._end)
+        self._end += len(line)
+
+    def compact(self, json_path):
+        """Write all records as a readable JSON list to json_path (atomically)."""
+        write_json_atomic(json_path, list(self))
+
+class DictJournal:
+    """A JSON dict stored as a readable snapshot file plus a journal of the
+    changes made since the snapshot was written.
+
+    Each save() appends only the top-level keys that changed (and, for lists
+    that only grew, just the new items) to the journal, so the cost of saving
+    does not grow with the size of the dict. compact() rewrites the snapshot
+    and empties the journal.
+
+    The journal's first line records a hash of the snapshot it applies to.
+    Before a new snapshot replaces the old one, its hash is appended to the
+    journal, so that if a crash occurs partway through compaction, changes
+    already incorporated into the new snapshot are not applied twice. If the
+    snapshot is instead changed by other means (e.g. edited by hand) while the
+    journal holds changes, load() raises an error rather than discarding
+    either the edits or the changes.
+    """
+    def __init__(self, snapshot_path):
+        self.snapshot_path = pathlib.Path(snapshot_path)
+        self.journal_path = self.snapshot_path.parent / (self.snapshot_path.name + '.journal')
+        self._saved = None
+        self._snapshot_hash = None
+        self._journal_end = None # if not None, the journal must be truncated to this size before appending
+        self.journal_length = 0
+
+    def load(self):
+        """Return the dict, as of the last save()."""
+        snapshot_bytes = self.snapshot_path.read_bytes()
+        self._snapshot_hash = hashlib.sha1(snapshot_bytes).hexdigest()
+        data = json.loads(snapshot_bytes.decode('utf8'))
+        self.journal_length = 0
+        self._journal_end = None
+        if self.journal_path.exists():
+            with self.journal_path.open('rb') as f:
+                lines = f.readlines()
+            if lines and not lines[-1].endswith(b'\n'):
+                lines.pop() # skip a partially-written change, and remove it before the next is appended
+                self._journal_end = sum(len(line) for line in lines)
+            changes = [json.loads(line.decode('utf8')) for line in lines[1:]]
+            if lines and json.loads(lines[0].decode('utf8')).get('snapshot') == self._snapshot_hash:
+                for change in changes:
+                    self._apply(data, change)
+                self.journal_length = len(changes)
+            elif changes and changes[-1].get('compacted_to') != self._snapshot_hash:
+                raise RuntimeError('{} has changed since the changes in {} were recorded. To keep those changes, '
+                    'restore the previous version of {} (or add the changes to it by hand); to discard them, delete {}.'
+                    .format(self.snapshot_path, self.journal_path, self.snapshot_path.name, self.journal_path.name))
+            # otherwise, the journal's changes were incorporated into the snapshot by an interrupted compact()
+        self._saved = _normalize(data)
+        return data
+
+    @staticmethod
+    def _apply(data, change):
+        data.update(change.get('set', {}))
+        for key, items in change.get('extend', {}).items():
+            data.setdefault(key, []).extend(items)
+        for key in change.get('delete', []):
+            data.pop(key, None)
+
+    def _diff(self, data):
+        change = {}
+        for key, value in data.items():
+            if key in self._saved:
+                old_value = self._saved[key]
+                if value == old_value:
+                    continue
+                if isinstance(value, list) and isinstance(old_value, list) and value[:len(old_value)] == old_value:
+                    change.setdefault('extend', {})[key] = value[len(old_value):]
+                    continue
+            change.setdefault('set', {})[key] = value
+        deleted = [key for key in self._saved if key not in data]
+        if deleted:
+            change['delete'] = deleted
+        return change
+
+    def save(self, data):
+        """Durably record the changes to data since the last load() or save()."""
+        normalized = _normalize(data)
+        change = self._diff(normalized)
+        if not change:
+            return
+        if not self.journal_path.exists() or self.journal_length == 0:
+            self._start_journal()
+        elif self._journal_end is not None:
+            self._truncate_journal()
+        _append_durably(self.journal_path, _encode_line(change))
+        self.journal_length += 1
+        self._saved = normalized
+
+    def _truncate_journal(self):
+        with self.journal_path.open('r+b') as f:
+            f.truncate(self._journal_end)
+        self._journal_end = None
+
+    def _start_journal(self):
+        tmp_path = self.journal_path.parent / (self.journal_path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            f.write(_encode_line({'snapshot': self._snapshot_hash}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(tmp_path), str(self.journal_path))
+        self._journal_end = None
+
+    def compact(self, data):
+        """Write data as the new snapshot and start a new, empty journal."""
+        tmp_path = _write_json_tmp(self.snapshot_path, data)
+        new_hash = hashlib.sha1(tmp_path.read_bytes()).hexdigest()
+        if self.journal_length > 0:
+            # mark the journal's changes as incorporated into the new snapshot
+            if self._journal_end is not None:
+                self._truncate_journal()
+            _append_durably(self.journal_path, _encode_line({'compacted_to': new_hash}))
+        os.replace(str(tmp_path), str(self.snapshot_path))
+        self._snapshot_hash = new_hash
+        self._start_journal()
+        self.journal_length = 0
+        self._saved = _normalize(data)
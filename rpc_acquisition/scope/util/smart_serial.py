@@ -47,15 +47,61 @@ class Serial(serialposix.Serial):
     read in will still be there.
     (3) A read_until() command is provided that reads from the serial port
     until some string is matched.
+
+    Incoming data is accumulated in a bytearray, which supports amortized
+    constant-time appends at the end and deletions from the front, so a
+    chatty device does not cause the buffer to be repeatedly copied.
     """
     def __init__(self, port, baudrate=9600, timeout=None, **kwargs):
-        self.read_buffer = b''
+        self.read_buffer = bytearray()
         super().__init__(port, baudrate=baudrate, timeout=timeout, **kwargs)
 
     def inWaiting(self):
         """Return the number of characters currently in the input buffer."""
+        return self._os_in_waiting() + len(self.read_buffer)
+
+    def _os_in_waiting(self):
         s = fcntl.ioctl(self.fd, serialposix.TIOCINQ, serialposix.TIOCM_zero_str)
-        return struct.unpack('I',s)[0] + len(self.read_buffer)
+        return struct.unpack('I',s)[0]
+
+    def _fill_buffer(self, size):
+        """Wait for data to be available and append up to size bytes of it to
+        the read buffer."""
+        try:
+            ready,_,_ = select.select([self.fd],[],[], self._timeout)
+            # If select was used with a timeout, and the timeout occurs, it
+            # returns with empty lists -> thus abort read operation.
+            # For timeout == 0 (non-blocking operation) also abort when there
+            # is nothing to read.
+            if not ready:
+                raise SerialTimeout()   # timeout
+            buf = os.read(self.fd, size)
+            # read should always return some data as select reported it was
+            # ready to read when we get to this point.
+            if not buf:
+                # Disconnected devices, at least on Linux, show the
+                # behavior that they are always ready to read immediately
+                # but reading returns nothing.
+                raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
+            self.read_buffer += buf
+        except OSError as e:
+            # because SerialException is a IOError subclass, which is a OSError subclass,
+            # we could accidentally catch and re-raise SerialExceptions we ourselves raise earlier
+            # which is a tad silly.
+            if isinstance(e, SerialException):
+                raise
+
+            # ignore EAGAIN errors. all other errors are shown
+            if e.errno != errno.EAGAIN:
+                raise SerialException('read failed: %s' % (e,))
+
+    def _consume(self, size):
+        """Remove and return the first size bytes of the read buffer."""
+        # Copy out first and only then delete, so that a KeyboardInterrupt
+        # between the two leaves the data in the buffer.
+        data = bytes(self.read_buffer[:size])
+        del self.read_buffer[:size]
+        return data
 
     def read(self, size=1):
         """Read size bytes from the serial port. If a timeout occurs, an
@@ -65,54 +111,26 @@ class Serial(serialposix.Serial):
            bytes read will not be lost but will be available to subsequent read()
            calls."""
         if not self.isOpen(): raise serialposix.portNotOpenError
-        if len(self.read_buffer) > size:
-            read_buffer = self.read_buffer
-            try:
-                self.read_buffer = read_buffer[size:]
-                return read_buffer[:size]
-            except KeyboardInterrupt as k:
-                self.read_buffer = read_buffer
-                raise k
         while len(self.read_buffer) < size:
-            try:
-                ready,_,_ = select.select([self.fd],[],[], self._timeout)
-                # If select was used with a timeout, and the timeout occurs, it
-                # returns with empty lists -> thus abort read operation.
-                # For timeout == 0 (non-blocking operation) also abort when there
-                # is nothing to read.
-                if not ready:
-                    raise SerialTimeout()   # timeout
-                buf = os.read(self.fd, size-len(self.read_buffer))
-                # read should always return some data as select reported it was
-                # ready to read when we get to this point.
-                if not buf:
-                    # Disconnected devices, at least on Linux, show the
-                    # behavior that they are always ready to read immediately
-                    # but reading returns nothing.
-                    raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
-                self.read_buffer += buf
-            except OSError as e:
-                # because SerialException is a IOError subclass, which is a OSError subclass,
-                # we could accidentally catch and re-raise SerialExceptions we ourselves raise earlier
-                # which is a tad silly.
-                if isinstance(e, SerialException):
-                    raise
-
-                # ignore EAGAIN errors. all other errors are shown
-                if e.errno != errno.EAGAIN:
-                    raise SerialException('read failed: %s' % (e,))
-
-        read_buffer = self.read_buffer
-        try:
-            self.read_buffer = b''
-            return read_buffer
-        except KeyboardInterrupt as k:
-            self.read_buffer = read_buffer
-            raise k
+            self._fill_buffer(size - len(self.read_buffer))
+        return self._consume(size)
 
     def read_all_buffered(self):
         return self.read(self.inWaiting())
 
+    def _find_match(self, match, search_start):
+        """Block until match is found in the read buffer, and return the
+        position just past its end. Bytes before search_start are known not to
+        contain the start of a match."""
+        ml = len(match)
+        while True:
+            match_pos = self.read_buffer.find(match, search_start)
+            if match_pos != -1:
+                return match_pos + ml
+            # don't re-scan data already known not to contain a match
+            search_start = max(search_start, len(self.read_buffer) - ml + 1)
+            self._fill_buffer(max(self._os_in_waiting(), ml))
+
     def read_until(self, match):
         """Read bytes from the serial until the sequence of bytes specified in
            'match' is read out. If a timeout is set and match hasn't been made,
@@ -121,48 +139,4 @@ class Serial(serialposix.Serial):
            the match is made, the pending bytes read will not be lost but will be
            available to subsequent read_until() calls."""
         if not self.isOpen(): raise serialposix.portNotOpenError
-        search_start = 0
-        ml = len(match)
-        while True:
-            match_pos = self.read_buffer.find(match, search_start)
-            if match_pos != -1:
-                break
-            search_start = len(self.read_buffer) - ml + 1
-            try:
-                ready,_,_ = select.select([self.fd],[],[], self.timeout)
-                # If select was used with a timeout, and the timeout occurs, it
-                # returns with empty lists -> thus abort read operation.
-                # For timeout == 0 (non-blocking operation) also abort when there
-                # is nothing to read.
-                if not ready:
-                    raise SerialTimeout()   # timeout
-                s = fcntl.ioctl(self.fd, serialposix.TIOCINQ, serialposix.TIOCM_zero_str)
-                in_waiting = struct.unpack('I',s)[0]
-                buf = os.read(self.fd, max(in_waiting, ml))
-                # read should always return some data as select reported it was
-                # ready to read when we get to this point.
-                if not buf:
-                    # Disconnected devices, at least on Linux, show the
-                    # behavior that they are always ready to read immediately
-                    # but reading returns nothing.
-                    raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
-                self.read_buffer += buf
-            except OSError as e:
-                # because SerialException is a IOError subclass, which is a OSError subclass,
-                # we could accidentally catch and re-raise SerialExceptions we ourselves raise earlier
-                # which is a tad silly.
-                if isinstance(e, SerialException):
-                    raise
-
-                # ignore EAGAIN errors. all other errors are shown
-                if e.errno != errno.EAGAIN:
-                    raise SerialException('read failed: %s' % (e,))
-
-        read_buffer = self.read_buffer
-        match_last = match_pos + ml
-        try:
-            self.read_buffer = read_buffer[match_last:]
-            return read_buffer[:match_last]
-        except KeyboardInterrupt as k:
-            self.read_buffer = read_buffer
-            raise k
\ No newline at end of file
+        return self._consume(self._find_match(match, 0))
@@ -21,7 +21,9 @@
 #
 # Authors: Zach Pincus
 
+import collections
 import contextlib
+from concurrent import futures
 
 @contextlib.contextmanager
 def in_state(device, **state):
@@ -34,14 +36,144 @@ def in_state(device, **state):
     finally:
         device.pop_state()
 
+@contextlib.contextmanager
+def transaction(*devices):
+    """Context manager to collapse all push_state() and pop_state() calls on
+    the given devices within the with-block into the minimal set of writes.
+
+    The state stacks are updated immediately, but the property writes are
+    deferred until the end of the with-block. Then, for each device, only the
+    last value written to each property is set (in the order in which those
+    final values were written), and properties that would be set back to the
+    value they had when the transaction began are not written at all (unless
+    the device's _filter_unchanged_pushes is False, as for the lamps).
+
+    Devices that do not share hardware (see _get_hardware_key()) have their
+    writes applied concurrently; those that do are applied one device at a
+    time, in the order given.
+
+    Because the writes are deferred, code in the with-block must not depend on
+    the hardware having reached the pushed state. Transactions may be nested;
+    writes happen at the end of the outermost one.
+    """
+    for device in devices:
+        device._begin_transaction()
+    try:
+        yield
+    finally:
+        groups = collections.OrderedDict()
+        for device in devices:
+            if device._end_transaction():
+                groups.setdefault(device._get_hardware_key(), []).append(device)
+        _flush_groups(list(groups.values()))
+
+def _flush_group(devices):
+    for device in devices:
+        device._flush_pending_writes()
+
+def _flush_groups(groups):
+    if len(groups) == 1:
+        _flush_group(groups[0])
+    elif groups:
+        with futures.ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            flushes = [executor.submit(_flush_group, group) for group in groups]
+        for flush in flushes:
+            flush.result() # re-raise any exceptions
+
 class StateStackDevice:
+    # class-level defaults, so that subclasses need not call __init__ first
+    _transaction_depth = 0
+    _pending_writes = None
+    _state_writes = 0
+    _state_writes_elided = 0
+    # If False, push_state() writes values even if they equal the current ones,
+    # also within a transaction: for devices whose state can change behind the
+    # cached values (e.g. lamps controlled by IOTool programs).
+    _filter_unchanged_pushes = True
+
     def __init__(self):
         self._state_stack = []
 
-    def _set_state(self, properties_and_values):
-        """Set a number of device properties at once, in the order specified"""
+    def _set_state(self, properties_and_values, current_values=None):
+        """Set a number of device properties at once, in the order specified.
+
+        Within a transaction the writes are deferred; current_values, if given,
+        is a dict of the present values of (some of) the properties, used to
+        avoid writing properties that end the transaction unchanged."""
+        if self._transaction_depth == 0:
+            self._write_state(properties_and_values)
+            return
+        pending, baseline = self._pending_writes
+        for p, v in properties_and_values:
+            if p in pending:
+                self._state_writes_elided += 1
+                del pending[p] # re-insert below, so the final writes are in order
+            elif current_values is not None and p in current_values:
+                baseline[p] = current_values[p]
+            pending[p] = v
+
+    def _write_state(self, properties_and_values):
+        """Actually write a number of device properties, in the order specified."""
         for p, v in properties_and_values:
             getattr(self, 'set_'+p)(v)
+            self._state_writes += 1
+
+    def _read_state_value(self, p):
+        """Read a property value from the device."""
+        return getattr(self, 'get_'+p)()
+
+    def _get_state_value(self, p):
+        """Return a property value, taking into account any writes pending in a
+        transaction."""
+        if self._pending_writes is not None and p in self._pending_writes[0]:
+            return self._pending_writes[0][p]
+        return self._read_state_value(p)
+
+    def _get_hardware_key(self):
+        """Return a key identifying the hardware this device writes to. Devices
+        with the same key have their transaction writes applied sequentially,
+        rather than concurrently."""
+        return self
+
+    def _begin_transaction(self):
+        if self._transaction_depth == 0:
+            # pending writes: (dict of property values to write, in order; dict of
+            # property values before the transaction, where known)
+            self._pending_writes = ({}, {})
+        self._transaction_depth += 1
+
+    def _end_transaction(self):
+        """Return True if the outermost transaction has ended and the pending
+        writes should be flushed."""
+        self._transaction_depth -= 1
+        return self._transaction_depth == 0
+
+    def _flush_pending_writes(self):
+        pending, baseline = self._pending_writes
+        self._pending_writes = None
+        writes = []
+        for p, v in pending.items():
+            if p in baseline and baseline[p] == v:
+                self._state_writes_elided += 1
+            else:
+                writes.append((p, v))
+        self._write_state(writes)
+
+    def state_transaction(self):
+        """Context manager that collapses all push_state() and pop_state() calls
+        within the with-block into the minimal set of writes, performed at
+        the end of the block. (See state_stack.transaction().)"""
+        return transaction(self)
+
+    def get_state_write_statistics(self):
+        """Return a dict with the number of property writes made by push_state()
+        and pop_state() ('writes'), and the number avoided by collapsing them
+        within transactions ('elided')."""
+        return dict(writes=self._state_writes, elided=self._state_writes_elided)
+
+    def reset_state_write_statistics(self):
+        self._state_writes = 0
+        self._state_writes_elided = 0
 
     @staticmethod
     def _order(state, weights):
@@ -52,6 +184,8 @@ class StateStackDevice:
         return zip(properties, values)
 
     def  _update_push_states(self, state, old_state):
+        if not self._filter_unchanged_pushes:
+            return
         for k in list(state.keys()):
             if old_state[k] == state[k]:
                 state.pop(k)
@@ -68,11 +202,12 @@ class StateStackDevice:
         saving the old values of those parameters. pop_state() will restore those
         previous values. push_state/pop_state pairs can be nested arbitrarily.
         """
-        old_state = {p:getattr(self, 'get_'+p)() for p, v in state.items()}
+        old_state = {p:self._get_state_value(p) for p, v in state.items()}
         self._update_push_states(state, old_state)
         if old_state:
             properties_and_values = self._order(state, self._get_push_weights(state))
-            self._set_state(properties_and_values)
+            # the old values are a baseline for eliding writes in a transaction only if the cached values can be trusted
+            self._set_state(properties_and_values, old_state if self._filter_unchanged_pushes else None)
         self._state_stack.append(old_state)
 
     def pop_state(self):
@@ -0,0 +1,113 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014-2015 WUSTL ZPLAB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for metadata_journal.DictJournal: run with
+python -m unittest scope.util.test_metadata_journal"""
+
+import hashlib
+import json
+import pathlib
+import tempfile
+import unittest
+
+from . import metadata_journal
+
+class DictJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tempdir.name) / 'experiment_metadata.json'
+        with self.path.open('w') as f:
+            json.dump(dict(positions={'000': [1, 2, 3]}, timepoints=[]), f)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _load(self):
+        return metadata_journal.DictJournal(self.path).load()
+
+    def _save_timepoints(self, journal, data, timepoints):
+        for timepoint in timepoints:
+            data['timepoints'].append(timepoint)
+            data['latest'] = timepoint
+            journal.save(data)
+
+    def test_save_and_load(self):
+        journal = metadata_journal.DictJournal(self.path)
+        data = journal.load()
+        self._save_timepoints(journal, data, ['a', 'b'])
+        del data['positions']
+        journal.save(data)
+        self.assertEqual(self._load(), dict(timepoints=['a', 'b'], latest='b'))
+        self.assertEqual(journal.journal_length, 3)
+        # only the changes are journaled, not the whole list
+        with journal.journal_path.open() as f:
+            changes = [json.loads(line) for line in f]
+        self.assertEqual(changes[2], {'extend': {'timepoints': ['b']}, 'set': {'latest': 'b'}})
+
+    def test_compact(self):
+        journal = metadata_journal.DictJournal(self.path)
+        data = journal.load()
+        self._save_timepoints(journal, data, ['a', 'b'])
+        journal.compact(data)
+        self.assertEqual(journal.journal_length, 0)
+        with self.path.open() as f:
+            self.assertEqual(json.load(f), data)
+        self._save_timepoints(journal, data, ['c'])
+        self.assertEqual(self._load(), data)
+
+    def test_partial_change(self):
+        journal = metadata_journal.DictJournal(self.path)
+        data = journal.load()
+        self._save_timepoints(journal, data, ['a'])
+        with journal.journal_path.open('ab') as f:
+            f.write(b'{"set": {"lat') # interrupted write
+        journal = metadata_journal.DictJournal(self.path)
+        data = journal.load()
+        self.assertEqual(data['timepoints'], ['a'])
+        self._save_timepoints(journal, data, ['b'])
+        self.assertEqual(self._load()['timepoints'], ['a', 'b'])
+
+    def test_interrupted_compaction(self):
+        journal = metadata_journal.DictJournal(self.path)
+        data = journal.load()
+        self._save_timepoints(journal, data, ['a', 'b'])
+        # as if compact() had replaced the snapshot but not yet started a new journal
+        tmp_path = metadata_journal._write_json_tmp(self.path, data)
+        new_hash = hashlib.sha1(tmp_path.read_bytes()).hexdigest()
+        metadata_journal._append_durably(journal.journal_path, metadata_journal._encode_line({'compacted_to': new_hash}))
+        tmp_path.replace(self.path)
+        self.assertEqual(self._load()['timepoints'], ['a', 'b'])
+
+    def test_edited_snapshot(self):
+        journal = metadata_journal.DictJournal(self.path)
+        data = journal.load()
+        self._save_timepoints(journal, data, ['a'])
+        with self.path.open('w') as f:
+            json.dump(dict(positions={}, timepoints=[]), f)
+        with self.assertRaises(RuntimeError):
+            self._load()
+        # with no journaled changes, editing is fine
+        journal.journal_path.unlink()
+        self.assertEqual(self._load(), dict(positions={}, timepoints=[]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,109 @@
+import collections
 import concurrent.futures as futures
+import itertools
+import json
+import os
+import pathlib
+import struct
+import threading
 import freeimage
+import ism_buffer
+import numpy
+
+class FreeImageWriter:
+    """Write images with freeimage, using the given freeimage.IO_FLAGS value."""
+    def __init__(self, flags=0):
+        self.flags = flags
+
+    def write(self, image, path):
+        freeimage.write(image, str(path), self.flags)
+
+class TiffWriter:
+    """Write TIFF files with the tifffile library, which (unlike freeimage)
+    supports zstd and low-level (i.e. fast) deflate compression.
+
+    Files are written in the same orientation as freeimage.write() uses.
+    Zstd-compressed files generally cannot be read by freeimage, but
+    read_image() will fall back to tifffile to read them.
+    """
+    suffixes = ('.tiff', '.tif')
+
+    def __init__(self, compression='zlib', level=1, predictor=True):
+        """Parameters:
+            compression: 'zlib' (i.e. deflate), 'zstd', or any other compression
+                supported by tifffile / imagecodecs.
+            level: compression level.
+            predictor: if True, store differences between neighboring pixels,
+                which generally compress much better for camera images.
+        """
+        self.compression = compression
+        self.level = level
+        self.predictor = predictor
+
+    def write(self, image, path):
+        import tifffile
+        tifffile.imwrite(str(path), image.T, compression=self.compression,
+            compressionargs={'level': self.level}, predictor=self.predictor)
+
+_BLOSC_MAGIC = b'BLOSCIMG'
+
+class BloscWriter:
+    """Write images as blosc-compressed raw pixel data with a small header
+    giving the dtype and shape. Such files (named e.g. 'gfp.blosc') can be
+    read with read_blosc() or read_image().
+
+    Blosc splits the data into blocks and optionally shuffles the bytes or bits
+    of each pixel before compressing, which for 16-bit images is both faster
+    and more compact than zlib on its own.
+    """
+    suffixes = ('.blosc',)
+
+    def __init__(self, cname='lz4', clevel=5, shuffle='bit'):
+        """Parameters:
+            cname: blosc compressor: 'lz4', 'zstd', 'blosclz', etc.
+            clevel: compression level, from 0 to 9.
+            shuffle: 'bit', 'byte', or None.
+        """
+        self.cname = cname
+        self.clevel = clevel
+        self.shuffle = shuffle
+
+    def write(self, image, path):
+        import blosc
+        shuffle = {'bit': blosc.BITSHUFFLE, 'byte': blosc.SHUFFLE, None: blosc.NOSHUFFLE}[self.shuffle]
+        image = numpy.asarray(image)
+        order = 'F' if image.flags.f_contiguous and not image.flags.c_contiguous else 'C'
+        header = json.dumps(dict(dtype=image.dtype.str, shape=image.shape, order=order)).encode('ascii')
+        data = blosc.compress(image.tobytes(order), typesize=image.dtype.itemsize,
+            clevel=self.clevel, shuffle=shuffle, cname=self.cname)
+        with open(str(path), 'wb') as f:
+            f.write(_BLOSC_MAGIC + struct.pack('<I', len(header)) + header)
+            f.write(data)
+
+def read_blosc(path):
+    """Read an image file written by BloscWriter."""
+    import blosc
+    with open(str(path), 'rb') as f:
+        if f.read(len(_BLOSC_MAGIC)) != _BLOSC_MAGIC:
+            raise ValueError('{} is not a blosc image file'.format(path))
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length).decode('ascii'))
+        data = blosc.decompress(f.read())
+    return numpy.frombuffer(data, dtype=header['dtype']).reshape(header['shape'], order=header['order'])
+
+def read_image(path):
+    """Read an image written by any of the writers above."""
+    path = str(path)
+    if path.endswith('.blosc'):
+        return read_blosc(path)
+    try:
+        return freeimage.read(path)
+    except Exception:
+        if not path.endswith(('.tif', '.tiff')):
+            raise
+        # freeimage's libtiff may not support the compression used (e.g. zstd)
+        import tifffile
+        return tifffile.imread(path).T
 
 class COMPRESSION:
     DEFAULT = 0 # save TIFFs using FreeImage default LZW compression, and PNGs with ZLib level 6 compression
@@ -10,14 +114,59 @@ class COMPRESSION:
 
     TIFF_NONE = freeimage.IO_FLAGS.TIFF_NONE # save without compression
 
+    # The following require the tifffile (and imagecodecs) or blosc packages.
+    TIFF_DEFLATE_FAST = TiffWriter('zlib', 1) # deflate level 1
+    TIFF_ZSTD = TiffWriter('zstd', 1) # zstd level 1: several times faster than deflate, similar size
+    BLOSC_LZ4 = BloscWriter('lz4', 5) # raw + blosc: fastest, use a '.blosc' file extension
+    BLOSC_ZSTD = BloscWriter('zstd', 3) # raw + blosc: smaller, use a '.blosc' file extension
+
+# file suffixes required by the freeimage flags above
+_FREEIMAGE_SUFFIXES = {
+    COMPRESSION.PNG_NONE: ('.png',),
+    COMPRESSION.PNG_FAST: ('.png',),
+    COMPRESSION.PNG_BEST: ('.png',),
+    COMPRESSION.TIFF_NONE: ('.tiff', '.tif')
+}
+
+def fix_suffix(name, compression):
+    """Return the given file name (or path), with its suffix replaced if it is
+    not appropriate for the given compression value (e.g. 'bf.png' becomes
+    'bf.tiff' for COMPRESSION.TIFF_ZSTD). Names are returned unchanged for
+    compression values that do not require a particular format, such as
+    COMPRESSION.DEFAULT."""
+    if hasattr(compression, 'write'):
+        suffixes = getattr(compression, 'suffixes', None)
+    else:
+        suffixes = _FREEIMAGE_SUFFIXES.get(compression)
+    path = pathlib.PurePath(name)
+    if suffixes is None or path.suffix.lower() in suffixes:
+        return name
+    return type(name)(path.with_suffix(suffixes[0]))
+
+def get_writer(compression):
+    """Return a writer object for the given compression, which may be any of the
+    COMPRESSION values above (freeimage flags or writer objects), or any object
+    with a write(image, path) method."""
+    if hasattr(compression, 'write'):
+        return compression
+    return FreeImageWriter(compression)
 
 class ThreadedIO:
     def __init__(self, num_threads):
         self.threadpool = futures.ThreadPoolExecutor(num_threads)
 
     def write(self, images, paths, flags=0):
-        """Write out a list of images to the given paths."""
-        futures_out = [self.threadpool.submit(freeimage.write, image, str(path), flags) for image, path in zip(images, paths)]
+        """Write out a list of images to the given paths.
+
+        flags may be a single COMPRESSION value (or other writer; see
+        get_writer()) used for all the images, or a list of one per image.
+        NB: the file extensions of the paths must be appropriate for the writers.
+        """
+        if isinstance(flags, (list, tuple)):
+            writers = [get_writer(f) for f in flags]
+        else:
+            writers = [get_writer(flags)] * len(images)
+        futures_out = [self.threadpool.submit(writer.write, image, path) for image, path, writer in zip(images, paths, writers)]
         # wait until all have completed or errored out
         futures.wait(futures_out)
         # now get the result() from each future, which will raise any errors encountered
@@ -28,5 +177,237 @@ class ThreadedIO:
 
     def read(self, paths):
         """Return an iterator over image arrays read from the given paths."""
-        paths = map(str, paths)
-        return self.threadpool.map(freeimage.read, paths)
+        return self.threadpool.map(read_image, paths)
+
+def _fsync_paths(paths):
+    """fsync the given files and the directories containing them."""
+    directories = set()
+    for path in paths:
+        path = os.path.abspath(str(path))
+        directories.add(os.path.dirname(path))
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _process_write(writer, buffer_name, path, fsync):
+    # runs in a worker process: the image data are read directly from shared memory
+    image = ism_buffer.open(buffer_name).asarray()
+    writer.write(image, path)
+    if fsync:
+        _fsync_paths([path])
+
+class _WriteGroup:
+    def __init__(self, count, callback, flush_fsyncs):
+        self.remaining = count # images not yet written (and fsynced, if requested)
+        self.unwritten = count
+        self.callback = callback
+        self.flush_fsyncs = flush_fsyncs # fsync as soon as written, rather than waiting for a full batch
+        self.error = None
+
+_buffer_counter = itertools.count()
+
+class ProcessIO:
+    """Write images using a pool of worker processes, so that encoding is not
+    limited by the GIL (as it is with ThreadedIO for encoders that do not
+    release it).
+
+    Images are copied into ISM_Buffer shared memory, which the workers open
+    by name: the pixel data are never pickled. (Writer objects, e.g.
+    COMPRESSION values, are pickled and so must be picklable.)
+
+    write_async() returns as soon as the images are handed off, allowing
+    acquisition to continue while they are encoded. It blocks only when more
+    than max_in_flight_mb of image data are waiting to be written. Callbacks
+    are called in the order the writes were submitted, from a dedicated
+    thread, so that slow callbacks do not hold up the handling of results from
+    the worker processes.
+    """
+    def __init__(self, num_processes, max_in_flight_mb=512, fsync_batch_size=0):
+        """Parameters:
+            num_processes: number of worker processes.
+            max_in_flight_mb: maximum amount of image data (in megabytes) that
+                may be queued or in the process of being written. A single
+                image larger than this is still allowed if nothing else is
+                in flight.
+            fsync_batch_size: if 0, files are not explicitly fsynced. If 1, each
+                file is fsynced by the worker after writing. If larger, files
+                are fsynced in batches of that many (or fewer, at wait()),
+                reducing the number of synchronous disk flushes. Callbacks are
+                not called until the group's files have been fsynced.
+        """
+        self.pool = futures.ProcessPoolExecutor(num_processes)
+        self.max_in_flight_bytes = max_in_flight_mb * 1e6
+        self.fsync_batch_size = fsync_batch_size
+        self._in_flight_bytes = 0
+        self._condition = threading.Condition()
+        self._delivery_lock = threading.Lock()
+        self._callback_thread = futures.ThreadPoolExecutor(max_workers=1)
+        self._groups = collections.OrderedDict()
+        self._group_counter = itertools.count()
+        self._unsynced = [] # (path, group) pairs awaiting a batch fsync
+        self._errors = []
+
+    def write(self, images, paths, flags=0):
+        """Write out a list of images to the given paths, as with ThreadedIO.write(),
+        waiting until they are written."""
+        done = threading.Event()
+        errors = []
+        def callback(error):
+            errors.append(error)
+            done.set()
+        self._write_group(images, paths, flags, callback, flush_fsyncs=True)
+        done.wait()
+        if errors[0] is not None:
+            raise errors[0]
+
+    def write_async(self, images, paths, flags=0, callback=None):
+        """Queue a list of images to be written to the given paths; flags is as
+        for ThreadedIO.write().
+
+        If specified, callback(error) will be called (from a background
+        thread) once all the images have been written, in the order that
+        write_async() calls were made. error is None if all were written
+        successfully, or else the exception raised. Exceptions are also
+        raised by wait(). Callbacks must not call write_async() or wait().
+        """
+        self._write_group(images, paths, flags, callback, flush_fsyncs=False)
+
+    def _write_group(self, images, paths, flags, callback, flush_fsyncs):
+        images = list(images)
+        if isinstance(flags, (list, tuple)):
+            writers = [get_writer(f) for f in flags]
+        else:
+            writers = [get_writer(flags)] * len(images)
+        group = _WriteGroup(len(images), callback, flush_fsyncs)
+        with self._condition:
+            self._groups[next(self._group_counter)] = group
+        for image, path, writer in zip(images, paths, writers):
+            image = numpy.asarray(image)
+            with self._condition:
+                # backpressure: wait for earlier images to be written if too much data are in flight
+                while self._in_flight_bytes > 0 and self._in_flight_bytes + image.nbytes > self.max_in_flight_bytes:
+                    self._condition.wait()
+                self._in_flight_bytes += image.nbytes
+            order = 'F' if image.flags.f_contiguous and not image.flags.c_contiguous else 'C'
+            buffer_name = 'image_io@{}:{}'.format(os.getpid(), next(_buffer_counter))
+            shared_image = ism_buffer.new(buffer_name, image.shape, image.dtype, order).asarray()
+            shared_image[...] = image
+            future = self.pool.submit(_process_write, writer, buffer_name, path, self.fsync_batch_size == 1)
+            # the callback keeps a reference to shared_image, so that the shared memory
+            # is retained until the worker is done with it
+            future.add_done_callback(lambda f, shared_image=shared_image, path=path, group=group:
+                self._write_done(f, shared_image.nbytes, path, group))
+        if not images:
+            self._schedule_delivery()
+
+    def _write_done(self, future, nbytes, path, group):
+        error = future.exception()
+        batch = None
+        with self._condition:
+            self._in_flight_bytes -= nbytes
+            group.unwritten -= 1
+            if error is not None:
+                group.error = group.error or error
+                group.remaining -= 1
+            elif self.fsync_batch_size > 1:
+                self._unsynced.append((path, group))
+                if len(self._unsynced) >= self.fsync_batch_size or self._fsyncs_awaited():
+                    batch, self._unsynced = self._unsynced, []
+            else:
+                group.remaining -= 1
+            self._condition.notify_all()
+        if batch:
+            self._submit_fsync(batch)
+        self._schedule_delivery()
+
+    def _fsyncs_awaited(self):
+        # Called with self._condition held. Return True if a write() or wait() is
+        # waiting for a group whose files have all been written, as have those
+        # of the groups before it (whose callbacks must come first): then the
+        # files awaiting a batch fsync must be fsynced now.
+        for group in self._groups.values():
+            if group.unwritten > 0:
+                return False
+            if group.flush_fsyncs:
+                return True
+        return False
+
+    def _submit_fsync(self, batch):
+        future = self.pool.submit(_fsync_paths, [path for path, group in batch])
+        future.add_done_callback(lambda f: self._fsync_done(f, batch))
+
+    def _fsync_done(self, future, batch):
+        error = future.exception()
+        with self._condition:
+            for path, group in batch:
+                if error is not None:
+                    group.error = group.error or error
+                group.remaining -= 1
+        self._schedule_delivery()
+
+    def flush_fsyncs(self):
+        """Start fsyncing any files waiting for a full fsync batch."""
+        with self._condition:
+            batch, self._unsynced = self._unsynced, []
+        if batch:
+            self._submit_fsync(batch)
+
+    def _schedule_delivery(self):
+        # _write_done() and _fsync_done() run in the process pool's result-handling
+        # thread, which must not be held up by the callbacks
+        self._callback_thread.submit(self._deliver_callbacks)
+
+    def _deliver_callbacks(self):
+        # the delivery lock ensures that callbacks are called one at a time, in order
+        with self._delivery_lock:
+            while True:
+                with self._condition:
+                    if not self._groups:
+                        return
+                    key, group = next(iter(self._groups.items()))
+                    if group.remaining > 0:
+                        return
+                    del self._groups[key]
+                    if group.error is not None:
+                        self._errors.append(group.error)
+                    self._condition.notify_all()
+                if group.callback is not None:
+                    try:
+                        group.callback(group.error)
+                    except Exception as e:
+                        with self._condition:
+                            self._errors.append(e)
+
+    def wait(self):
+        """Wait for all queued images to be written (and fsynced, if requested),
+        and for their callbacks to complete. Raise the first exception
+        encountered, if any."""
+        with self._condition:
+            for group in self._groups.values():
+                group.flush_fsyncs = True
+        self.flush_fsyncs()
+        with self._condition:
+            while self._groups:
+                self._condition.wait()
+        # callbacks run after their group is removed: make sure the last has finished
+        with self._delivery_lock, self._condition:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def read(self, paths):
+        """Return an iterator over image arrays read from the given paths."""
+        return map(read_image, paths)
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
+        self._callback_thread.shutdown()
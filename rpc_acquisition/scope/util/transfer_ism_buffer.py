@@ -22,6 +22,8 @@
 #
 # Authors: Zach Pincus
 
+import base64
+import itertools
 import json
 import numpy
 import struct
@@ -33,6 +35,7 @@ import time
 import ism_buffer
 
 _ism_buffer_registry = collections.defaultdict(list)
+_uploaded_arrays = {}
 
 def server_create_array(name, shape, dtype, order):
     """Create a numpy array view onto an ISM_Buffer shared memory region
@@ -91,6 +94,9 @@ def _server_pack_data(name, compressor='blosc', **compressor_args):
     compressor_args are passed to zlib.compress() or blosc.compress() directly."""
 
     array = _release_array(name) # get the array and release it from the list of to-be-transfered arrays
+    return _pack_array(array, compressor, **compressor_args)
+
+def _pack_array(array, compressor, **compressor_args):
     dtype_str = numpy.lib.format.dtype_to_descr(array.dtype)
     if array.flags.f_contiguous:
         order = 'F'
@@ -146,6 +152,26 @@ def _client_unpack_data(buf, compressor='blosc'):
     array.flags.writeable = True
     return array
 
+def _server_claim_uploaded_array(name):
+    """Open the named ISM_Buffer created by a client process and retain it
+    until server_take_uploaded_array() is called with the same name."""
+    _uploaded_arrays[name] = ism_buffer.open(name).asarray()
+
+def _server_unpack_uploaded_data(name, data, compressor):
+    """Unpack data packed by the client (and base64-encoded for transfer over
+    JSON RPC) and retain it until server_take_uploaded_array() is called with
+    the same name."""
+    _uploaded_arrays[name] = _client_unpack_data(base64.b64decode(data), compressor)
+
+def server_take_uploaded_array(name):
+    """Return the numpy array uploaded by a client under the given name (see
+    client_get_data_putter()), removing it from the registry of uploaded
+    arrays."""
+    try:
+        return _uploaded_arrays.pop(name)
+    except KeyError:
+        raise ValueError('No array named "{}" has been uploaded'.format(name))
+
 def _server_get_node():
     return platform.node()
 
@@ -198,3 +224,29 @@ def client_get_data_getter(rpc_client, force_remote=False):
                 return _client_unpack_data(data, self.compressor)
         get_data = GetData()
     return is_local, get_data
+
+_upload_counter = itertools.count()
+
+def client_get_data_putter(rpc_client, is_local):
+    """Return a callable, put_data(), which given a numpy array, copies it to
+    the server and returns a name by which server-side code can retrieve it
+    with server_take_uploaded_array(). If the server and client are on the
+    same host (is_local, as returned by client_get_data_getter()), the data are
+    copied into a new ISM_Buffer that the server opens directly; otherwise the
+    data are compressed and sent over RPC."""
+    if is_local:
+        def put_data(array):
+            name = 'upload@{}:{}'.format(time.time(), next(_upload_counter))
+            order = 'Fortran' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+            server_array = server_create_array(name, array.shape, array.dtype, order)
+            server_array[...] = array
+            # server_array keeps the ISM_Buffer alive until the server has opened it
+            rpc_client('_transfer_ism_buffer._server_claim_uploaded_array', name)
+            return name
+    else:
+        def put_data(array):
+            name = 'upload@{}:{}'.format(time.time(), next(_upload_counter))
+            data = base64.b64encode(_pack_array(array, 'zlib', level=2)).decode('ascii')
+            rpc_client('_transfer_ism_buffer._server_unpack_uploaded_data', name, data, 'zlib')
+            return name
+    return put_data